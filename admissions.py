@@ -1,23 +1,35 @@
-import geopandas as gpd
-import matplotlib.pyplot as plt
+import geometry
+import rendering
 
 
-def admission_rate(df):
+def admission_rate(df, testing=False):
     '''
     Plots the average admission rate for the universities/institutions per state.
+    Returns the states merged with their average admission rate; nothing is
+    plotted if testing is True.
     '''
-    avg_state_admission = df.groupby('ST_FIPS',
-                                     as_index=False)['ADM_RATE'].mean()
-    usa = gpd.read_file('data/gz_2010_us_040_00_5m.json')
+    avg_state_admission = df.groupby('ST_FIPS', as_index=False,
+                                     observed=True)['ADM_RATE'].mean()
+    usa = geometry.load_states()
     usa['STATE'] = usa['STATE'].astype(int)
     # merges with JSON state geospatial file
     merged = usa.merge(avg_state_admission, left_on='STATE', right_on='ST_FIPS',
                        how='inner')
-    fig, ax = plt.subplots(1)
-    ax.set_xlim([-200, -50])
-    ax.set_title("Average Admissions Rate Per State", fontsize=20)
-    merged.plot(ax=ax, column='ADM_RATE', legend='true')
-    fig.tight_layout()
-    plt.savefig('graphs/admissions_rate.png')
+    if testing == False:
+        plot_admission_rate(merged)
     # returns merged
     return merged
+
+
+def plot_admission_rate(merged):
+    '''
+    Helper method for admission_rate. Plots the map of the average admission
+    rate per state.
+    '''
+    fig, ax = rendering.new_figure()
+    ax.set_title("Average Admissions Rate Per State", fontsize=20)
+    collection, colorbar = rendering.choropleth(ax, rendering.state_paths(merged))
+    rendering.set_map_values(collection, colorbar, merged['ADM_RATE'])
+    ax.set_xlim([-200, -50])
+    fig.tight_layout()
+    rendering.save(fig, 'admissions_rate.png')
@@ -0,0 +1,368 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import admissions
+import cube
+import demographics
+import ingest
+import machine_learning
+import peers
+import race
+import rendering
+'''
+Benchmarks every public analysis function on synthetic datasets of any
+size. The synthetic datasets have the same columns and types as the real
+racial rep, IPEDS and College Scorecard datasets. Results are saved as JSON,
+and two result files can be compared to find slowdowns.
+
+    python benchmark.py run --sizes 10000 100000 --output results.json
+    python benchmark.py compare old.json new.json --threshold 1.25
+    python benchmark.py generate --rows 100000 --output-dir synthetic_data
+'''
+
+# state names and FIPS codes matching the state geometry file
+STATES = {
+    'Alabama': 1, 'Alaska': 2, 'Arizona': 4, 'Arkansas': 5, 'California': 6,
+    'Colorado': 8, 'Connecticut': 9, 'Delaware': 10, 'District of Columbia': 11,
+    'Florida': 12, 'Georgia': 13, 'Hawaii': 15, 'Idaho': 16, 'Illinois': 17,
+    'Indiana': 18, 'Iowa': 19, 'Kansas': 20, 'Kentucky': 21, 'Louisiana': 22,
+    'Maine': 23, 'Maryland': 24, 'Massachusetts': 25, 'Michigan': 26,
+    'Minnesota': 27, 'Mississippi': 28, 'Missouri': 29, 'Montana': 30,
+    'Nebraska': 31, 'Nevada': 32, 'New Hampshire': 33, 'New Jersey': 34,
+    'New Mexico': 35, 'New York': 36, 'North Carolina': 37, 'North Dakota': 38,
+    'Ohio': 39, 'Oklahoma': 40, 'Oregon': 41, 'Pennsylvania': 42,
+    'Rhode Island': 44, 'South Carolina': 45, 'South Dakota': 46,
+    'Tennessee': 47, 'Texas': 48, 'Utah': 49, 'Vermont': 50, 'Virginia': 51,
+    'Washington': 53, 'West Virginia': 54, 'Wisconsin': 55, 'Wyoming': 56,
+}
+IPEDS_RACES = ['Black or African American', 'Asian', 'Hispanic/Latino', 'White']
+SCORECARD_RACES = ['UGDS_WHITE', 'UGDS_BLACK', 'UGDS_HISP', 'UGDS_ASIAN',
+                   'UGDS_AIAN', 'UGDS_NHPI']
+# ML benchmarks (SVR in particular) are skipped above this many rows
+ML_ROW_LIMIT = 50000
+
+
+def institution_names(rows):
+    '''
+    Returns the synthetic institution names shared by all synthetic datasets.
+    '''
+    return ['Institution ' + str(i) for i in range(rows)]
+
+
+def synthetic_race(rows, years=(2017,), seed=0):
+    '''
+    Returns a synthetic college racial rep dataset with the given number of
+    institutions for every year.
+    '''
+    rng = np.random.default_rng(seed)
+    states = rng.choice(list(STATES), rows)
+    names = institution_names(rows)
+    frames = []
+    for year in years:
+        df = pd.DataFrame({'year': year, 'fips_ipeds': states, 'inst_name': names})
+        selectivity = rng.integers(0, 3, rows)
+        df['selective'] = (selectivity == 0).astype(float)
+        df['more_selective'] = (selectivity == 1).astype(float)
+        df['non_selective'] = (selectivity == 2).astype(float)
+        df['total_enrollment'] = rng.integers(100, 50000, rows).astype(float)
+        enrolled = rng.dirichlet(np.ones(len(ingest.RACES)), rows) * 100
+        market = rng.dirichlet(np.ones(len(ingest.RACES)), rows) * 100
+        for i, race_name in enumerate(ingest.RACES):
+            df['col_' + race_name] = enrolled[:, i]
+            df['mkt_' + race_name] = market[:, i]
+            df['dif_' + race_name] = enrolled[:, i] - market[:, i]
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def synthetic_ipeds(rows, seed=0):
+    '''
+    Returns a synthetic IPEDS dataset with the given number of institutions.
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'FIPS state code': rng.choice(list(STATES), rows),
+        'Sector of institution': rng.choice(['Public, 4-year or above',
+                                             'Private not-for-profit, 4-year or above'],
+                                            rows),
+        'Tuition and fees, 2013-14': rng.integers(3000, 60000, rows).astype(float),
+        'Total  enrollment': rng.integers(100, 60000, rows).astype(float),
+        'Percent of total enrollment that are women': rng.uniform(20, 80, rows),
+    })
+    shares = rng.dirichlet(np.ones(len(IPEDS_RACES)), rows) * 100
+    for i, race_name in enumerate(IPEDS_RACES):
+        df['Percent of total enrollment that are ' + race_name] = shares[:, i]
+    df['Applicants total'] = rng.integers(100, 80000, rows).astype(float)
+    df['Admissions total'] = (df['Applicants total'] * rng.uniform(0.05, 1, rows)).round()
+    for residency in ['in-state', 'out-of-state', 'foreign countries']:
+        df['Number of first-time undergraduates - ' + residency] = \
+            rng.integers(0, 5000, rows).astype(float)
+    return df
+
+
+def synthetic_scorecard(rows, seed=0, suppressed=0.02):
+    '''
+    Returns a synthetic most recent cohorts (College Scorecard) dataset with
+    the given number of institutions. About the suppressed fraction of the
+    socio-economic values are missing, like 'PrivacySuppressed' values
+    read through ingest.
+    '''
+    rng = np.random.default_rng(seed)
+    states = rng.choice(list(STATES), rows)
+    df = pd.DataFrame({
+        'INSTNM': institution_names(rows),
+        'ST_FIPS': [float(STATES[state]) for state in states],
+        'ADM_RATE': rng.uniform(0.05, 1, rows),
+        'SAT_AVG': rng.normal(1100, 120, rows).round(),
+        'FAMINC': rng.normal(60000, 20000, rows).round(),
+        'MD_FAMINC': rng.normal(40000, 15000, rows).round(),
+        'FIRST_GEN': rng.uniform(0.1, 0.6, rows),
+    })
+    shares = rng.dirichlet(np.ones(len(SCORECARD_RACES)), rows)
+    for i, column in enumerate(SCORECARD_RACES):
+        df[column] = shares[:, i]
+    for column in ['FAMINC', 'MD_FAMINC', 'FIRST_GEN'] + SCORECARD_RACES:
+        df.loc[rng.uniform(size=rows) < suppressed, column] = np.nan
+    return df
+
+
+def write_synthetic(directory, rows, years=(2017,), seed=0):
+    '''
+    Writes the three synthetic datasets as CSV files with the names main.py
+    reads them from. Suppressed Scorecard values are written as
+    'PrivacySuppressed' like in the real file.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    synthetic_race(rows, years, seed).to_csv(
+        os.path.join(directory, os.path.basename(ingest.DATASETS['race']['path'])),
+        index=False)
+    synthetic_ipeds(rows, seed).to_csv(
+        os.path.join(directory, os.path.basename(ingest.DATASETS['ipeds']['path'])),
+        index=False)
+    synthetic_scorecard(rows, seed).to_csv(
+        os.path.join(directory, os.path.basename(ingest.DATASETS['recent']['path'])),
+        index=False, na_rep=ingest.SUPPRESSED[0])
+
+
+def benchmarks():
+    '''
+    Returns a list of (function name, function, row limit) of the benchmarked
+    functions. Every function takes the synthetic datasets dictionary. The
+    plotting functions are included, since drawing is part of their cost.
+    '''
+    return [
+        ('race.state_race_averages', lambda d: race.state_race_averages(d['race']), None),
+        ('race.race_percent_geoplot', lambda d: race.race_percent_geoplot(d['race']), None),
+        ('race.race_enrollment_diff', lambda d: race.race_enrollment_diff(d['race']), None),
+        ('race.plot_market_share', lambda d: race.plot_market_share(d['race']), None),
+        ('race.calculate_racial_diversity_index',
+         lambda d: race.calculate_racial_diversity_index(d['race']), None),
+        ('race.race_top_bottom_5',
+         lambda d: race.race_top_bottom_5(race.calculate_racial_diversity_index(d['race'])),
+         None),
+        ('race.race_percent_time_bar', lambda d: race.race_percent_time_bar(d['race']), None),
+        ('cube.partials', lambda d: cube.partials(d['race']), None),
+        ('demographics.race_tuition_enrollment_correlation',
+         lambda d: demographics.race_tuition_enrollment_correlation(d['ipeds']), None),
+        ('demographics.filter_by_gender',
+         lambda d: demographics.filter_by_gender(d['ipeds']), None),
+        ('demographics.first_gen_selectivity',
+         lambda d: demographics.first_gen_selectivity(d['recent']), None),
+        ('demographics.in_state_out_state',
+         lambda d: demographics.in_state_out_state(d['ipeds']), None),
+        ('admissions.admission_rate', lambda d: admissions.admission_rate(d['merged']), None),
+        ('peers.find_peers',
+         lambda d: peers.find_peers(peers.build_index(d['race']),
+                                    d['race'].dropna(subset=peers.COMPOSITION), k=5), None),
+        ('machine_learning.race_selectivity_data_prep',
+         lambda d: machine_learning.race_selectivity_data_prep(d['race']), None),
+        ('machine_learning.run_race_selectivity_ml_models',
+         lambda d: machine_learning.run_race_selectivity_ml_models(
+             *machine_learning.race_selectivity_data_prep(d['race'])), ML_ROW_LIMIT),
+        ('machine_learning.socio_and_SAT_data_prep',
+         lambda d: machine_learning.socio_and_SAT_data_prep(d['merged']), None),
+        ('machine_learning.run_socio_and_SAT_data_ml_models',
+         lambda d: machine_learning.run_socio_and_SAT_data_ml_models(
+             *machine_learning.socio_and_SAT_data_prep(d['merged'])), ML_ROW_LIMIT),
+        ('machine_learning.socio_SAT_svm',
+         lambda d: machine_learning.socio_SAT_svm(
+             *machine_learning.socio_and_SAT_data_prep(d['merged'])), ML_ROW_LIMIT),
+        # the approximate SVM fits in about linear time, so it has no row limit
+        ('machine_learning.socio_SAT_approximate_svm',
+         lambda d: machine_learning.socio_SAT_approximate_svm(
+             *machine_learning.socio_and_SAT_data_prep(d['merged'])), None),
+    ]
+
+
+def run_benchmarks(sizes, functions=None, repeat=1, memory=True, seed=0):
+    '''
+    Runs every benchmark (or the ones whose name contains one of the
+    functions strings) for every size. Returns a list of result dictionaries
+    with the best wall time in seconds of the repeats and the peak traced
+    memory in MB. Graphs are saved in a temporary folder.
+    '''
+    results = []
+    output_dir = rendering.get_output_dir()
+    with tempfile.TemporaryDirectory() as graphs_dir:
+        rendering.set_output_dir(graphs_dir)
+        try:
+            for rows in sizes:
+                data = synthetic_data(rows, seed)
+                for name, func, limit in benchmarks():
+                    if functions and not any(f in name for f in functions):
+                        continue
+                    results.append(_run_benchmark(name, func, data, rows, limit,
+                                                  repeat, memory))
+                    _print_result(results[-1])
+        finally:
+            rendering.set_output_dir(output_dir)
+    return results
+
+
+def synthetic_data(rows, seed=0):
+    '''
+    Returns a dictionary of the synthetic datasets used by the benchmarks,
+    including the racial rep dataset merged with the Scorecard dataset.
+    '''
+    data = {
+        'race': synthetic_race(rows, seed=seed),
+        'ipeds': synthetic_ipeds(rows, seed),
+        'recent': synthetic_scorecard(rows, seed),
+    }
+    data['merged'] = data['race'].merge(data['recent'], left_on='inst_name',
+                                        right_on='INSTNM', how='left')
+    return data
+
+
+def save_results(results, path):
+    '''
+    Saves the benchmark results with information about the machine as JSON.
+    '''
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'pandas': pd.__version__,
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+def compare_results(old_path, new_path, threshold=1.2):
+    '''
+    Compares two saved result files and returns a list of
+    (function, rows, old seconds, new seconds) for every benchmark that got
+    slower by more than the threshold ratio.
+    '''
+    with open(old_path) as f:
+        old = {(r['function'], r['rows']): r for r in json.load(f)['results']}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    regressions = []
+    for result in new:
+        before = old.get((result['function'], result['rows']))
+        if before is None or before['seconds'] is None or result['seconds'] is None:
+            continue
+        if result['seconds'] > before['seconds'] * threshold:
+            regressions.append((result['function'], result['rows'],
+                                before['seconds'], result['seconds']))
+    return regressions
+
+
+def _run_benchmark(name, func, data, rows, limit, repeat, memory):
+    '''
+    Helper method for run_benchmarks that times one function on one size.
+    '''
+    result = {'function': name, 'rows': rows, 'seconds': None, 'peak_mb': None,
+              'error': None}
+    if limit is not None and rows > limit:
+        result['error'] = 'skipped above ' + str(limit) + ' rows'
+        return result
+    try:
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func(data)
+            times.append(time.perf_counter() - start)
+        result['seconds'] = min(times)
+        if memory:
+            # memory is measured in a separate run since tracing slows the function down
+            tracemalloc.start()
+            func(data)
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+    except Exception as e:
+        tracemalloc.stop()
+        result['error'] = type(e).__name__ + ': ' + str(e)
+    return result
+
+
+def _print_result(result):
+    '''
+    Helper method that prints one benchmark result.
+    '''
+    if result['error'] is not None:
+        print(result['function'], result['rows'], result['error'])
+    else:
+        peak = '' if result['peak_mb'] is None else \
+            ' ' + str(round(result['peak_mb'], 1)) + 'MB'
+        print(result['function'], result['rows'],
+              str(round(result['seconds'], 3)) + 's' + peak)
+
+
+def main():
+    '''
+    Command line entry point for running, comparing and generating data
+    for the benchmarks.
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark the analysis functions.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    run.add_argument('--functions', nargs='*',
+                     help='only run benchmarks whose name contains one of these')
+    run.add_argument('--repeat', type=int, default=1)
+    run.add_argument('--no-memory', action='store_true',
+                     help='do not measure peak memory')
+    run.add_argument('--render-processes', type=int,
+                     help='processes used to render graphs')
+    run.add_argument('--output', default='benchmark_results.json')
+    compare = commands.add_parser('compare', help='compare two result files')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=1.2,
+                         help='ratio of new to old time counted as a slowdown')
+    generate = commands.add_parser('generate', help='write synthetic CSV files')
+    generate.add_argument('--rows', type=int, default=10000)
+    generate.add_argument('--years', type=int, nargs='+', default=[2017])
+    generate.add_argument('--output-dir', default='synthetic_data')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        if args.render_processes is not None:
+            rendering.set_processes(args.render_processes)
+        results = run_benchmarks(args.sizes, args.functions, args.repeat,
+                                 not args.no_memory)
+        save_results(results, args.output)
+    elif args.command == 'compare':
+        regressions = compare_results(args.old, args.new, args.threshold)
+        for function, rows, before, after in regressions:
+            print(function, rows, str(round(before, 3)) + 's ->',
+                  str(round(after, 3)) + 's')
+        if regressions:
+            sys.exit(1)
+    else:
+        write_synthetic(args.output_dir, args.rows, args.years)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import pandas as pd
+import geometry
+import ingest
+import race
+'''
+Keeps the year and state level averages of the racial rep dataset as an
+aggregate cube: the sum and count of every col_, mkt_ and dif_ column (and
+total_enrollment) per year, state and metric. Sums and counts can be added
+together, so any set of years or states is averaged from the cube without
+going back to the institution rows. The cube is saved under cache/cube and
+only the years whose partition of the dataset changed (or new years) are
+computed again.
+'''
+
+CUBE_DIR = os.path.join(geometry.CACHE_DIR, 'cube')
+# columns of the racial rep dataset summed in the cube
+METRIC_COLUMNS = ['total_enrollment'] + [metric + race_name for metric in race.METRICS
+                                         for race_name in race.RACES]
+
+_lock = threading.Lock()
+
+
+def partials(df):
+    '''
+    Takes in rows of the racial rep dataset and returns their cube: one row
+    per year, state and metric column with the sum and the count of the
+    values that are not missing. Rows without a state are kept (with a
+    missing state), so the yearly averages still include them.
+    '''
+    columns = [col for col in METRIC_COLUMNS if col in df.columns]
+    grouped = df.groupby(['year', 'fips_ipeds'], observed=True, dropna=False)[columns]
+    keys = ['year', 'fips_ipeds']
+    sums = grouped.sum().reset_index().melt(keys, var_name='metric', value_name='sum')
+    counts = grouped.count().reset_index().melt(keys, var_name='metric', value_name='count')
+    # both frames come from the same groups, so their rows line up
+    sums['count'] = counts['count'].to_numpy()
+    return sums.rename(columns={'fips_ipeds': 'state'})
+
+
+def update(cube, df):
+    '''
+    Returns the cube with the years in the racial rep rows replaced by the
+    partials of those rows (years not in the cube yet are added), so only
+    those years are computed.
+    '''
+    new = partials(df)
+    if cube is None:
+        return new
+    return pd.concat([cube[~cube['year'].isin(df['year'].unique())], new],
+                     ignore_index=True)
+
+
+def load_cube(path=None, directory=None, cache_dir=None):
+    '''
+    Returns the cube of the racial rep dataset at the path (the ingest path by
+    default). The cube saved in the directory (a cube folder in the cache_dir,
+    cache/cube by default) is reused, and only the years whose partition
+    changed since it was saved are read and computed again.
+    '''
+    path = path or ingest.DATASETS['race']['path']
+    if directory is None:
+        directory = os.path.join(cache_dir, 'cube') if cache_dir else CUBE_DIR
+    columns = ['year', 'fips_ipeds'] + METRIC_COLUMNS
+    with _lock:
+        partitions = ingest.race_partitions(path, cache_dir)
+        if partitions is None:
+            # no Parquet support, so the cube is computed from the whole dataset
+            return partials(ingest.read_dataset('race', columns, path, cache_dir))
+        directory = os.path.join(directory, ingest.cache_key(path))
+        cube_path = os.path.join(directory, 'cube.parquet')
+        meta_path = os.path.join(directory, 'years.json')
+        saved = {}
+        if os.path.exists(cube_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                saved = json.load(f)
+        years = {str(year): geometry.file_hash(os.path.join(partitions, str(year) + '.parquet'))
+                 for year in ingest.race_years(path, cache_dir)}
+        if saved == years:
+            return pd.read_parquet(cube_path)
+
+        cube = None
+        if saved:
+            cube = pd.read_parquet(cube_path)
+            # years that are no longer in the dataset are dropped
+            cube = cube[cube['year'].astype(str).isin(years)]
+        for year in years:
+            if saved.get(year) != years[year]:
+                cube = update(cube, ingest.read_race_year(int(year), columns, path,
+                                                            cache_dir))
+        os.makedirs(directory, exist_ok=True)
+        cube.to_parquet(cube_path, index=False)
+        with open(meta_path, 'w') as f:
+            json.dump(years, f)
+        return cube
+
+
+def state_averages(cube, years=None):
+    '''
+    Returns the state averages of every race metric over the given years
+    (all years by default) from the cube, in the same form as
+    race.state_race_averages returns them.
+    '''
+    if years is not None:
+        cube = cube[cube['year'].isin(years)]
+    means = _means(cube.dropna(subset=['state']), 'state')
+    columns = [metric + race_name for metric in race.METRICS for race_name in race.RACES
+               if metric + race_name in means.columns]
+    return race.label_averages(means[columns].rename_axis('fips_ipeds'))
+
+
+def year_averages(cube):
+    '''
+    Returns the total enrollment and the average of every col_ race column
+    per year from the cube, which race.race_percent_time_bar can take as
+    its averages.
+    '''
+    means = _means(cube, 'year')
+    totals = cube[cube['metric'] == 'total_enrollment'].groupby('year')['sum'].sum()
+    columns = ['col_' + race_name for race_name in race.RACES
+               if 'col_' + race_name in means.columns]
+    return pd.concat([totals.rename('total_enrollment'), means[columns]], axis=1)
+
+
+def _means(cube, key):
+    '''
+    Helper method that adds up the sums and counts of the cube per key
+    ('state' or 'year') and metric and returns the averages with one
+    column per metric.
+    '''
+    totals = cube.groupby([key, 'metric'], observed=True)[['sum', 'count']].sum()
+    means = (totals['sum'] / totals['count']).unstack('metric')
+    return means.rename_axis(columns=None)
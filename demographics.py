@@ -1,8 +1,8 @@
-import matplotlib.pyplot as plt
 import pandas as pd
-import seaborn as sns
 import numpy as np
-import geopandas as gpd
+import geometry
+import regression
+import rendering
 
 """
 Includes code for the 2nd research question
@@ -11,52 +11,93 @@ enrollment/admissions and other factors
 """
 
 
+# IPEDS percentage column name of each race
+RACE_COLUMNS = {
+    'Black': 'Black or African American',
+    'Asian': 'Asian',
+    'Hispanic/Latino': 'Hispanic/Latino',
+    'White': 'White',
+}
+TUITION = 'Tuition and fees, 2013-14'
+RESIDENCY = ['Number of first-time undergraduates - in-state',
+             'Number of first-time undergraduates - out-of-state',
+             'Number of first-time undergraduates - foreign countries']
+
+
+def race_enrollment_metrics(df, races=None):
+    '''
+    Takes in the IPEDS Dataframe and returns a new narrow dataframe with the
+    enrollment count of every race (<race>_enrollment_count, the race's
+    percentage of the total enrollment) and the admission rate, computed
+    together from only the needed columns. The IPEDS dataframe is not changed.
+    '''
+    if races is None:
+        races = list(RACE_COLUMNS)
+    percent_cols = percent_columns(races)
+    total_enroll = df['Total  enrollment'].to_numpy(dtype=float)
+    # every race count in one pass over the percentage columns
+    counts = df[percent_cols].to_numpy(dtype=float) / 100 * total_enroll[:, None]
+    metrics = pd.DataFrame(counts, index=df.index,
+                           columns=[race + '_enrollment_count' for race in races])
+    metrics['admission_rate'] = (df['Admissions total'].to_numpy(dtype=float) /
+                                 df['Applicants total'].to_numpy(dtype=float) * 100)
+    return metrics
+
+
 def race_tuition_enrollment_correlation(df):
     '''
     Calls the method to plot the correlation between
     tutition for the 4 highest racial populations. 
     Takes in the IPEDS Dataset.
     '''
-    plot_race_tuition(df, 'Black', 'red')
-    plot_race_tuition(df, 'Asian', 'blue')
-    plot_race_tuition(df, 'Hispanic/Latino', 'green')
-    plot_race_tuition(df, 'White', 'purple')
+    # the four plots share one narrow frame instead of each copying the dataset
+    data = race_enrollment_metrics(df).join(df[[TUITION] + percent_columns()])
+    rendering.render_all([(plot_race_tuition_metrics, (data, 'Black', 'red')),
+                          (plot_race_tuition_metrics, (data, 'Asian', 'blue')),
+                          (plot_race_tuition_metrics, (data, 'Hispanic/Latino', 'green')),
+                          (plot_race_tuition_metrics, (data, 'White', 'purple'))])
 
 
 def plot_race_tuition(df, race, color, testing=False):
     '''
     Plots a scatterplot which signifies the correlation between the number
     of students of a particular race. Takes in the color of the graph, and
-    the race being graphed.
+    the race being graphed. Returns the enrollment counts of the race.
     '''
-    fig, ax = plt.subplots(1)
-    if race == 'Black':
-        percent_col = 'Black or African American'
-    else:
-        percent_col = race
-    name = race + '_enrollment_count'
-    df_copy = df.copy()
-    # calculates enrollment from total enrollment and percentage columns
-    total_enroll = df_copy['Total  enrollment']
-    df_copy[name] = df_copy['Percent of total enrollment that are ' +
-                            percent_col] / 100 * total_enroll
-
+    metrics = race_enrollment_metrics(df, [race])
     if testing == False:
-        # color is changed for each race; alpha modifies the transparency of the dots
-        plt.scatter(x='Tuition and fees, 2013-14',
-                    y=name, data=df_copy,
-                    s=df_copy['Percent of total enrollment that are ' +
-                              percent_col],
-                    color=color, alpha=0.4)
-        plt.xlabel('Tuition ($)'),
-        plt.ylabel('Number of ' + race + ' People In Insititution')
-        plt.title('Correlation Between ' + race + ' Population and Tuition')
+        plot_race_tuition_metrics(
+            metrics.join(df[[TUITION] + percent_columns([race])]), race, color)
+    return metrics[race + '_enrollment_count']
+
+
+def plot_race_tuition_metrics(data, race, color):
+    '''
+    Helper method for plot_race_tuition. Takes in the race enrollment metrics
+    joined with the tuition and race percentage columns and plots them.
+    '''
+    name = race + '_enrollment_count'
+    percent = data[percent_columns([race])[0]]
+    fig, ax = rendering.new_figure()
+    # color is changed for each race; alpha modifies the transparency of the dots
+    ax.scatter(x=TUITION, y=name, data=data, s=percent, color=color, alpha=0.4)
+    ax.set_xlabel('Tuition ($)'),
+    ax.set_ylabel('Number of ' + race + ' People In Insititution')
+    ax.set_title('Correlation Between ' + race + ' Population and Tuition')
     # exception for Hispanic/Latino column
     if race == 'Hispanic/Latino':
         race = race.split('/')[0]
-    plt.savefig('graphs/' + race + '_enrollment_tuition.png')
-    plt.close()
-    return df_copy[name]
+    rendering.save(fig, race + '_enrollment_tuition.png')
+
+
+def percent_columns(races=None):
+    '''
+    Returns the IPEDS percentage column names of the races (all four by default).
+    '''
+    if races is None:
+        races = list(RACE_COLUMNS)
+    return ['Percent of total enrollment that are ' + RACE_COLUMNS[race]
+            for race in races]
 
 
 def filter_by_gender(df, testing=False):
@@ -67,19 +108,19 @@ def filter_by_gender(df, testing=False):
     '''
     df_gender = pd.DataFrame()
     # average enrollment of Women per each state
-    df_gender['women'] = df.groupby('FIPS state code')[
+    df_gender['women'] = df.groupby('FIPS state code', observed=True)[
         'Percent of total enrollment that are women'].mean()
     # no column for men: manually calculated as the remainder for whatever is not men
     df_gender['men'] = 100 - df_gender['women']
     # merges with JSON file for state geometry
-    usa = gpd.read_file('data/gz_2010_us_040_00_5m.json')
+    usa = geometry.load_states()
     merged = usa.merge(df_gender,
                        left_on='NAME',
                        right_index=True,
                        how='inner')
     if testing == False:
-        plot_gender_geospatial(merged, 'women', 'men')
-        plot_gender_barplot(df_gender)
+        rendering.render_all([(plot_gender_geospatial, (merged, 'women', 'men')),
+                              (plot_gender_barplot, (df_gender,))])
     return merged
 
 
@@ -90,26 +131,25 @@ def plot_gender_geospatial(merged, gender1, gender2):
     Top plot represents the enrollment of women
     Bottom plot represents the enrollment of men
     '''
-    fig, axs = plt.subplots(2, figsize=(30, 25))
+    fig, axs = rendering.new_figure(2, figsize=(30, 25))
     # set up the axes for the figure
     for ax in axs:
-        ax.set_xlim([-200, -50])
         ax.xaxis.set_tick_params(labelsize=20)
         ax.yaxis.set_tick_params(labelsize=20)
         ax.set_ylabel('Enrollment %', fontsize=30)
-    # plots the geospatial graphs
-    axs[0].set_title('Avg Enrollment % of ' + gender1.capitalize() +' Per State',
+    # plots the geospatial graphs, converting the state shapes once for both
+    paths = rendering.state_paths(merged)
+    for ax, gender in zip(axs, [gender1, gender2]):
+        ax.set_title('Avg Enrollment % of ' + gender.capitalize() + ' Per State',
                      fontsize=40)
-    merged.plot(ax=axs[0], column=gender1, legend='true')
-    axs[1].set_title('Avg Enrollment % of ' + gender2.capitalize() +' Per State',
-                     fontsize=40)
-    merged.plot(ax=axs[1], column=gender2, legend='true')
+        collection, colorbar = rendering.choropleth(ax, paths)
+        rendering.set_map_values(collection, colorbar, merged[gender])
+        ax.set_xlim([-200, -50])
     # sets a supertitle for the figure
     fig.suptitle('Average Enrollment By Gender Across the Nation', fontsize=60)
     # padding spaces out text from graphs, enhancing visual appearence
     fig.tight_layout(pad=3)
-    plt.savefig('graphs/geospatial_gender.png')
-    plt.close()
+    rendering.save(fig, 'geospatial_gender.png')
 
 
 def plot_gender_barplot(df_gender):
@@ -125,16 +165,15 @@ def plot_gender_barplot(df_gender):
     # find the 5 universities with the largest percentage difference
     largest = df_gender.nlargest(5, 'difference')
     df_gender_state = pd.concat([smallest, largest])
-    fig, ax = plt.subplots(1)
+    fig, ax = rendering.new_figure()
     df_gender_state = df_gender_state.drop(columns='difference')
     # plots the stacked bar plot, consecutive order top 5 -- bottom 5
     df_gender_state.plot.bar(use_index=True, stacked=True, ax=ax, fontsize=10)
 
-    plt.title('Gender Enrollment Percentages By State: Top/Bottom 5')
-    plt.xlabel('State')
-    plt.ylabel('Percentage')
-    plt.savefig('graphs/gender_barplot.png', bbox_inches='tight')
-    plt.close()
+    ax.set_title('Gender Enrollment Percentages By State: Top/Bottom 5')
+    ax.set_xlabel('State')
+    ax.set_ylabel('Percentage')
+    rendering.save(fig, 'gender_barplot.png', bbox_inches='tight')
     return df_gender
 
 
@@ -144,17 +183,18 @@ def first_gen_selectivity(df):
     The method plots the correlations between an institution's admission rate
     and the number of their first-generation enrolled students
     Each dot represents an individual institution
+    Returns the fitted line and correlations.
     """
-    fig, ax = plt.subplots(1)
-    df_copy = df.copy()
-    df_copy['ADM_RATE'] = df_copy['ADM_RATE'] * 100
-    df_copy['FIRST_GEN'] = df_copy['FIRST_GEN'] * 100
-    ax = sns.regplot(x='ADM_RATE', y='FIRST_GEN', data=df_copy)
+    fig, ax = rendering.new_figure()
+    # only the two plotted columns are turned into percentages
+    data = pd.DataFrame({'ADM_RATE': df['ADM_RATE'] * 100,
+                         'FIRST_GEN': df['FIRST_GEN'] * 100})
+    fit = regression.regression_plot(ax, data, 'ADM_RATE', 'FIRST_GEN')
     ax.set(title='Correlation Between First Gen Percent and Admissions',
            xlabel='Admissions Rate %',
            ylabel='% of First Gen Students')
-    plt.savefig('graphs/first_gen_admission.png')
-    plt.close()
+    rendering.save(fig, 'first_gen_admission.png')
+    return fit
 
 
 def in_state_out_state(df, testing=False):
@@ -163,12 +203,13 @@ def in_state_out_state(df, testing=False):
     Plots three graphs on one figure representing number of students admitted from
     In-State, Out-Of-State, and Foreign Countries
     Finds the correlation between enrollment metrics and acceptance/admissions rate
+    Returns a new dataframe of the admission rate and the three residency counts.
     """
-    # calculates the admission rate
-    df['admission_rate'] = df['Admissions total'] / df['Applicants total'] * 100
+    # calculates the admission rate without adding a column to the dataset
+    data = race_enrollment_metrics(df, [])[['admission_rate']].join(df[RESIDENCY])
     if testing == False:
         # sets up the figure, titles, and labels
-        fig, [ax1, ax2, ax3] = plt.subplots(3, figsize=(20, 13))
+        fig, [ax1, ax2, ax3] = rendering.new_figure(3, figsize=(20, 13))
         axs = [ax1, ax2, ax3]
         ax1.set_title('Number of In-State versus Admission Rate', fontsize=15)
         ax2.set_title('Number of Out-of-State versus Admission Rate',
@@ -177,22 +218,15 @@ def in_state_out_state(df, testing=False):
                       fontsize=15)
         fig.suptitle(
             'Correlation Between In State, Out of State, and International Student Enrollment versus Admission Rate', fontsize=25)
-        # plots three regplots: in-state, out-of-state, foreign
-        sns.regplot(x='admission_rate',
-                    y='Number of first-time undergraduates - in-state',
-                    data=df, ax=ax1)
-        sns.regplot(x='admission_rate',
-                    y='Number of first-time undergraduates - out-of-state',
-                    data=df, ax=ax2, color='r')
-        sns.regplot(
-            x='admission_rate',
-            y='Number of first-time undergraduates - foreign countries',
-            data=df, ax=ax3, color='g')
+        # plots three regression plots: in-state, out-of-state, foreign
+        # (the three lines are fitted together)
+        fits = regression.fit_lines(data, [('admission_rate', col) for col in RESIDENCY])
+        for ax, color, (i, fit) in zip(axs, ['C0', 'r', 'g'], fits.iterrows()):
+            regression.regression_plot(ax, data, fit['x'], fit['y'], color, fit)
         # sets the x and y labels for each axis
         for ax in axs:
             ax.set_xlabel('Admissions Rate (%)', fontsize=15)
             ax.set_ylabel('Number of Students', fontsize=15)
         fig.tight_layout(pad=3.0)
-        plt.savefig('graphs/residency_and_admissions.png')
-        plt.close()
-    return df
+        rendering.save(fig, 'residency_and_admissions.png')
+    return data
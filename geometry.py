@@ -0,0 +1,77 @@
+import hashlib
+import os
+import threading
+'''
+Provides the state shapes used by every choropleth in the project.
+The GeoJSON file is only parsed once per process, and a binary
+GeoParquet copy is kept on disk so later runs can skip parsing it.
+'''
+
+STATES_PATH = 'data/gz_2010_us_040_00_5m.json'
+CACHE_DIR = 'cache'
+
+# loaded state frames keyed by (path, simplify tolerance)
+_states = {}
+# threads asking for shapes that are still being read wait for that read
+_states_lock = threading.RLock()
+
+
+def file_hash(path):
+    '''
+    Returns the sha256 hex digest of the file at the given path.
+    The file is read in blocks so large files are not loaded at once.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_states(simplify=None, path=STATES_PATH):
+    '''
+    Returns a GeoDataFrame of the state shapes. Passing a simplify tolerance
+    (in degrees) returns a lighter version of the shapes for plotting.
+    A copy is returned every time so callers are free to modify it.
+    '''
+    key = (path, simplify)
+    with _states_lock:
+        if key not in _states:
+            _states[key] = _read_states(path, simplify)
+        return _states[key].copy()
+
+
+def clear_cache():
+    '''
+    Forgets the state shapes loaded by this process. The on-disk cache is kept.
+    '''
+    _states.clear()
+
+
+def _read_states(path, simplify):
+    '''
+    Helper method for load_states. Reads the cached GeoParquet file if one
+    exists for the current contents of the source file, otherwise parses the
+    source file and writes the cache.
+    '''
+    # geopandas is slow to import, so it is only imported once shapes are needed
+    import geopandas as gpd
+    name = 'states_' + file_hash(path)[:16]
+    if simplify is not None:
+        name += '_simplified_' + str(simplify)
+    cache_path = os.path.join(CACHE_DIR, name + '.parquet')
+    if os.path.exists(cache_path):
+        return gpd.read_parquet(cache_path)
+
+    if simplify is None:
+        usa = gpd.read_file(path)
+    else:
+        usa = load_states(path=path)
+        usa['geometry'] = usa.simplify(simplify, preserve_topology=True)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        usa.to_parquet(cache_path)
+    except ImportError:
+        # pyarrow is not installed, so the shapes are only kept in memory
+        pass
+    return usa
@@ -0,0 +1,358 @@
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import geometry
+'''
+Reads the three project datasets. Every dataset has an explicit schema of
+the columns the analyses use and their types. The first read of a CSV file
+converts it into a Parquet file under cache/, and later reads load the
+Parquet file (only the needed columns) until the CSV file changes.
+College Scorecard files are read in chunks with 'PrivacySuppressed'
+markers turned into missing values, so their columns are numeric.
+The racial rep dataset is also stored as one Parquet file per year, so a
+single year can be loaded without reading the other years.
+Loaded dataframes can be compacted to use less memory, and several
+datasets can be read at the same time in background threads.
+'''
+
+CACHE_DIR = geometry.CACHE_DIR
+# markers the College Scorecard uses for suppressed values
+SUPPRESSED = ['PrivacySuppressed']
+SCORECARD_CHUNKSIZE = 50000
+RACES = ['white', 'black', 'asian', 'hispa', 'amind', 'pacis', 'twora']
+# string columns with at most this share of distinct values become categoricals
+CATEGORY_RATIO = 0.5
+
+# schema for the college racial rep dataset
+RACE_SCHEMA = {
+    'year': 'int64',
+    'fips_ipeds': 'object',
+    'inst_name': 'object',
+    'selective': 'float64',
+    'more_selective': 'float64',
+    'non_selective': 'float64',
+    'total_enrollment': 'float64',
+}
+for _race in RACES:
+    for _prefix in ['col_', 'mkt_', 'dif_']:
+        RACE_SCHEMA[_prefix + _race] = 'float64'
+
+# schema for the IPEDS dataset
+IPEDS_SCHEMA = {
+    'FIPS state code': 'object',
+    'Sector of institution': 'object',
+    'Tuition and fees, 2013-14': 'float64',
+    'Total  enrollment': 'float64',
+    'Percent of total enrollment that are women': 'float64',
+    'Percent of total enrollment that are Black or African American': 'float64',
+    'Percent of total enrollment that are Asian': 'float64',
+    'Percent of total enrollment that are Hispanic/Latino': 'float64',
+    'Percent of total enrollment that are White': 'float64',
+    'Applicants total': 'float64',
+    'Admissions total': 'float64',
+    'Number of first-time undergraduates - in-state': 'float64',
+    'Number of first-time undergraduates - out-of-state': 'float64',
+    'Number of first-time undergraduates - foreign countries': 'float64',
+}
+
+# schema for the most recent cohorts (College Scorecard) dataset
+RECENT_SCHEMA = {
+    'INSTNM': 'object',
+    'ST_FIPS': 'float64',
+    'ADM_RATE': 'float64',
+    'SAT_AVG': 'float64',
+    # these columns can contain 'PrivacySuppressed' markers
+    'FAMINC': 'float64',
+    'MD_FAMINC': 'float64',
+    'FIRST_GEN': 'float64',
+    'UGDS_WHITE': 'float64',
+    'UGDS_BLACK': 'float64',
+    'UGDS_HISP': 'float64',
+    'UGDS_ASIAN': 'float64',
+    'UGDS_AIAN': 'float64',
+    'UGDS_NHPI': 'float64',
+}
+
+DATASETS = {
+    'ipeds': {'path': 'data/IPEDS_data.csv', 'schema': IPEDS_SCHEMA},
+    'race': {'path': 'data/college_racial_rep.csv', 'schema': RACE_SCHEMA},
+    # the full Scorecard has thousands of columns, so only the schema
+    # columns are kept in its cache
+    'recent': {'path': 'data/Most_recent_cohorts_institution_filtered.csv',
+               'schema': RECENT_SCHEMA, 'scorecard': True},
+}
+# a dataset's Parquet copy is only converted by one thread at a time
+_cache_locks = {name: threading.RLock() for name in DATASETS}
+
+
+def read_dataset(name, columns=None, path=None, cache_dir=None):
+    '''
+    Returns the named dataset ('ipeds', 'race' or 'recent') as a dataframe.
+    Only the given columns are loaded; by default these are the columns in
+    the dataset's schema. A different CSV file can be passed in as the path,
+    and a different folder for the Parquet copies as the cache_dir.
+    '''
+    dataset = DATASETS[name]
+    path = path or dataset['path']
+    if columns is None:
+        columns = list(dataset['schema'])
+    cache_path = cached_parquet(name, path, cache_dir)
+    if cache_path is None:
+        # no Parquet support, so the CSV file is parsed every time
+        return _read_csv(dataset, path, columns)
+    available = set(_parquet_columns(cache_path))
+    return pd.read_parquet(cache_path,
+                           columns=[col for col in columns if col in available])
+
+
+def cached_parquet(name, path, cache_dir=None):
+    '''
+    Returns the path of the Parquet copy of the CSV file, converting the
+    CSV file first if there is no copy or the CSV file has changed since.
+    The copy is saved in the cache_dir (cache/ by default). Returns None if
+    Parquet files can not be written (pyarrow missing).
+    '''
+    cache_dir = cache_dir or CACHE_DIR
+    with _cache_locks[name]:
+        base = os.path.join(cache_dir, name + '_' + cache_key(path))
+        cache_path = base + '.parquet'
+        meta_path = base + '.json'
+        stat = os.stat(path)
+        dataset = DATASETS[name]
+        source = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                  'schema': _schema_key(dataset)}
+        if os.path.exists(cache_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('schema') != source['schema']:
+                # the schema changed, so the file has to be converted again
+                meta = {}
+            elif meta['mtime'] == source['mtime'] and meta['size'] == source['size']:
+                return cache_path
+            # file was touched, so only reconvert if the contents changed
+            source['hash'] = geometry.file_hash(path)
+            if meta.get('hash') == source['hash']:
+                _write_meta(meta_path, source)
+                return cache_path
+
+        if importlib.util.find_spec('pyarrow') is None:
+            return None
+        columns = list(dataset['schema']) if dataset.get('scorecard') else None
+        df = _read_csv(dataset, path, columns)
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(cache_path, index=False)
+        source['hash'] = source.get('hash') or geometry.file_hash(path)
+        _write_meta(meta_path, source)
+        return cache_path
+
+
+def cache_key(path):
+    '''
+    Returns the name the cached copies of the CSV file are saved under: its
+    file name followed by a hash of its absolute path, so CSV files with the
+    same name in different folders do not share a copy.
+    '''
+    path_hash = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    return os.path.basename(path) + '_' + path_hash[:12]
+
+
+def race_years(path=None, cache_dir=None):
+    '''
+    Returns the sorted list of years in the racial rep dataset.
+    '''
+    partitions = race_partitions(path, cache_dir)
+    if partitions is None:
+        return sorted(read_dataset('race', ['year'], path, cache_dir)['year'].unique())
+    return sorted(int(file_name[:-len('.parquet')])
+                  for file_name in os.listdir(partitions)
+                  if file_name.endswith('.parquet'))
+
+
+def read_race_year(year, columns=None, path=None, cache_dir=None):
+    '''
+    Returns the rows of the racial rep dataset for one year, reading only
+    that year's partition. Only the given columns are loaded (by default the
+    columns in the schema). The dataframe is empty if the year is missing.
+    '''
+    partitions = race_partitions(path, cache_dir)
+    if partitions is None:
+        df = read_dataset('race', columns, path, cache_dir)
+        return df[df['year'] == year].reset_index(drop=True)
+    if columns is None:
+        columns = list(RACE_SCHEMA)
+    year_path = os.path.join(partitions, str(year) + '.parquet')
+    if not os.path.exists(year_path):
+        return read_dataset('race', columns, path, cache_dir).iloc[0:0]
+    available = set(_parquet_columns(year_path))
+    return pd.read_parquet(year_path,
+                           columns=[col for col in columns if col in available])
+
+
+def race_partitions(path=None, cache_dir=None):
+    '''
+    Returns the folder holding one Parquet file per year of the racial rep
+    dataset, splitting the cached dataset first if the folder is missing or
+    out of date. Returns None if Parquet files can not be written.
+    The folder is named after the conversion it was split from and is only
+    renamed into place once every year is written, so other processes
+    reading the years never see a missing or half written file.
+    '''
+    path = path or DATASETS['race']['path']
+    with _cache_locks['race']:
+        cache_path = cached_parquet('race', path, cache_dir)
+        if cache_path is None:
+            return None
+        base = cache_path[:-len('.parquet')]
+        with open(base + '.json') as f:
+            meta = json.load(f)
+        source = json.dumps({'hash': meta['hash'], 'schema': meta['schema']}, sort_keys=True)
+        partitions = base + '_by_year_' + hashlib.sha256(source.encode()).hexdigest()[:16]
+        if os.path.exists(partitions):
+            return partitions
+
+        # the years are written next to the folder and then renamed to it
+        folder, name = os.path.split(base)
+        building = tempfile.mkdtemp(prefix='.' + name + '_by_year_', dir=folder)
+        df = pd.read_parquet(cache_path)
+        for year, df_year in df.groupby('year'):
+            df_year.to_parquet(os.path.join(building, str(year) + '.parquet'),
+                               index=False)
+        try:
+            os.replace(building, partitions)
+        except OSError:
+            # another process renamed the same years into place first
+            shutil.rmtree(building, ignore_errors=True)
+        # the folders of older conversions are out of date
+        for old in glob.glob(glob.escape(base) + '_by_year*'):
+            if old != partitions:
+                shutil.rmtree(old, ignore_errors=True)
+        return partitions
+
+
+def load_in_background(loaders):
+    '''
+    Takes in a dictionary of names and functions (without arguments) that
+    load data and starts all of them at once in background threads, so
+    reading one file overlaps with reading the others and with any work that
+    does not need it. Returns a dictionary of the names and the futures of
+    the loaded values.
+    '''
+    if not loaders:
+        return {}
+    pool = ThreadPoolExecutor(max_workers=len(loaders), thread_name_prefix='ingest')
+    futures = {name: pool.submit(func) for name, func in loaders.items()}
+    # the threads are left to finish their loads on their own
+    pool.shutdown(wait=False)
+    return futures
+
+
+def read_scorecard(path, columns, chunksize=SCORECARD_CHUNKSIZE):
+    '''
+    Reads the given columns of a College Scorecard CSV file chunksize rows
+    at a time, so only the selected columns are ever held in memory.
+    'PrivacySuppressed' markers are read as missing values, so the columns
+    get numeric types (the types in the Scorecard schema where known).
+    '''
+    columns = set(columns)
+    header = pd.read_csv(path, nrows=0).columns
+    dtypes = {col: dtype for col, dtype in RECENT_SCHEMA.items()
+              if col in columns and col in header}
+    chunks = pd.read_csv(path, usecols=lambda col: col in columns, dtype=dtypes,
+                         na_values=SUPPRESSED, chunksize=chunksize)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def compact(df, report=False):
+    '''
+    Returns a copy of the dataframe that uses less memory. String columns
+    with many repeated values become categoricals, number columns holding
+    only whole numbers become the smallest integer type that fits them and
+    the other number columns become float32. If report is True, the memory
+    before and after is printed.
+    '''
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object:
+            if values.nunique() <= CATEGORY_RATIO * len(values):
+                values = values.astype('category')
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            values = pd.to_numeric(values, downcast='integer')
+        elif pd.api.types.is_float_dtype(values.dtype):
+            if values.notna().all() and (values % 1 == 0).all():
+                values = pd.to_numeric(values.astype('int64'), downcast='integer')
+            else:
+                values = values.astype('float32')
+        columns[col] = values
+    compacted = pd.DataFrame(columns, index=df.index)
+    if report:
+        before = memory_mb(df)
+        after = memory_mb(compacted)
+        print('Compacted', len(df.columns), 'columns from', round(before, 2), 'MB to',
+              round(after, 2), 'MB (saved ' + str(round(before - after, 2)) + ' MB)')
+    return compacted
+
+
+def memory_mb(df):
+    '''
+    Returns the memory used by the dataframe in megabytes, including the
+    memory of the strings it holds.
+    '''
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def _read_csv(dataset, path, columns=None):
+    '''
+    Helper method to parse a dataset's CSV file with its schema types,
+    keeping only the given columns (all columns if None).
+    '''
+    if dataset.get('scorecard'):
+        if columns is None:
+            columns = pd.read_csv(path, nrows=0).columns
+        return read_scorecard(path, columns)
+    usecols = None if columns is None else (lambda col: col in columns)
+    return pd.read_csv(path, dtype=_schema_dtypes(dataset, path), usecols=usecols)
+
+
+def _schema_key(dataset):
+    '''
+    Helper method that returns a digest of the dataset's schema, so cached
+    files are converted again when the schema changes.
+    '''
+    schema = json.dumps([dataset['schema'], dataset.get('scorecard', False),
+                         SUPPRESSED], sort_keys=True)
+    return hashlib.sha256(schema.encode()).hexdigest()
+
+
+def _parquet_columns(cache_path):
+    '''
+    Helper method for read_dataset. Returns the column names stored in the
+    Parquet file without reading any data.
+    '''
+    import pyarrow.parquet as pq
+    return pq.read_schema(cache_path).names
+
+
+def _schema_dtypes(dataset, path):
+    '''
+    Helper method to only pass on the schema types of columns that exist
+    in the CSV file.
+    '''
+    header = pd.read_csv(path, nrows=0).columns
+    return {col: dtype for col, dtype in dataset['schema'].items()
+            if col in header}
+
+
+def _write_meta(meta_path, source):
+    '''
+    Helper method to record which version of the CSV file was converted.
+    '''
+    with open(meta_path, 'w') as f:
+        json.dump(source, f)
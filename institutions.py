@@ -0,0 +1,181 @@
+import difflib
+import pandas as pd
+'''
+Matches the institution names of the racial rep dataset to the institution
+names of the College Scorecard. Every distinct name gets a compact integer
+key, so the datasets can be joined on the keys instead of on the raw name
+strings. Names are matched after normalizing case, punctuation and common
+abbreviations, then through an optional UNITID crosswalk, and finally (if
+asked for) with a fuzzy match among the names in the same state sharing
+their rarest word. Fuzzy matches are returned so they can be checked.
+'''
+
+# abbreviations replaced by the full word when normalizing names
+ABBREVIATIONS = {
+    'univ': 'university',
+    'coll': 'college',
+    'inst': 'institute',
+    'tech': 'technology',
+    'cmty': 'community',
+}
+# similarity needed for a fuzzy match ('saint johns university' and
+# 'saint josephs university' are 0.91 similar)
+FUZZY_CUTOFF = 0.95
+# FIPS codes of the state names used by the racial rep dataset
+STATE_FIPS = {
+    'Alabama': 1, 'Alaska': 2, 'Arizona': 4, 'Arkansas': 5, 'California': 6,
+    'Colorado': 8, 'Connecticut': 9, 'Delaware': 10, 'District of Columbia': 11,
+    'Florida': 12, 'Georgia': 13, 'Hawaii': 15, 'Idaho': 16, 'Illinois': 17,
+    'Indiana': 18, 'Iowa': 19, 'Kansas': 20, 'Kentucky': 21, 'Louisiana': 22,
+    'Maine': 23, 'Maryland': 24, 'Massachusetts': 25, 'Michigan': 26,
+    'Minnesota': 27, 'Mississippi': 28, 'Missouri': 29, 'Montana': 30,
+    'Nebraska': 31, 'Nevada': 32, 'New Hampshire': 33, 'New Jersey': 34,
+    'New Mexico': 35, 'New York': 36, 'North Carolina': 37, 'North Dakota': 38,
+    'Ohio': 39, 'Oklahoma': 40, 'Oregon': 41, 'Pennsylvania': 42,
+    'Rhode Island': 44, 'South Carolina': 45, 'South Dakota': 46, 'Tennessee': 47,
+    'Texas': 48, 'Utah': 49, 'Vermont': 50, 'Virginia': 51, 'Washington': 53,
+    'West Virginia': 54, 'Wisconsin': 55, 'Wyoming': 56, 'Puerto Rico': 72,
+}
+
+
+def normalize_names(names):
+    '''
+    Takes in a series of institution names and returns them in lower case,
+    with '&' spelled out, punctuation removed, abbreviations expanded and
+    whitespace collapsed.
+    '''
+    normalized = names.astype(str).str.lower()
+    normalized = normalized.str.replace('&', ' and ', regex=False)
+    normalized = normalized.str.replace(r'[^\w\s]', ' ', regex=True)
+    normalized = normalized.str.replace(r'\s+', ' ', regex=True).str.strip()
+    for short, full in ABBREVIATIONS.items():
+        normalized = normalized.str.replace(r'\b' + short + r'\b', full, regex=True)
+    return normalized.str.replace(r'^the ', '', regex=True)
+
+
+def build_index(race_names, scorecard_names, crosswalk=None, scorecard_ids=None,
+                fuzzy_cutoff=None, race_states=None, scorecard_states=None):
+    '''
+    Returns the institution key index as a dictionary with a 'race' and a
+    'scorecard' series mapping every distinct name of that dataset to an
+    integer key. Names of the two datasets that refer to the same institution
+    share a key. The optional crosswalk maps racial rep names to UNITIDs and
+    is used with scorecard_ids (the UNITID of each scorecard name, in the
+    same order). If a fuzzy_cutoff is given (FUZZY_CUTOFF is a safe choice),
+    racial rep names still unmatched are fuzzy matched to a scorecard name
+    in the same state with at least that similarity, which needs the state
+    of every name: race_states (state names, like fips_ipeds) and
+    scorecard_states (FIPS codes, like ST_FIPS). The dictionary's 'fuzzy'
+    dataframe lists the fuzzy matches with their similarity.
+    '''
+    if fuzzy_cutoff is not None and (race_states is None or scorecard_states is None):
+        raise ValueError('fuzzy matching needs race_states and scorecard_states')
+    race_input = pd.DataFrame({'name': list(race_names)})
+    race_input['state'] = _state_codes(race_states, len(race_input))
+    race_input = race_input.dropna(subset=['name']).drop_duplicates('name')
+    race_names = race_input['name'].reset_index(drop=True)
+    scorecard = pd.DataFrame({'name': list(scorecard_names)})
+    scorecard['state'] = _state_codes(scorecard_states, len(scorecard))
+    if scorecard_ids is not None:
+        scorecard['id'] = list(scorecard_ids)
+    scorecard = scorecard.dropna(subset=['name'])
+    # every state a scorecard name appears in, for the fuzzy match
+    scorecard_in_states = scorecard[['name', 'state']].drop_duplicates()
+    scorecard = scorecard.drop_duplicates('name')
+
+    # every normalized scorecard name gets a key
+    scorecard['normalized'] = normalize_names(scorecard['name']).to_numpy()
+    scorecard['key'] = pd.factorize(scorecard['normalized'])[0]
+    by_normalized = scorecard.drop_duplicates('normalized').set_index('normalized')['key']
+
+    race = pd.DataFrame({'name': race_names,
+                         'normalized': normalize_names(race_names).to_numpy(),
+                         'state': race_input['state'].to_numpy()})
+    race['key'] = race['normalized'].map(by_normalized).astype('float64')
+    if crosswalk is not None and scorecard_ids is not None:
+        by_id = scorecard.drop_duplicates('id').set_index('id')['key']
+        missing = race['key'].isna()
+        race.loc[missing, 'key'] = race.loc[missing, 'name'].map(crosswalk).map(by_id)
+    fuzzy = pd.DataFrame(columns=['name', 'state', 'scorecard_name', 'similarity'])
+    if fuzzy_cutoff is not None:
+        missing = race['key'].isna()
+        scorecard_in_states['normalized'] = normalize_names(scorecard_in_states['name'])
+        fuzzy = _fuzzy_matches(race[missing], scorecard_in_states, fuzzy_cutoff)
+        race.loc[missing, 'key'] = race.loc[missing, 'name'].map(
+            fuzzy.set_index('name')['scorecard_name'].map(
+                scorecard.set_index('name')['key']))
+
+    # unmatched racial rep names get new keys of their own
+    missing = race['key'].isna()
+    start = scorecard['key'].max() + 1 if len(scorecard) else 0
+    race.loc[missing, 'key'] = start + pd.factorize(race.loc[missing, 'normalized'])[0]
+    return {
+        'race': race.set_index('name')['key'].astype('int64'),
+        'scorecard': scorecard.set_index('name')['key'].astype('int64'),
+        'fuzzy': fuzzy,
+    }
+
+
+def merge_on_keys(df_race, df_recent, index, race_on='inst_name', recent_on='INSTNM',
+                  how='left'):
+    '''
+    Merges the racial rep and Scorecard datasets on the integer keys of the
+    institution index instead of on the name strings.
+    '''
+    # names missing from the index get keys that match nothing
+    race_keys = _keys(df_race[race_on], index['race'], -1)
+    recent_keys = _keys(df_recent[recent_on], index['scorecard'], -2)
+    merged = df_race.assign(_institution_key=race_keys).merge(
+        df_recent.assign(_institution_key=recent_keys), on='_institution_key', how=how)
+    return merged.drop(columns='_institution_key')
+
+
+def _keys(names, keys, missing):
+    '''
+    Helper method for merge_on_keys. Looks up the integer key of every name,
+    using the missing key for names that are not in the index.
+    '''
+    # looks up plain strings, since the names can be categoricals
+    return names.astype(object).map(keys).fillna(missing).astype('int64')
+
+
+def _state_codes(states, length):
+    '''
+    Helper method for build_index. Returns the FIPS code of every state (state
+    names are looked up in STATE_FIPS), or missing codes if states is None.
+    '''
+    if states is None:
+        return [float('nan')] * length
+    states = pd.Series(list(states), dtype=object)
+    names = states.astype(str).str.strip(' \'"')
+    codes = pd.to_numeric(states, errors='coerce')
+    return codes.fillna(names.map(STATE_FIPS)).astype('float64').to_numpy()
+
+
+def _fuzzy_matches(race, scorecard, cutoff):
+    '''
+    Helper method for build_index. Takes in the unmatched racial rep names
+    and the scorecard names (both with their normalized name and state code)
+    and returns a dataframe of the racial rep names whose closest scorecard
+    name in the same state is at least cutoff similar. Only the scorecard
+    names of the state containing the name's rarest word are compared, so a
+    name is not compared with every institution.
+    '''
+    blocks = {}
+    names = {}
+    for name, normalized, state in scorecard[['name', 'normalized', 'state']].itertuples(
+            index=False):
+        names.setdefault((state, normalized), name)
+        for word in set(normalized.split(' ')):
+            blocks.setdefault((state, word), []).append(normalized)
+    matches = []
+    for name, normalized, state in race[['name', 'normalized', 'state']].itertuples(
+            index=False):
+        candidates = [blocks[(state, word)] for word in normalized.split(' ')
+                      if (state, word) in blocks]
+        block = min(candidates, key=len) if candidates else []
+        match = difflib.get_close_matches(normalized, block, n=1, cutoff=cutoff)
+        if match:
+            similarity = difflib.SequenceMatcher(None, normalized, match[0]).ratio()
+            matches.append((name, state, names[(state, match[0])], similarity))
+    return pd.DataFrame(matches, columns=['name', 'state', 'scorecard_name', 'similarity'])
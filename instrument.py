@@ -0,0 +1,290 @@
+import atexit
+import cProfile
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+'''
+Records the wall time, CPU time, memory growth and peak memory and row counts
+of every stage of main and every public function of the analysis modules, and
+writes them as a JSON run report when the program exits. Nothing is recorded (and the
+modules are not wrapped) unless enable is called, so the overhead is
+negligible when it is off. cProfile and tracemalloc can also be turned on
+for chosen stages or functions.
+'''
+
+ENABLED = False
+REPORT_PATH = 'run_report.json'
+# seconds between samples of the resident memory while measured calls are open
+SAMPLE_SECONDS = 0.005
+
+_records = []
+_profiled = set()
+_report_path = REPORT_PATH
+_exit_registered = False
+# profiled calls that overlap (nested or on other threads) share one
+# tracemalloc trace, which is stopped when the last of them ends
+_tracing = {'count': 0}
+_tracing_lock = threading.Lock()
+# the profiler running on each thread, since a thread can only run one
+_active = threading.local()
+# peak resident memory of every open measured call (by record id), updated
+# by one sampling thread that runs while any call is open
+_open_peaks = {}
+_sampling = {'thread': None}
+_sampling_lock = threading.Lock()
+
+
+def enable(report_path=REPORT_PATH, profile=()):
+    '''
+    Starts recording. The report is written to report_path at exit, and the
+    stages or functions named in profile (for example 'race_maps' or
+    'race.state_race_averages') are also run under cProfile and tracemalloc.
+    '''
+    global ENABLED, _report_path, _exit_registered
+    ENABLED = True
+    _report_path = report_path
+    _profiled.update(profile)
+    if not _exit_registered:
+        atexit.register(write_report)
+        _exit_registered = True
+
+
+def disable():
+    '''
+    Stops recording and forgets the records so far.
+    '''
+    global ENABLED
+    ENABLED = False
+    _records.clear()
+    _profiled.clear()
+
+
+def instrument_module(module):
+    '''
+    Replaces every public function defined in the module with a wrapper that
+    records each call, so calls between functions of the module are also
+    recorded.
+    '''
+    for name, func in list(vars(module).items()):
+        if not name.startswith('_') and inspect.isfunction(func) and \
+                func.__module__ == module.__name__ and \
+                not hasattr(func, '__wrapped__'):
+            setattr(module, name, wrap_function(func))
+
+
+def wrap_function(func):
+    '''
+    Returns a wrapper of the function that records its calls while recording
+    is enabled and otherwise just calls it.
+    '''
+    name = func.__module__ + '.' + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        with measure(name, 'function', rows_in=row_count(args[0]) if args else None) as record:
+            result = func(*args, **kwargs)
+            record['rows_out'] = row_count(result)
+        return result
+    return wrapper
+
+
+@contextmanager
+def measure(name, kind='stage', rows_in=None):
+    '''
+    Context manager that records the time and memory of the code inside it.
+    It yields the record dictionary, so row counts or a status can be added.
+    The memory is the change in resident memory of the process and its peak
+    while the code ran (sampled every SAMPLE_SECONDS), which also count other
+    threads running at the same time.
+    '''
+    record = {'name': name, 'kind': kind, 'rows_in': rows_in}
+    if not ENABLED:
+        yield record
+        return
+    profiled = name in _profiled
+    profiler = None
+    if profiled:
+        _start_tracing()
+        if getattr(_active, 'profiler', None) is None:
+            # a call inside a profiled call is already part of its profile
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                _active.profiler = profiler
+            except ValueError:
+                # another thread is profiling (Python 3.12 allows only one profiler)
+                profiler = None
+    rss = _rss_mb()
+    if rss is not None:
+        _start_sampling(id(record), rss)
+    wall = time.perf_counter()
+    # CPU time of this thread, since stages can run on several threads
+    cpu = time.thread_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall
+        record['cpu_seconds'] = time.thread_time() - cpu
+        record['rss_delta_mb'] = record['peak_rss_mb'] = None
+        if rss is not None:
+            end_rss = _rss_mb()
+            record['rss_delta_mb'] = end_rss - rss
+            record['peak_rss_mb'] = _stop_sampling(id(record), end_rss)
+        if profiler is not None:
+            profiler.disable()
+            _active.profiler = None
+        if profiled:
+            record.update(_profile_summary(name, profiler))
+            _stop_tracing()
+        _records.append(record)
+
+
+def write_report(path=None):
+    '''
+    Writes the records so far as a JSON run report and returns its path.
+    '''
+    path = path or _report_path
+    if not ENABLED and not _records:
+        return None
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'argv': sys.argv,
+        'peak_rss_mb': _peak_rss_mb(),
+        'records': _records,
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+    return path
+
+
+def row_count(value):
+    '''
+    Returns the number of rows of a dataframe, series or
+    array, and None for anything else.
+    '''
+    if hasattr(value, 'shape') and len(getattr(value, 'shape', ())) > 0:
+        return int(value.shape[0])
+    return None
+
+
+def _rss_mb():
+    '''
+    Helper method that returns the current resident memory of the process
+    in MB, or None where it can not be read without psutil (only Linux has
+    /proc/self/statm).
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def _start_sampling(key, rss):
+    '''
+    Helper method for measure. Starts following the peak memory of an open
+    call, starting the sampling thread if it is not running.
+    '''
+    with _sampling_lock:
+        _open_peaks[key] = rss
+        if _sampling['thread'] is None:
+            _sampling['thread'] = threading.Thread(target=_sample, daemon=True,
+                                                   name='instrument-rss')
+            _sampling['thread'].start()
+
+
+def _stop_sampling(key, rss):
+    '''
+    Helper method for measure. Stops following a call and returns its peak
+    memory in MB.
+    '''
+    with _sampling_lock:
+        return max(_open_peaks.pop(key), rss)
+
+
+def _sample():
+    '''
+    Helper method for _start_sampling that runs in the sampling thread. Raises
+    the peak of every open call to the current memory until no call is open.
+    '''
+    while True:
+        time.sleep(SAMPLE_SECONDS)
+        rss = _rss_mb()
+        with _sampling_lock:
+            if not _open_peaks:
+                _sampling['thread'] = None
+                return
+            for key in _open_peaks:
+                _open_peaks[key] = max(_open_peaks[key], rss)
+
+
+def _start_tracing():
+    '''
+    Helper method for measure. Starts tracemalloc for the first profiled call.
+    '''
+    with _tracing_lock:
+        if _tracing['count'] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing['count'] += 1
+
+
+def _stop_tracing():
+    '''
+    Helper method for measure. Stops tracemalloc when the last profiled call ends.
+    '''
+    with _tracing_lock:
+        _tracing['count'] -= 1
+        if _tracing['count'] == 0:
+            tracemalloc.stop()
+
+
+def _peak_rss_mb():
+    '''
+    Helper method that returns the peak resident memory of the process in MB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _profile_summary(name, profiler):
+    '''
+    Helper method for measure. Returns the top allocation sites found by
+    tracemalloc and the peak traced memory since tracing started (shared by
+    profiled calls that overlap). If the call had its own profiler, also
+    saves the cProfile stats next to the report and returns the top
+    functions by cumulative time.
+    '''
+    snapshot = tracemalloc.take_snapshot()
+    summary = {
+        'traced_peak_mb': tracemalloc.get_traced_memory()[1] / 2 ** 20,
+        'allocations_top': [str(stat) for stat in
+                            snapshot.statistics('lineno')[:10]],
+    }
+    if profiler is None:
+        return summary
+    profile_path = os.path.splitext(_report_path)[0] + '_' + \
+        name.replace('.', '_') + '.prof'
+    if os.path.dirname(profile_path):
+        os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+    profiler.dump_stats(profile_path)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(20)
+    summary['profile_path'] = profile_path
+    summary['profile_top'] = output.getvalue().splitlines()
+    return summary
@@ -1,4 +1,10 @@
-from sklearn.model_selection import train_test_split
+import time
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone, is_classifier
+from sklearn.kernel_approximation import Nystroem
+from sklearn.linear_model import Ridge
+from sklearn.model_selection import KFold, StratifiedKFold, train_test_split
 from sklearn.metrics import accuracy_score
 from sklearn.metrics import mean_squared_error
 from sklearn.tree import DecisionTreeRegressor
@@ -7,92 +13,99 @@ from sklearn.ensemble import RandomForestRegressor
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+import model_store
 '''
 This file contains all the code for the machine learning
 question in the project. Used ChatGPT to figure out the paramaters
 for the different ML models and as a template for how to write them.
 '''
 
+# number of folds used by the cross validation mode
+FOLDS = 5
+# which SVMs predict the SAT average: the exact SVR, the kernel
+# approximation or both
+SVM_MODES = ['exact', 'approximate', 'both']
+# number of sample rows the approximate SVM builds its kernel from
+KERNEL_COMPONENTS = 300
+
 
 def race_selectivity_data_prep(df_race):
     '''
     Preps and splits up the data for the classifier machine learning
     the input,output, training, and testing data.
     '''
+    df_X, df_Y = race_selectivity_features(df_race)
+    X_train, X_test, y_train, y_test = train_test_split(df_X,
+                                                        df_Y,
+                                                        test_size=0.33,
+                                                        random_state=50)
+    return X_train, X_test, y_train, y_test
+
+
+def race_selectivity_features(df_race):
+    '''
+    Returns the input (racial percentages) and output (selectivity) data
+    for the classifiers without splitting it.
+    '''
     df_Y = df_race.loc[:, ['selective', 'non_selective', 'more_selective']]
     # reverese one-hot encodes the three columns to get one string per institution
     df_Y = df_Y.idxmax(axis=1)
     df_X = df_race.loc[:, [
         'col_white', 'col_black', 'col_asian', 'col_hispa', 'col_pacis',
         'col_amind', 'col_twora']]
-    X_train, X_test, y_train, y_test = train_test_split(df_X,
-                                                        df_Y,
-                                                        test_size=0.33,
-                                                        random_state=50)
-    return X_train, X_test, y_train, y_test
+    return df_X, df_Y
 
 
-def run_race_selectivity_ml_models(X_train, X_test, y_train, y_test):
+def run_race_selectivity_ml_models(X_train, X_test, y_train, y_test, n_jobs=-1,
+                                   save=False):
     '''
-    Prints out the training and testing accuracies for all three types of ML models used.
+    Fits all three types of ML models used once and returns a table of their
+    testing and training accuracies (see evaluate_models). The fitted models
+    are saved in the model store as 'race_selectivity <model>' if save is True.
     '''
-    print(
-        'Predicting Selectivity of College From Racial Make-Up of School Enrollment'
-    )
-    print('Decision Tree Model Test Accuracy:',
-          race_selectivity_decision_tree(X_train, X_test, y_train, y_test)[0])
-    print('Decision Tree Model Train Accuracy:',
-          race_selectivity_decision_tree(X_train, X_test, y_train, y_test)[1])
-    print('Random Forest Test Accuracy:',
-          race_selectivity_random_forest(X_train, X_test, y_train, y_test)[0])
-    print('Random Forest Train Accuracy:',
-          race_selectivity_random_forest(X_train, X_test, y_train, y_test)[1])
-    print('K-Nearest Neighbors Test Accuracy:',
-          race_selectivity_knn(X_train, X_test, y_train, y_test)[0])
-    print('K-Nearest Neighbors Train Accuracy:',
-          race_selectivity_knn(X_train, X_test, y_train, y_test)[1])
+    return evaluate_models(race_selectivity_models(), X_train, X_test,
+                           y_train, y_test, accuracy_score, n_jobs,
+                           'race_selectivity' if save else None)
+
+
+def race_selectivity_models():
+    '''
+    Returns the unfitted classifiers used to predict selectivity, by name.
+    '''
+    return {
+        'Decision Tree': DecisionTreeClassifier(),
+        'Random Forest': RandomForestClassifier(n_estimators=200, random_state=70),
+        'K-Nearest Neighbors': KNeighborsClassifier(n_neighbors=10),
+    }
 
 
 def race_selectivity_decision_tree(X_train, X_test, y_train, y_test):
     '''
     Decision Tree Classifier - returns training/testing accuracy
     '''
-    dt_model = DecisionTreeClassifier()
-    dt_model.fit(X_train, y_train)
-    y_predict = dt_model.predict(X_test)
-    y_predict_train = dt_model.predict(X_train)
-    return [
-        accuracy_score(y_test, y_predict),
-        accuracy_score(y_train, y_predict_train)
-    ]
+    scores = fit_and_score(race_selectivity_models()['Decision Tree'],
+                           X_train, X_test, y_train, y_test, accuracy_score)
+    return [scores['test_score'], scores['train_score']]
 
 
 def race_selectivity_random_forest(X_train, X_test, y_train, y_test):
     '''
     Random Forest Classifier - returns training/testing accuracy
     '''
-    rf_model = RandomForestClassifier(n_estimators=200, random_state=70)
-    rf_model.fit(X_train, y_train)
-    y_predict = rf_model.predict(X_test)
-    y_predict_train = rf_model.predict(X_train)
-    return [
-        accuracy_score(y_test, y_predict),
-        accuracy_score(y_train, y_predict_train)
-    ]
+    scores = fit_and_score(race_selectivity_models()['Random Forest'],
+                           X_train, X_test, y_train, y_test, accuracy_score)
+    return [scores['test_score'], scores['train_score']]
 
 
 def race_selectivity_knn(X_train, X_test, y_train, y_test):
     '''
     KNN Classifer - returns training/testing accuracy
     '''
-    knn_model = KNeighborsClassifier(n_neighbors=10)
-    knn_model.fit(X_train, y_train)
-    y_predict = knn_model.predict(X_test)
-    y_predict_train = knn_model.predict(X_train)
-    return [
-        accuracy_score(y_test, y_predict),
-        accuracy_score(y_train, y_predict_train)
-    ]
+    scores = fit_and_score(race_selectivity_models()['K-Nearest Neighbors'],
+                           X_train, X_test, y_train, y_test, accuracy_score)
+    return [scores['test_score'], scores['train_score']]
 
 
 def socio_and_SAT_data_prep(df_merged):
@@ -100,78 +113,225 @@ def socio_and_SAT_data_prep(df_merged):
     Preps and splits up the data for the regression machine learning
     data for input,output, training, and testing data.
     '''
+    df_X, df_Y = socio_and_SAT_features(df_merged)
+    X_train, X_test, y_train, y_test = train_test_split(df_X, df_Y, test_size=0.33,
+                                                        random_state=50)
+    return X_train, X_test, y_train, y_test
+
+
+def socio_and_SAT_features(df_merged):
+    '''
+    Returns the input (socio-economic) and output (SAT average) data for
+    the regression models without splitting it.
+    '''
     # filters the needed input columns
     df_filtered = df_merged[[
         'FAMINC', 'MD_FAMINC', 'FIRST_GEN', 'SAT_AVG', 'UGDS_WHITE',
         'UGDS_BLACK', 'UGDS_HISP', 'UGDS_ASIAN', 'UGDS_AIAN', 'UGDS_NHPI'
     ]]
     
-    # the following code was needed for the pre-filtered recent cohorts file
-    df_filtered = df_filtered.dropna()
-    for col in df_filtered.columns:
-        df_filtered = df_filtered[~(df_filtered[col] == 'PrivacySuppressed')]
+    # Scorecard columns read through ingest are already numeric; any remaining
+    # 'PrivacySuppressed' markers become missing values and are dropped
+    df_filtered = df_filtered.apply(pd.to_numeric, errors='coerce').dropna()
     df_Y = df_filtered['SAT_AVG']
     # takes output column from input dataframe
     df_X = df_filtered.drop(columns=['SAT_AVG'])
-    
-    X_train, X_test, y_train, y_test = train_test_split(df_X, df_Y, test_size=0.33,
-                                                        random_state=50)
-    return X_train, X_test, y_train, y_test
+    return df_X, df_Y
+
+
+def run_socio_and_SAT_data_ml_models(X_train, X_test, y_train, y_test, n_jobs=-1,
+                                     save=False, svm='both'):
+    '''
+    Fits all the regression models once and returns a table of their
+    testing and training errors (see evaluate_models). The fitted models
+    are saved in the model store as 'socio_SAT <model>' if save is True.
+    svm picks the SVMs that are fit (see socio_SAT_models).
+    '''
+    return evaluate_models(socio_SAT_models(svm), X_train, X_test,
+                           y_train, y_test, root_mean_squared_error, n_jobs,
+                           'socio_SAT' if save else None)
+
+
+def socio_SAT_models(svm='both'):
+    '''
+    Returns the unfitted regression models used to predict the SAT average, by
+    name. svm is 'exact' for the SVR, 'approximate' for the approximate SVM
+    (which fits in about linear time in the number of rows, while the SVR
+    gets slow on many rows) or 'both'.
+    '''
+    if svm not in SVM_MODES:
+        raise ValueError('svm must be one of ' + ', '.join(SVM_MODES))
+    models = {
+        'Decision Tree': DecisionTreeRegressor(),
+        'Random Forest': RandomForestRegressor(n_estimators=100, random_state=50),
+    }
+    if svm in ['exact', 'both']:
+        models['SVM'] = SVR()
+    if svm in ['approximate', 'both']:
+        models['Approximate SVM'] = approximate_svm()
+    return models
 
 
-def run_socio_and_SAT_data_ml_models(X_train, X_test, y_train, y_test):
+def approximate_svm():
     '''
-    Prints out the training and testing accuracies for all three types of ML models used.
+    Returns an unfitted kernel regression model like the SVR (with an RBF
+    kernel) that scales to many rows: the features are standardized, mapped
+    to a Nystroem approximation of the kernel (built from KERNEL_COMPONENTS
+    sample rows) and fit with a linear ridge regression.
     '''
-    print('Predicting Average SAT Score of College From Socio-economic Make-Up of School ')
-    print('Decision Tree Model Test Error:',
-          socio_SAT_decision_tree(X_train, X_test, y_train, y_test)[0])
-    print('Decision Tree Model Train Error:',
-          socio_SAT_decision_tree(X_train, X_test, y_train, y_test)[1])
-    print('Random Forest Test Error:',
-          socio_SAT_random_forest(X_train, X_test, y_train, y_test)[0])
-    print('Random Forest Train Error:',
-          socio_SAT_random_forest(X_train, X_test, y_train, y_test)[1])
-    print('SVM Test Error:',
-          socio_SAT_svm(X_train, X_test, y_train, y_test)[0])
-    print('SVM Neighbors Train Error:',
-          socio_SAT_svm(X_train, X_test, y_train, y_test)[1])
+    return make_pipeline(StandardScaler(),
+                         Nystroem(kernel='rbf', n_components=KERNEL_COMPONENTS,
+                                  random_state=50),
+                         Ridge(alpha=1.0))
 
 
 def socio_SAT_decision_tree(X_train, X_test, y_train, y_test):
     '''
     Returns the error for the Decision Tree Regression model.
     '''
-    dt = DecisionTreeRegressor()
-    dt.fit(X_train, y_train)
-    y_predict = dt.predict(X_test)
-    y_predict_train = dt.predict(X_train)
-    score1 = mean_squared_error(y_test, y_predict, squared=False)
-    score2 = mean_squared_error(y_train, y_predict_train, squared=False)
-    return [score1, score2]
+    scores = fit_and_score(socio_SAT_models()['Decision Tree'], X_train, X_test,
+                           y_train, y_test, root_mean_squared_error)
+    return [scores['test_score'], scores['train_score']]
 
 
 def socio_SAT_random_forest(X_train, X_test, y_train, y_test):
     '''
     Returns the error for the Random Forest Regression model.
     '''
-    rf_model = RandomForestRegressor(n_estimators=100, random_state=50)
-    rf_model.fit(X_train, y_train)
-    y_predict = rf_model.predict(X_test)
-    y_predict_train = rf_model.predict(X_train)
-    score1 = mean_squared_error(y_test, y_predict, squared=False)
-    score2 = mean_squared_error(y_train, y_predict_train, squared=False)
-    return [score1, score2]
+    scores = fit_and_score(socio_SAT_models()['Random Forest'], X_train, X_test,
+                           y_train, y_test, root_mean_squared_error)
+    return [scores['test_score'], scores['train_score']]
 
 
 def socio_SAT_svm(X_train, X_test, y_train, y_test):
     '''
     Returns the error for the Support Vector Machine model.
     '''
-    svm_model = SVR()
-    svm_model.fit(X_train, y_train)
-    y_predict = svm_model.predict(X_test)
-    y_predict_train = svm_model.predict(X_train)
-    score1 = mean_squared_error(y_test, y_predict, squared=False)
-    score2 = mean_squared_error(y_train, y_predict_train, squared=False)
-    return [score1, score2]
+    scores = fit_and_score(socio_SAT_models()['SVM'], X_train, X_test,
+                           y_train, y_test, root_mean_squared_error)
+    return [scores['test_score'], scores['train_score']]
+
+
+def socio_SAT_approximate_svm(X_train, X_test, y_train, y_test):
+    '''
+    Returns the error for the approximate Support Vector Machine model.
+    '''
+    scores = fit_and_score(approximate_svm(), X_train, X_test,
+                           y_train, y_test, root_mean_squared_error)
+    return [scores['test_score'], scores['train_score']]
+
+
+def root_mean_squared_error(y_true, y_predict):
+    '''
+    Returns the root mean squared error of the predictions.
+    '''
+    return mean_squared_error(y_true, y_predict, squared=False)
+
+
+def evaluate_models(models, X_train, X_test, y_train, y_test, metric, n_jobs=-1,
+                    save_as=None):
+    '''
+    Takes in a dictionary of unfitted models by name and fits every model
+    exactly once, running up to n_jobs models at the same time (-1 uses every
+    core). Returns a dataframe indexed by model name with the test_score and
+    train_score of the metric and the fit_time in seconds. If save_as is
+    given, every fitted model is saved in the model store as
+    save_as + ' ' + model name together with its scores.
+    '''
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_and_score)(model, X_train, X_test, y_train, y_test, metric)
+        for model in models.values())
+    table = pd.DataFrame(results, index=pd.Index(list(models), name='model'))
+    table = table[['test_score', 'train_score', 'fit_time']]
+    if save_as is not None:
+        for name, result in zip(models, results):
+            model_store.save_model(save_as + ' ' + name, result['model'],
+                                   X_train, y_train, table.loc[name].to_dict())
+    return table
+
+
+def fit_and_score(model, X_train, X_test, y_train, y_test, metric):
+    '''
+    Fits a copy of the model on the training data and returns a dictionary
+    with the fitted model, the metric on the testing and training data and
+    the time the fit took in seconds.
+    '''
+    model = clone(model)
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_time = time.perf_counter() - start
+    return {
+        'model': model,
+        'test_score': metric(y_test, model.predict(X_test)),
+        'train_score': metric(y_train, model.predict(X_train)),
+        'fit_time': fit_time,
+    }
+
+
+def run_race_selectivity_cv(df_race, folds=FOLDS, n_jobs=-1):
+    '''
+    Cross validates the three classifiers with folds folds and returns the
+    summary and per fold tables of their accuracies (see cross_validate_models).
+    '''
+    df_X, df_Y = race_selectivity_features(df_race)
+    return cross_validate_models(race_selectivity_models(), df_X, df_Y,
+                                 accuracy_score, folds, n_jobs)
+
+
+def run_socio_and_SAT_cv(df_merged, folds=FOLDS, n_jobs=-1, svm='both'):
+    '''
+    Cross validates the regression models with folds folds and returns the
+    summary and per fold tables of their errors (see cross_validate_models).
+    svm picks the SVMs that are scored (see socio_SAT_models).
+    '''
+    df_X, df_Y = socio_and_SAT_features(df_merged)
+    return cross_validate_models(socio_SAT_models(svm), df_X, df_Y,
+                                 root_mean_squared_error, folds, n_jobs)
+
+
+def cross_validate_models(models, X, y, metric, folds=FOLDS, n_jobs=-1,
+                          random_state=50):
+    '''
+    Takes in a dictionary of unfitted models by name and scores every model
+    with k-fold cross validation (stratified for classifiers). Every (model,
+    fold) pair is fit at the same time on up to n_jobs processes, which share
+    one memory mapped copy of the data instead of each getting their own.
+    Returns a summary dataframe indexed by model name with the mean and
+    standard deviation of the test and train scores and the mean fit time,
+    and a dataframe with the scores and fit time of every fold.
+    '''
+    X = X.to_numpy(dtype=float)
+    # labels are turned into integer codes, so they can be memory mapped too
+    y = pd.factorize(y)[0] if y.dtype == object else y.to_numpy()
+    jobs = []
+    for name, model in models.items():
+        splitter = (StratifiedKFold if is_classifier(model) else KFold)(
+            n_splits=folds, shuffle=True, random_state=random_state)
+        for fold, (train, test) in enumerate(splitter.split(X, y)):
+            jobs.append((name, fold, model, train, test))
+    results = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+        delayed(fit_and_score_fold)(model, X, y, train, test, metric)
+        for name, fold, model, train, test in jobs)
+    fold_table = pd.DataFrame(results)
+    fold_table.insert(0, 'model', [name for name, fold, model, train, test in jobs])
+    fold_table.insert(1, 'fold', [fold for name, fold, model, train, test in jobs])
+    grouped = fold_table.groupby('model', sort=False)
+    summary = pd.DataFrame({
+        'test_mean': grouped['test_score'].mean(),
+        'test_std': grouped['test_score'].std(),
+        'train_mean': grouped['train_score'].mean(),
+        'train_std': grouped['train_score'].std(),
+        'fit_time': grouped['fit_time'].mean(),
+    })
+    return summary, fold_table
+
+
+def fit_and_score_fold(model, X, y, train, test, metric):
+    '''
+    Fits a copy of the model on the training rows of one fold and returns a
+    dictionary with the metric on the test and training rows and the time
+    the fit took in seconds. X and y are the whole (shared) dataset.
+    '''
+    scores = fit_and_score(model, X[train], X[test], y[train], y[test], metric)
+    del scores['model']
+    return scores
@@ -2,52 +2,476 @@
 # The Final Project Replit ran out of storage
 # All of our code for this project is present here
 
-import pandas as pd
-import demographics
-import race
-import test
-import admissions
-import machine_learning
+import argparse
+import functools
+import glob
+import importlib
+import os
+import sys
+import geometry
+import ingest
+import instrument
+import pipeline
+# the analysis modules import geopandas, matplotlib, scipy and sklearn, so
+# they are only imported by the stages (and functions) that use them
 
+# year of the racial rep dataset used for the single year analyses
+YEAR = 2017
+# single year race plots that can also run for other years (see year_stages)
+YEAR_PLOTS = ['race_maps', 'race_top_bottom_5']
+# rendering.GRAPHS_DIR, without importing matplotlib
+GRAPHS_DIR = 'graphs'
+# graphs saved by each plot stage; a plot stage runs again if one is missing
+MAP_RACES = ['minority', 'white', 'black', 'asian', 'hispanic']
+GRAPHS = {
+    'race_maps': ['state_race_' + race + '.png' for race in MAP_RACES] +
+                 ['market_race_' + race + '.png' for race in MAP_RACES] +
+                 ['market_diff_' + race + '.png' for race in MAP_RACES[1:]],
+    'race_top_bottom_5': ['top_and_worst.png'],
+    'race_time_series': ['race_percent_over_time.png', 'race_count_over_time.png'],
+    'tuition_correlation': [race + '_enrollment_tuition.png'
+                            for race in ['Black', 'Asian', 'Hispanic', 'White']],
+    'gender': ['geospatial_gender.png', 'gender_barplot.png'],
+    'first_gen': ['first_gen_admission.png'],
+    'residency': ['residency_and_admissions.png'],
+    'admissions': ['admissions_rate.png'],
+}
+# number of stages run at the same time
+WORKERS = min(4, os.cpu_count() or 1)
+ML_STAGES = {
+    'ml_race_selectivity': 'Predicting Selectivity of College From Racial Make-Up of School Enrollment (accuracy)',
+    'ml_socio_sat': 'Predicting Average SAT Score of College From Socio-economic Make-Up of School (error)',
+}
 
-def main():
+
+# stages run by each --stages choice (with the stages they depend on)
+STAGE_GROUPS = {
+    'race': ['race_maps', 'race_top_bottom_5', 'race_time_series'],
+    'demographics': ['tuition_correlation', 'gender', 'first_gen', 'residency'],
+    'admissions': ['admissions'],
+    'ml': ['ml_race_selectivity', 'ml_socio_sat'],
+    'tests': ['tests'],
+}
+
+# modules whose public functions are recorded in the run report
+INSTRUMENTED_MODULES = ['race', 'demographics', 'admissions', 'machine_learning', 'ingest']
+
+
+def main(year=YEAR, targets=None, force=False, report_path=None, profile=(), folds=None,
+         workers=WORKERS, svm='both', years=()):
+    '''
+    Main method to call all other methods. Runs the stages of the project
+    (or only the target stages and what they need) and skips every stage
+    whose data, parameters and code did not change since it last ran.
+    If a report_path is given (or stages/functions to profile), the time and
+    memory of every stage and analysis function are written there at exit.
+    If folds is given, the machine learning models are cross validated with
+    that many folds instead of being scored on one split, and svm picks the
+    exact and/or approximate SVM for the SAT models. Up to workers
+    independent stages run at the same time, and the datasets are read in the
+    background from the start. The single year race plots also run for every
+    year in years ('all' for every year in the dataset), each saved in
+    graphs/<year>. Returns the pipeline report.
+    '''
+    if report_path is not None or profile:
+        instrument.enable(report_path or instrument.REPORT_PATH, profile)
+        for module in INSTRUMENTED_MODULES:
+            instrument.instrument_module(importlib.import_module(module))
+    if years == 'all':
+        years = ingest.race_years()
+    stages = build_stages(year, folds, svm, years)
+    if targets is not None and years:
+        # the plots of the asked for years run along with the targets
+        targets = targets + [plot + '_' + str(other) for other in years
+                             for plot in YEAR_PLOTS]
+    loads = prefetch(stages, targets, force)
+    report = pipeline.run_pipeline(stages, targets, force=force, workers=workers,
+                                   prefetched=loads)
+    for name, status, seconds in report:
+        print(name + ':', status, '(' + str(round(seconds, 2)) + 's)')
+    path, seconds = pipeline.critical_path(stages, report)
+    print('Critical path:', ' -> '.join(path), '(' + str(round(seconds, 2)) + 's)')
+
+    # prints the machine learning results, even if the models did not have to run again
+    for name, status, seconds in report:
+        if name in ML_STAGES and status in ['ran', 'skipped']:
+            print(ML_STAGES[name])
+            result = pipeline.load_result(name)
+            # cross validation also returns the scores of every fold
+            for table in result if isinstance(result, tuple) else [result]:
+                print(table)
+    return report
+
+
+def build_stages(year=YEAR, folds=None, svm='both', years=()):
+    '''
+    Returns the stage graph of the project: loading the datasets, merging them,
+    the tests, the race aggregates and plots, the demographic plots, the
+    admissions plot and the machine learning models (cross validated with
+    folds folds if given, with the svm choice of SVMs for the SAT models),
+    followed by the single year race plots of the other years.
+    '''
+    ipeds = ingest.DATASETS['ipeds']['path']
+    race_path = ingest.DATASETS['race']['path']
+    recent = ingest.DATASETS['recent']['path']
+    states = geometry.STATES_PATH
+    plots = ['rendering', 'geometry']
+    return [
+        # LOADING (the datasets are already cached by ingest, so these are not saved again)
+        pipeline.stage('load_ipeds', load_ipeds, sources=[ipeds], code=['ingest'],
+                       cache=False),
+        pipeline.stage('load_race_year', load_race_year, params={'year': year},
+                       sources=[race_path], code=['ingest'], cache=False),
+        # the cube keeps its own file of year and state sums, so it is not saved again
+        pipeline.stage('load_race_cube', 'cube:load_cube', sources=[race_path],
+                       code=['ingest', 'race'], cache=False),
+        pipeline.stage('load_recent', load_recent, sources=[recent], code=['ingest'],
+                       cache=False),
+        pipeline.stage('load_race_names', load_race_names, sources=[race_path],
+                       code=['ingest'], cache=False),
+        # matching the institution names is saved, so it only runs when a dataset changes
+        pipeline.stage('institution_index', build_institution_index,
+                       ['load_race_names', 'load_recent'], code=['institutions']),
+        pipeline.stage('merge', merge_race_recent,
+                       ['load_race_year', 'load_recent', 'institution_index'],
+                       code=['institutions'], cache=False),
+
+        # TESTS
+        # the tests change shared settings (like stopping the render pool), so they
+        # run alone; their graphs are saved in a folder of their own (see
+        # test.run_testing_methods), so they never replace the real graphs
+        pipeline.stage('tests', run_tests, ['merge', 'load_race_year'], exclusive=True,
+                       sources=sorted(glob.glob('test_data/*.csv')) + [states],
+                       code=['test', 'race', 'demographics', 'admissions', 'machine_learning',
+                             'ingest', 'institutions', 'geometry', 'rendering', 'regression',
+                             'cube']),
+
+        # RACE PLOTS
+        pipeline.stage('race_averages', 'cube:state_averages', ['load_race_cube'],
+                       params={'years': [year]}, code=['race']),
+        pipeline.stage('race_maps', plot_race_maps, ['race_averages'],
+                       sources=[states], code=['race'] + plots, outputs=graph_paths('race_maps')),
+        pipeline.stage('racial_index', racial_index, ['load_race_year'], code=['race']),
+        pipeline.stage('race_top_bottom_5', plot_top_bottom_5, ['racial_index'],
+                       code=['race'] + plots, outputs=graph_paths('race_top_bottom_5')),
+        pipeline.stage('race_time_series', plot_race_time_series, ['load_race_cube'],
+                       code=['race', 'cube'] + plots, outputs=graph_paths('race_time_series')),
+
+        # DEMOGRAPHIC PLOTS
+        pipeline.stage('tuition_correlation', plot_tuition_correlation, ['load_ipeds'],
+                       code=['demographics'] + plots, outputs=graph_paths('tuition_correlation')),
+        pipeline.stage('gender', plot_gender, ['load_ipeds'], sources=[states],
+                       code=['demographics'] + plots, outputs=graph_paths('gender')),
+        pipeline.stage('first_gen', plot_first_gen, ['load_recent'],
+                       code=['demographics', 'regression'] + plots,
+                       outputs=graph_paths('first_gen')),
+        pipeline.stage('residency', plot_residency, ['load_ipeds'],
+                       code=['demographics', 'regression'] + plots,
+                       outputs=graph_paths('residency')),
+
+        # ADMISSION PLOTS
+        pipeline.stage('admissions', plot_admissions, ['merge'], sources=[states],
+                       code=['admissions'] + plots, outputs=graph_paths('admissions')),
+
+        # MACHINE LEARNING MODELS
+        pipeline.stage('ml_race_selectivity', run_race_selectivity_models,
+                       ['load_race_year'], params={'folds': folds}, code=['machine_learning']),
+        pipeline.stage('ml_socio_sat', run_socio_SAT_models, ['merge'],
+                       params={'folds': folds, 'svm': svm}, code=['machine_learning']),
+    ] + year_stages(years, year)
+
+
+def year_stages(years, year=YEAR):
     '''
-    Main method to call all other methods
+    Returns the stages of the single year race plots (the maps and the top
+    and bottom 5) for every year in years, named <stage>_<year>. The state
+    averages come from the cube, and only the year's partition of the
+    racial rep dataset is loaded (the year of the main stages reuses
+    load_race_year). Their graphs are saved in graphs/<year>.
     '''
+    race_path = ingest.DATASETS['race']['path']
+    states = geometry.STATES_PATH
+    plots = ['rendering', 'geometry']
+    stages = []
+    for other in years:
+        suffix = '_' + str(other)
+        load = 'load_race_year'
+        if other != year:
+            load = 'load_race_year' + suffix
+            stages.append(pipeline.stage(load, load_race_year, params={'year': other},
+                                         sources=[race_path], code=['ingest'], cache=False))
+        stages += [
+            pipeline.stage('race_averages' + suffix, 'cube:state_averages', ['load_race_cube'],
+                           params={'years': [other]}, code=['race']),
+            pipeline.stage('race_maps' + suffix, plot_race_maps, ['race_averages' + suffix],
+                           params={'year': other}, sources=[states], code=['race'] + plots,
+                           outputs=graph_paths('race_maps', other)),
+            pipeline.stage('racial_index' + suffix, racial_index, [load], code=['race']),
+            pipeline.stage('race_top_bottom_5' + suffix, plot_top_bottom_5,
+                           ['racial_index' + suffix], params={'year': other},
+                           code=['race'] + plots,
+                           outputs=graph_paths('race_top_bottom_5', other)),
+        ]
+    return stages
 
-    # reads alls datasets into dataframes
-    df_ipeds = pd.read_csv("data/IPEDS_data.csv")
-    df_race = pd.read_csv('data/college_racial_rep.csv')
-    df_race_2017 = df_race[df_race['year'] == 2017]
-    df_recent = pd.read_csv('data/Most_recent_cohorts_institution_filtered.csv')
-    df_merged = df_race_2017.merge(df_recent, left_on='inst_name', right_on='INSTNM', how = 'left')
 
-    # runs all the test methods
-    test.run_testing_methods(df_merged, df_race_2017)
+def graph_paths(name, year=None):
+    '''
+    Returns the paths of the graphs the named plot stage saves (in
+    graphs/<year> if a year is given).
+    '''
+    folder = GRAPHS_DIR if year is None else os.path.join(GRAPHS_DIR, str(year))
+    return [os.path.join(folder, file_name) for file_name in GRAPHS[name]]
 
-    # RACE PLOTS
-    race.race_percent_geoplot(df_race_2017)
-    race.race_enrollment_diff(df_race_2017)
-    race.plot_market_share(df_race_2017)
-    df_racial_index = race.calculate_racial_diversity_index(df_race_2017)
-    race.race_top_bottom_5(df_racial_index)
-    race.race_percent_time_bar(df_race)
 
-    # DEMOGRAPHIC PLOTS
+def prefetch(stages, targets=None, force=False):
+    '''
+    Starts reading every dataset the run will need (and the state shapes if
+    a map will be drawn) in background threads, so each stage can start as
+    soon as its own dataset is read. Returns the futures of the load stages.
+    '''
+    by_name = {s['name']: s for s in stages}
+    pending = pipeline.pending_stages(stages, targets, force=force)
+    loaders = {name: functools.partial(pipeline.resolve(by_name[name]['func']),
+                                       **by_name[name]['params'])
+               for name in pending if name.startswith('load_')}
+    if any(geometry.STATES_PATH in by_name[name]['sources'] for name in pending):
+        # the shapes are kept by geometry, so the plots find them already read
+        loaders['states'] = geometry.load_states
+    return ingest.load_in_background(loaders)
+
+
+def load_ipeds():
+    '''
+    Reads the IPEDS dataset (only the columns in its schema) in compact form.
+    '''
+    return ingest.compact(ingest.read_dataset('ipeds'), report=True)
+
+
+def load_race_year(year):
+    '''
+    Only reads the partition of the racial rep dataset for the year, in compact form.
+    '''
+    return ingest.compact(ingest.read_race_year(year), report=True)
+
+
+def load_recent():
+    '''
+    Reads the most recent cohorts (College Scorecard) dataset in compact form.
+    '''
+    return ingest.compact(ingest.read_dataset('recent'), report=True)
+
+
+def load_race_names():
+    '''
+    Reads the institution names and states of every year of the racial rep dataset.
+    '''
+    return ingest.read_dataset('race', ['inst_name', 'fips_ipeds'])
+
+
+def build_institution_index(df_race_names, df_recent):
+    '''
+    Matches the institution names of all years of the racial rep dataset to
+    the most recent cohorts dataset, so every year is merged with the same index.
+    Names that only match with a typo are matched within their state, and
+    printed so they can be checked.
+    '''
+    import institutions
+    index = institutions.build_index(df_race_names['inst_name'], df_recent['INSTNM'],
+                                     fuzzy_cutoff=institutions.FUZZY_CUTOFF,
+                                     race_states=df_race_names['fips_ipeds'],
+                                     scorecard_states=df_recent['ST_FIPS'])
+    if len(index['fuzzy']) > 0:
+        print('Fuzzy matched', len(index['fuzzy']), 'institution names:')
+        print(index['fuzzy'].to_string(index=False))
+    return index
+
+
+def merge_race_recent(df_race_year, df_recent, index=None):
+    '''
+    Merges the racial rep dataset for the year with the most recent cohorts
+    dataset on the integer keys of the institution index.
+    '''
+    import institutions
+    if index is None:
+        index = institutions.build_index(df_race_year['inst_name'], df_recent['INSTNM'])
+    return institutions.merge_on_keys(df_race_year, df_recent, index)
+
+
+def run_tests(df_merged, df_race_year):
+    '''
+    Runs all the test methods.
+    '''
+    import test
+    test.run_testing_methods(df_merged, df_race_year)
+
+
+def plot_race_maps(averages, year=None):
+    '''
+    Plots the race percent, market difference and market share maps from
+    the state averages of every race metric (in graphs/<year> if a year
+    is given).
+    '''
+    import race
+    with year_graphs(year):
+        race.race_percent_geoplot(None, averages=averages)
+        race.race_enrollment_diff(None, averages=averages)
+        race.plot_market_share(None, averages=averages)
+
+
+def racial_index(df_race_year):
+    '''
+    Scores the racial diversity of every institution, keeping only the
+    columns the top and bottom 5 plot needs instead of a copy of the year.
+    '''
+    import race
+    return race.calculate_racial_diversity_index(df_race_year,
+                                                 columns=race.TOP_BOTTOM_COLUMNS)
+
+
+def plot_top_bottom_5(df_racial_index, year=None):
+    '''
+    Plots the top and bottom 5 universities in racial diversity (in
+    graphs/<year> if a year is given).
+    '''
+    import race
+    with year_graphs(year):
+        race.race_top_bottom_5(df_racial_index)
+
+
+def year_graphs(year=None):
+    '''
+    Returns a with block saving the graphs of the calling stage in the
+    year's folder of the graphs folder, or in the graphs folder itself
+    if there is no year.
+    '''
+    import rendering
+    path = rendering.get_output_dir()
+    if year is not None:
+        path = os.path.join(path, str(year))
+    return rendering.graphs_in(path)
+
+
+def plot_race_time_series(race_cube):
+    '''
+    Plots the racial percentages and enrollment over time from the yearly
+    averages of the cube.
+    '''
+    import cube
+    import race
+    race.race_percent_time_bar(None, averages=cube.year_averages(race_cube))
+
+
+def plot_tuition_correlation(df_ipeds):
+    '''
+    Plots the race enrollment versus tuition graphs.
+    '''
+    import demographics
     demographics.race_tuition_enrollment_correlation(df_ipeds)
+
+
+def plot_gender(df_ipeds):
+    '''
+    Plots the gender enrollment map and bar plot.
+    '''
+    import demographics
     demographics.filter_by_gender(df_ipeds)
+
+
+def plot_first_gen(df_recent):
+    '''
+    Plots first generation students versus admission rate.
+    '''
+    import demographics
     demographics.first_gen_selectivity(df_recent)
+
+
+def plot_residency(df_ipeds):
+    '''
+    Plots residency of students versus admission rate.
+    '''
+    import demographics
     demographics.in_state_out_state(df_ipeds)
 
-    # ADMISSION PLOTS
+
+def plot_admissions(df_merged):
+    '''
+    Plots the average admission rate per state.
+    '''
+    import admissions
     admissions.admission_rate(df_merged)
 
-    # MACHINE LEARNING MODELS
-    X1_train, X1_test, y1_train, y1_test = machine_learning.race_selectivity_data_prep(df_race_2017)
-    machine_learning.run_race_selectivity_ml_models(X1_train, X1_test, y1_train, y1_test)
-    X2_train, X2_test, y2_train, y2_test = machine_learning.socio_and_SAT_data_prep(df_merged)
-    machine_learning.run_socio_and_SAT_data_ml_models(X2_train, X2_test, y2_train, y2_test)
-     
+
+def run_race_selectivity_models(df_race_year, folds=None):
+    '''
+    Fits and saves the models predicting selectivity from racial make-up
+    and returns their results table. With folds, returns the cross validation
+    summary and fold tables instead.
+    '''
+    import machine_learning
+    if folds is not None:
+        return machine_learning.run_race_selectivity_cv(df_race_year, folds)
+    X_train, X_test, y_train, y_test = machine_learning.race_selectivity_data_prep(df_race_year)
+    return machine_learning.run_race_selectivity_ml_models(X_train, X_test, y_train, y_test,
+                                                           save=True)
+
+
+def run_socio_SAT_models(df_merged, folds=None, svm='both'):
+    '''
+    Fits and saves the models predicting the SAT average from the
+    socio-economic make-up and returns their results table (the errors and
+    fit times of the exact and/or approximate SVM are next to each other).
+    With folds, returns the cross validation summary and fold tables instead.
+    '''
+    import machine_learning
+    if folds is not None:
+        return machine_learning.run_socio_and_SAT_cv(df_merged, folds, svm=svm)
+    X_train, X_test, y_train, y_test = machine_learning.socio_and_SAT_data_prep(df_merged)
+    return machine_learning.run_socio_and_SAT_data_ml_models(X_train, X_test, y_train, y_test,
+                                                             save=True, svm=svm)
+
+
+def cli(args=None):
+    '''
+    Command line entry point. Runs every stage, or only the stages of the
+    --stages groups (and what they need).
+    '''
+    parser = argparse.ArgumentParser(description='Run the college analyses.')
+    parser.add_argument('--stages', nargs='+', metavar='STAGE',
+                        help='groups (' + ', '.join(STAGE_GROUPS) + ') or stage names to run')
+    parser.add_argument('--year', type=int, default=YEAR,
+                        help='year of the racial rep dataset to analyze')
+    parser.add_argument('--years', nargs='+', default=(), metavar='YEAR',
+                        help="also plot the race maps and top and bottom 5 for these years "
+                             "('all' for every year), each in graphs/<year>")
+    parser.add_argument('--force', action='store_true', help='run stages even if up to date')
+    parser.add_argument('--folds', type=int, help='cross validate the models with this many folds')
+    # machine_learning.SVM_MODES, without importing scikit-learn
+    parser.add_argument('--svm', choices=['exact', 'approximate', 'both'], default='both',
+                        help='SVMs used for the SAT models (approximate scales to many rows)')
+    parser.add_argument('--report', help='write the time and memory report to this file')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of stages to run at the same time')
+    parser.add_argument('--profile', nargs='+', default=(), metavar='NAME',
+                        help='stages or functions to profile in the report')
+    args = parser.parse_args(args)
+    years = args.years
+    if years == ['all']:
+        years = 'all'
+    else:
+        try:
+            years = [int(other) for other in years]
+        except ValueError:
+            parser.error("--years takes years or 'all'")
+    targets = None
+    if args.stages:
+        targets = [name for group in args.stages
+                   for name in STAGE_GROUPS.get(group, [group])]
+    report = main(args.year, targets, args.force, args.report, args.profile, args.folds,
+                  args.workers, args.svm, years)
+    if any(status == 'failed' for name, status, seconds in report):
+        sys.exit(1)
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    cli()
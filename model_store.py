@@ -0,0 +1,124 @@
+import argparse
+import hashlib
+import os
+import time
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+'''
+Saves fitted models with the information needed to reuse them later: the
+fingerprint of the training data, the order of the feature columns and the
+metrics from the evaluation. Saved models can score large files in chunks
+without being trained again.
+'''
+
+MODELS_DIR = 'models'
+
+
+def model_path(name, directory=MODELS_DIR):
+    '''
+    Returns the file path a model with the given name is saved under.
+    '''
+    file_name = name.lower().replace(' ', '_').replace('-', '_') + '.joblib'
+    return os.path.join(directory, file_name)
+
+
+def fingerprint(X, y=None):
+    '''
+    Returns a sha256 hex digest of the values of the training data, so it can
+    be checked which data a saved model was trained on.
+    '''
+    digest = hashlib.sha256()
+    digest.update(','.join(map(str, X.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(X, index=False).values.tobytes())
+    if y is not None:
+        digest.update(pd.util.hash_pandas_object(y, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def save_model(name, model, X_train, y_train=None, metrics=None,
+               directory=MODELS_DIR):
+    '''
+    Saves the fitted model with the fingerprint and feature columns of its
+    training data and a dictionary of its metrics. Returns the saved path.
+    '''
+    record = {
+        'name': name,
+        'model': model,
+        'features': list(X_train.columns),
+        'fingerprint': fingerprint(X_train, y_train),
+        'metrics': metrics or {},
+        'sklearn_version': sklearn.__version__,
+        'saved_at': time.time(),
+    }
+    os.makedirs(directory, exist_ok=True)
+    path = model_path(name, directory)
+    joblib.dump(record, path)
+    return path
+
+
+def load_model(name, directory=MODELS_DIR):
+    '''
+    Returns the dictionary saved by save_model for the model with the given name.
+    '''
+    return joblib.load(model_path(name, directory))
+
+
+def predict_chunk(record, chunk):
+    '''
+    Returns a series of predictions for the rows of the chunk, using the
+    feature columns in the order the model was trained with. Rows with a
+    missing feature get a missing prediction.
+    '''
+    features = chunk[record['features']]
+    complete = features.notna().all(axis=1)
+    if not complete.any():
+        return pd.Series(np.nan, index=chunk.index)
+    predictions = record['model'].predict(features[complete])
+    return pd.Series(predictions, index=chunk.index[complete]).reindex(chunk.index)
+
+
+def predict_file(name, path, output_path, chunksize=100000, keep=None,
+                 directory=MODELS_DIR):
+    '''
+    Streams the CSV file at path through the saved model chunksize rows at a
+    time and writes the predictions to output_path, so memory stays bounded by
+    the chunk size. The keep columns (such as an institution name) are copied
+    next to the prediction column. Returns the number of rows scored.
+    '''
+    record = load_model(name, directory)
+    keep = keep or []
+    columns = set(record['features']) | set(keep)
+    reader = pd.read_csv(path, usecols=lambda col: col in columns,
+                         na_values=['PrivacySuppressed'], chunksize=chunksize)
+    rows = 0
+    for chunk in reader:
+        output = chunk[keep].copy()
+        output['prediction'] = predict_chunk(record, chunk)
+        output.to_csv(output_path, mode='w' if rows == 0 else 'a',
+                      header=rows == 0, index=False)
+        rows += len(chunk)
+    return rows
+
+
+def main():
+    '''
+    Command line entry point for scoring a file with a saved model.
+    '''
+    parser = argparse.ArgumentParser(description='Score a CSV file with a saved model.')
+    parser.add_argument('name', help='name of the saved model')
+    parser.add_argument('input', help='CSV file with the feature columns')
+    parser.add_argument('output', help='CSV file to write the predictions to')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--keep', nargs='*', default=[],
+                        help='columns to copy next to the predictions')
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    args = parser.parse_args()
+    rows = predict_file(args.name, args.input, args.output, args.chunksize,
+                        args.keep, args.models_dir)
+    print('Scored', rows, 'rows')
+
+
+if __name__ == '__main__':
+    main()
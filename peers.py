@@ -0,0 +1,172 @@
+import argparse
+import os
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree, KDTree
+import geometry
+import ingest
+import model_store
+'''
+Finds peer institutions: the institutions with the most similar racial
+make-up (the seven col_ percentages), optionally together with Scorecard
+income and SAT columns. The institutions are put in a KD-tree (a ball tree
+for many columns) that is saved to disk, so thousands of institutions can
+be matched at once without comparing every pair.
+'''
+
+COMPOSITION = ['col_white', 'col_black', 'col_asian', 'col_hispa', 'col_pacis',
+               'col_amind', 'col_twora']
+# Scorecard columns that can be added to the composition
+SCORECARD = ['FAMINC', 'MD_FAMINC', 'SAT_AVG']
+INFO = ['inst_name', 'fips_ipeds', 'year']
+INDEX_DIR = os.path.join(geometry.CACHE_DIR, 'peers')
+# KD-trees get slow with many columns, so a ball tree is used above this
+KD_TREE_COLUMNS = 15
+
+
+def build_index(df, features=None):
+    '''
+    Takes in a dataframe of institutions and returns the peer index of the
+    rows that have every feature column (the composition columns by default).
+    The columns are standardized first, so columns with large values (like
+    income) do not outweigh the percentages.
+    '''
+    features = COMPOSITION if features is None else features
+    df = df.dropna(subset=features)
+    values = df[features].to_numpy(dtype=float)
+    mean = values.mean(axis=0)
+    scale = values.std(axis=0)
+    scale[scale == 0] = 1
+    points = (values - mean) / scale
+    return {
+        'tree': _tree(points),
+        'points': points,
+        'features': features,
+        'mean': mean,
+        'scale': scale,
+        'info': df[[col for col in INFO if col in df.columns]].reset_index(drop=True),
+        'subsets': {},
+    }
+
+
+def load_index(df, features=None, directory=INDEX_DIR):
+    '''
+    Returns the peer index of the dataframe, loading it from the directory
+    if it was saved for the same data and features, and building and saving
+    it otherwise.
+    '''
+    features = COMPOSITION if features is None else features
+    key = model_store.fingerprint(df[features + [col for col in INFO if col in df.columns]])
+    path = os.path.join(directory, key[:16] + '.joblib')
+    if os.path.exists(path):
+        return joblib.load(path)
+    index = build_index(df, features)
+    os.makedirs(directory, exist_ok=True)
+    joblib.dump(index, path)
+    return index
+
+
+def find_peers(index, queries, k=5, state=None, year=None, exclude=None):
+    '''
+    Returns the k nearest institutions in the index to every row of the
+    queries dataframe (which needs the index's feature columns), as a
+    dataframe with the query row, the rank of the peer, the peer's
+    information and its distance. Peers can be limited to a state and/or
+    year. exclude can give the index row of every query (or -1) that should
+    not be returned as its own peer. Queries missing a feature value have no
+    peers, like the rows left out of the index.
+    '''
+    rows = _subset_rows(index, state, year)
+    tree = index['tree'] if rows is None else _subset_tree(index, rows, state, year)
+    size = len(index['points']) if rows is None else len(rows)
+    points = (queries[index['features']].to_numpy(dtype=float) - index['mean']) / index['scale']
+    # positions of the queries that have every feature
+    complete = np.flatnonzero(~np.isnan(points).any(axis=1))
+    extra = 0 if exclude is None else 1
+    count = min(k + extra, size)
+    if count == 0 or len(complete) == 0:
+        return pd.DataFrame(columns=['query', 'rank', 'distance'] + list(index['info'].columns))
+    distances, neighbors = tree.query(points[complete], k=count)
+    if rows is not None:
+        neighbors = rows[neighbors]
+    query = np.repeat(complete, count)
+    neighbors = neighbors.ravel()
+    distances = distances.ravel()
+    if exclude is not None:
+        keep = neighbors != np.repeat(np.asarray(exclude)[complete], count)
+        query, neighbors, distances = query[keep], neighbors[keep], distances[keep]
+    rank = pd.Series(query).groupby(query).cumcount().to_numpy() + 1
+    top = rank <= k
+    peers = pd.DataFrame({'query': queries.index.to_numpy()[query[top]],
+                          'rank': rank[top], 'distance': distances[top]})
+    info = index['info'].iloc[neighbors[top]].reset_index(drop=True)
+    return pd.concat([peers, info], axis=1)
+
+
+def peers_of(index, names, k=5, state=None, year=None):
+    '''
+    Returns the k nearest peers of the institutions in the index with the
+    given names (see find_peers), never returning an institution as its own
+    peer.
+    '''
+    rows = np.flatnonzero(index['info']['inst_name'].isin(names).to_numpy())
+    points = index['points'][rows] * index['scale'] + index['mean']
+    queries = pd.DataFrame(points, columns=index['features'],
+                           index=index['info']['inst_name'].iloc[rows])
+    return find_peers(index, queries, k, state, year, exclude=rows)
+
+
+def _tree(points):
+    '''
+    Helper method that builds the nearest neighbor tree of the points.
+    '''
+    if points.shape[1] > KD_TREE_COLUMNS:
+        return BallTree(points)
+    return KDTree(points)
+
+
+def _subset_rows(index, state, year):
+    '''
+    Helper method for find_peers. Returns the index rows in the state and
+    year, or None if there is no filter.
+    '''
+    if state is None and year is None:
+        return None
+    keep = np.ones(len(index['info']), dtype=bool)
+    if state is not None:
+        keep &= (index['info']['fips_ipeds'] == state).to_numpy()
+    if year is not None:
+        keep &= (index['info']['year'] == year).to_numpy()
+    return np.flatnonzero(keep)
+
+
+def _subset_tree(index, rows, state, year):
+    '''
+    Helper method for find_peers. Returns the tree of the rows of one state
+    and/or year, building it the first time that filter is used.
+    '''
+    if (state, year) not in index['subsets']:
+        index['subsets'][(state, year)] = _tree(index['points'][rows])
+    return index['subsets'][(state, year)]
+
+
+def main():
+    '''
+    Command line entry point that prints the peers of institutions in the
+    racial rep dataset.
+    '''
+    parser = argparse.ArgumentParser(description='Find the peer institutions of colleges.')
+    parser.add_argument('names', nargs='+', help='institution names in the racial rep dataset')
+    parser.add_argument('-k', type=int, default=5, help='number of peers per institution')
+    parser.add_argument('--state', help='only return peers in this state')
+    parser.add_argument('--year', type=int, help='only use this year of the dataset')
+    args = parser.parse_args()
+    df = ingest.read_dataset('race', INFO + COMPOSITION)
+    if args.year is not None:
+        df = df[df['year'] == args.year]
+    print(peers_of(load_index(df), args.names, args.k, args.state).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+import contextvars
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import geometry
+import instrument
+'''
+Runs a declarative graph of stages, caching the output of every stage on
+disk. A stage is skipped when its key (a hash of its code, its parameters,
+its source files and the outputs of the stages it depends on) matches the
+key it was last run with and the files it writes are still there, so re-runs
+only redo the stages whose inputs changed or whose files were deleted.
+Stage functions and code modules can be given by name ('module:function' and
+'module'), so their modules are only imported when the stage actually runs.
+Stages whose inputs are ready run at the same time on a pool of threads, and
+a failing stage only stops the stages that depend on it. Each stage runs in
+a copy of the caller's context, so context variables (like the graphs folder
+of rendering.graphs_in) carry over to the stage threads. The outputs of
+stages can also be started in the background before the run (prefetched),
+so reading files overlaps with the stages that do not need them.
+'''
+
+CACHE_DIR = os.path.join(geometry.CACHE_DIR, 'stages')
+
+
+def stage(name, func, inputs=(), params=None, sources=(), code=(), cache=True,
+          exclusive=False, outputs=()):
+    '''
+    Returns the description of a stage. func is called with the outputs of
+    the input stages (in order) and the params as keyword arguments. The
+    contents of the sources files and the source code of func's module and
+    of the code modules are part of the stage's key. func can be a
+    'module:function' string and code can hold module names, so nothing
+    is imported until the stage runs. If cache is False the
+    output is not saved, so the stage runs again whenever a later stage
+    that is not skipped needs it. An exclusive stage never runs at the same
+    time as another stage. outputs are the files the stage writes (like its
+    graphs); the stage runs again if one of them is missing.
+    '''
+    return {
+        'name': name,
+        'func': func,
+        'inputs': list(inputs),
+        'params': params or {},
+        'sources': list(sources),
+        'code': [_func_module(func)] + list(code),
+        'cache': cache,
+        'exclusive': exclusive,
+        'outputs': list(outputs),
+    }
+
+
+def run_pipeline(stages, targets=None, cache_dir=CACHE_DIR, force=False, workers=1,
+                 prefetched=None):
+    '''
+    Runs the stages needed for the target stages (every stage by default),
+    each after the stages it depends on, skipping stages that are up to date
+    unless force is True. Up to workers stages run at the same time. A stage
+    that raises an error is 'failed' and the stages depending on it are
+    'blocked', while the other stages still run. Returns a list of (stage
+    name, 'ran', 'skipped', 'failed' or 'blocked', seconds) in dependency order.
+    prefetched can map stage names to futures of their outputs that were
+    started before the run (see ingest.load_in_background); such a stage
+    waits for its future instead of calling its function.
+    '''
+    prefetched = dict(prefetched or {})
+    by_name = {s['name']: s for s in stages}
+    order = stage_order(stages, targets)
+    manifest = _read_manifest(cache_dir)
+    values = {}
+    hashes = {}
+    # one lock per stage, so uncached inputs are only computed once
+    locks = {name: threading.RLock() for name in by_name}
+    locks[None] = threading.Lock()
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while len(results) < len(order):
+            for name in order:
+                if name in results or name in running.values():
+                    continue
+                inputs = by_name[name]['inputs']
+                if any(results.get(dep, ('',))[0] in ['failed', 'blocked'] for dep in inputs):
+                    results[name] = ('blocked', 0.0)
+                elif all(dep in results for dep in inputs):
+                    exclusive = by_name[name]['exclusive'] or \
+                        any(by_name[other]['exclusive'] for other in running.values())
+                    if exclusive and running:
+                        continue
+                    future = pool.submit(contextvars.copy_context().run, _timed_stage,
+                                         by_name[name], by_name, values, hashes, manifest,
+                                         cache_dir, force, locks, prefetched)
+                    running[future] = name
+                    if by_name[name]['exclusive']:
+                        break
+            if not running:
+                continue
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return [(name,) + results[name] for name in order]
+
+
+def pending_stages(stages, targets=None, cache_dir=CACHE_DIR, force=False):
+    '''
+    Returns the names of the stages that run_pipeline would run for the
+    targets, in dependency order, without running anything. A stage whose
+    input runs is counted as running (even though it is skipped if the
+    input's output did not change), and so are the uncached stages that a
+    running stage needs.
+    '''
+    by_name = {s['name']: s for s in stages}
+    order = stage_order(stages, targets)
+    manifest = _read_manifest(cache_dir)
+    pending = set()
+    for name in order:
+        s = by_name[name]
+        entry = manifest.get(name)
+        if force or entry is None or any(dep in pending for dep in s['inputs']):
+            pending.add(name)
+        elif entry['key'] != stage_key(s, [manifest[dep]['hash'] for dep in s['inputs']]) \
+                or not _outputs_exist(s, cache_dir):
+            pending.add(name)
+    for name in reversed(order):
+        if name in pending:
+            pending.update(dep for dep in by_name[name]['inputs']
+                           if not by_name[dep]['cache'])
+    return [name for name in order if name in pending]
+
+
+def critical_path(stages, report):
+    '''
+    Takes in the stages and the report of run_pipeline and returns the chain
+    of dependent stages that took the longest in total, as a list of stage
+    names, and its total seconds. With enough workers, the whole run cannot
+    be faster than this chain.
+    '''
+    by_name = {s['name']: s for s in stages}
+    seconds = {name: secs for name, status, secs in report}
+    longest = {}
+    for name, status, secs in report:
+        # the report is in dependency order, so the inputs are already done
+        best = max([longest[dep] for dep in by_name[name]['inputs'] if dep in longest],
+                   key=lambda path: path[1], default=([], 0.0))
+        longest[name] = (best[0] + [name], best[1] + seconds[name])
+    return max(longest.values(), key=lambda path: path[1], default=([], 0.0))
+
+
+def load_result(name, cache_dir=CACHE_DIR):
+    '''
+    Returns the saved output of the stage with the given name from its last run.
+    '''
+    with open(_value_path(cache_dir, name), 'rb') as f:
+        return pickle.load(f)
+
+
+def stage_order(stages, targets=None):
+    '''
+    Returns the names of the stages needed for the targets, with every stage
+    after the stages it depends on.
+    '''
+    by_name = {s['name']: s for s in stages}
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError('stage ' + name + ' depends on itself')
+        if name not in by_name:
+            raise ValueError('unknown stage ' + name)
+        visiting.add(name)
+        for dep in by_name[name]['inputs']:
+            visit(dep)
+        visiting.remove(name)
+        order.append(name)
+
+    for name in targets or by_name:
+        visit(name)
+    return order
+
+
+def stage_key(s, input_hashes):
+    '''
+    Returns the key of a stage from its name, code, parameters, source
+    files and the output hashes of its inputs.
+    '''
+    digest = hashlib.sha256()
+    digest.update(s['name'].encode())
+    digest.update(_func_name(s['func']).encode())
+    for module in s['code']:
+        digest.update(_code_hash(module).encode())
+    digest.update(repr(sorted(s['params'].items())).encode())
+    for path in s['sources']:
+        digest.update(_source_hash(path).encode())
+    for input_hash in input_hashes:
+        digest.update(input_hash.encode())
+    return digest.hexdigest()
+
+
+def _timed_stage(s, by_name, values, hashes, manifest, cache_dir, force, locks,
+                 prefetched):
+    '''
+    Helper method for run_pipeline that runs in a worker thread. Runs the
+    stage and returns its status and seconds, printing the error of a
+    failed stage instead of raising it.
+    '''
+    start = time.perf_counter()
+    status = 'failed'
+    # errors while recording the stage also only fail this stage
+    try:
+        with instrument.measure(s['name'], 'stage') as record:
+            record['status'] = 'failed'
+            record['status'] = status = _run_stage(s, by_name, values, hashes, manifest,
+                                                   cache_dir, force, locks, prefetched)
+            record['rows_out'] = instrument.row_count(values.get(s['name']))
+    except Exception:
+        status = 'failed'
+        print('Stage', s['name'], 'failed:', file=sys.stderr)
+        traceback.print_exc()
+    return status, time.perf_counter() - start
+
+
+def _run_stage(s, by_name, values, hashes, manifest, cache_dir, force, locks, prefetched):
+    '''
+    Helper method for run_pipeline. Runs one stage unless it is up to date,
+    saving its output and output hash. Returns 'ran' or 'skipped'.
+    '''
+    name = s['name']
+    key = stage_key(s, [hashes[dep] for dep in s['inputs']])
+    entry = manifest.get(name)
+    if not force and entry is not None and entry['key'] == key and \
+            _outputs_exist(s, cache_dir):
+        hashes[name] = entry['hash']
+        return 'skipped'
+
+    args = [_input_value(dep, by_name, values, cache_dir, locks, prefetched)
+            for dep in s['inputs']]
+    value = _call(s, args, prefetched)
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    values[name] = value
+    hashes[name] = hashlib.sha256(data).hexdigest()
+    if s['cache']:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(_value_path(cache_dir, name), 'wb') as f:
+            f.write(data)
+    with locks[None]:
+        manifest[name] = {'key': key, 'hash': hashes[name]}
+        _write_manifest(cache_dir, manifest)
+    return 'ran'
+
+
+def _input_value(name, by_name, values, cache_dir, locks, prefetched):
+    '''
+    Helper method for run_pipeline. Returns the output of an input stage,
+    from memory if it ran in this run or from its saved file otherwise.
+    Uncached stages that were skipped are run again (once, even if several
+    stages need them at the same time).
+    '''
+    with locks[name]:
+        if name not in values:
+            s = by_name[name]
+            if s['cache']:
+                values[name] = load_result(name, cache_dir)
+            else:
+                args = [_input_value(dep, by_name, values, cache_dir, locks, prefetched)
+                        for dep in s['inputs']]
+                values[name] = _call(s, args, prefetched)
+    return values[name]
+
+
+def _call(s, args, prefetched):
+    '''
+    Helper method for run_pipeline. Returns the output of the stage for the
+    input values, from its prefetched future if one was started (each future
+    is only used once).
+    '''
+    future = prefetched.pop(s['name'], None)
+    if future is not None:
+        return future.result()
+    return resolve(s['func'])(*args, **s['params'])
+
+
+def resolve(func):
+    '''
+    Returns the function, importing it first if it is a 'module:function' string.
+    '''
+    if isinstance(func, str):
+        module, name = func.split(':')
+        return getattr(importlib.import_module(module), name)
+    return func
+
+
+def _func_module(func):
+    '''
+    Helper method for stage. Returns the module (or module name) of a function.
+    '''
+    if isinstance(func, str):
+        return func.split(':')[0]
+    return inspect.getmodule(func)
+
+
+def _func_name(func):
+    '''
+    Helper method for stage_key. Returns the name of a function.
+    '''
+    if isinstance(func, str):
+        return func.split(':')[1]
+    return func.__qualname__
+
+
+def _code_hash(module):
+    '''
+    Helper method that returns a hash of the source code of a module. A
+    module name is looked up without importing the module.
+    '''
+    if isinstance(module, str):
+        return _source_hash(importlib.util.find_spec(module).origin)
+    return geometry.file_hash(inspect.getsourcefile(module))
+
+
+_source_hashes = {}
+
+
+def _source_hash(path):
+    '''
+    Helper method that returns a hash of a source file, hashing each
+    version of the file only once per process.
+    '''
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in _source_hashes:
+        _source_hashes[key] = geometry.file_hash(path)
+    return _source_hashes[key]
+
+
+def _outputs_exist(s, cache_dir):
+    '''
+    Helper method that returns whether the saved output of a stage (if it is
+    cached) and every file in its outputs are there.
+    '''
+    if s['cache'] and not os.path.exists(_value_path(cache_dir, s['name'])):
+        return False
+    return all(os.path.exists(path) for path in s['outputs'])
+
+
+def _value_path(cache_dir, name):
+    '''
+    Helper method that returns the file the output of a stage is saved in.
+    '''
+    return os.path.join(cache_dir, name + '.pkl')
+
+
+def _read_manifest(cache_dir):
+    '''
+    Helper method that returns the keys and output hashes of the last run
+    of every stage.
+    '''
+    path = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(cache_dir, manifest):
+    '''
+    Helper method that saves the keys and output hashes of the stages.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
@@ -1,7 +1,7 @@
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
 import numpy as np
+import geometry
+import rendering
 '''
 Code for the first question about race across states and race changes over time.
 
@@ -11,30 +11,69 @@ Code for the first question about race across states and race changes over time.
     dif_RACE: Difference in percent of enrolled and marker (col_RACE - mkt_RACE)
 '''
 
+# amind = American Indians; twora = Two or More Races; hispa = Hispanic
+RACES = ['white', 'black', 'asian', 'hispa', 'amind', 'pacis', 'twora']
+MINORITIES = ['asian', 'black', 'hispanic', 'pacis', 'amind', 'twora']
+METRICS = ['col_', 'mkt_', 'dif_']
+# races used for the diversity index and the supported index methods
+# (each computed by its _<method>_index helper)
+DIVERSITY_RACES = ['white', 'hispa']
+DIVERSITY_METHODS = ['shannon', 'simpson', 'gini_simpson']
+# columns race_top_bottom_5 needs from the scored dataset
+TOP_BOTTOM_COLUMNS = ['inst_name'] + ['col_' + race for race in RACES]
 
-def race_percent_geoplot(df, test=False):
+
+def state_race_averages(df):
+    '''
+    Finds the state average of every col_, mkt_ and dif_ race column with a
+    single groupby, so the race geoplots can share one pass over the data.
+    The hispa columns are renamed to hispanic and every metric also gets a
+    minority column that adds together the minority races.
+    '''
+    columns = [metric + race for metric in METRICS for race in RACES
+               if metric + race in df.columns]
+    return label_averages(df.groupby('fips_ipeds', observed=True)[columns].mean())
+
+
+def label_averages(averages):
+    '''
+    Helper method for state_race_averages (and cube.state_averages). Takes in
+    the state averages of the race columns, renames the hispa columns to
+    hispanic and adds the minority column of every metric.
+    '''
+    averages = averages.copy()
+    averages.columns = [col[:-len('hispa')] + 'hispanic' if col.endswith('_hispa')
+                        else col for col in averages.columns]
+    for metric in METRICS:
+        if all(metric + race in averages.columns for race in MINORITIES):
+            averages[metric + 'minority'] = sum(averages[metric + race]
+                                                for race in MINORITIES)
+    return averages
+
+
+def metric_averages(averages, metric):
+    '''
+    Takes the result of state_race_averages and returns the state averages
+    of one metric ('col_', 'mkt_' or 'dif_') with the race as the column name.
+    '''
+    columns = [col for col in averages.columns if col.startswith(metric)]
+    return averages[columns].rename(columns=lambda col: col[len(metric):])
+
+
+def race_percent_geoplot(df, test=False, averages=None):
     '''
     This method finds the average percentage of the representation of every race 
     in every college within a state. The geospatial plot represents this data 
     though a spectrum. This takes in the college racial representatives dataset for
-    the year 2017.
+    the year 2017. The result of state_race_averages can be passed in as averages
+    so it is not computed again.
     '''
-    average_races = pd.DataFrame()
-    df_copy = df.copy()
-    # amind = American Indians; twora = Two or More Races; hispa = Hispanic
-    races = ['white', 'black', 'asian', 'hispanic', 'amind', 'pacis', 'twora']
-    df_copy.columns = ['col_hispanic' if x == 'col_hispa' else x for x in df.columns]
-    for race in races:
-        average_races[race] = df_copy.groupby('fips_ipeds')['col_' + race].mean()
-    # finds average minority percentage by adding minority races together
-    average_races['minority'] = (average_races['asian'] +
-                                 average_races['black'] +
-                                 average_races['hispanic'] +
-                                 average_races['pacis'] +
-                                 average_races['amind'] +
-                                 average_races['twora'])
+    if averages is None:
+        averages = state_race_averages(df)
+    # includes the average minority percentage of the minority races added together
+    average_races = metric_averages(averages, 'col_')
     # merges with the JSON file which contains shape of states
-    usa = gpd.read_file('data/gz_2010_us_040_00_5m.json')
+    usa = geometry.load_states()
     merged = usa.merge(average_races,
                        left_on='NAME',
                        right_index=True,
@@ -42,142 +81,132 @@ def race_percent_geoplot(df, test=False):
 
     # only plots if not test function
     if test == False:
-        plot_race_percent(merged, 'minority')
-        plot_race_percent(merged, 'white')
-        plot_race_percent(merged, 'black')
-        plot_race_percent(merged, 'asian')
-        plot_race_percent(merged, 'hispanic')
+        # one map per race, recoloring the same state shapes
+        rendering.render_maps(merged, [
+            (race, 'Avg Enrollment % of ' + race.capitalize() + ' Populations Per State',
+             'state_race_' + race + '.png')
+            for race in ['minority', 'white', 'black', 'asian', 'hispanic']])
     return merged
 
 
-def plot_race_percent(merged, race):
-    '''
-    Helper method for the race_percent_geoplot method.
-    Plots the graph for each race, by taking in the merged dataset
-    with groupby and specific race.
-    '''
-    fig, ax = plt.subplots(1)
-    fig.tight_layout()
-    ax.set_title('Avg Enrollment % of ' + race.capitalize() +
-                 ' Populations Per State')
-    merged.plot(ax=ax, column=race, legend='true')
-    plt.xlim(-200, -35)
-    plt.savefig('graphs/state_race_' + race + '.png')
-    plt.clf()
-
-
-def plot_market_share(df):
+def plot_market_share(df, averages=None):
     """
     Plots the market share of the specific racial populations
     within each state using the college_racial_rep dataset 
     Filtered to the data in the year 2017
+    Can also take in the result of state_race_averages
     """
-    races = ['white', 'black', 'asian', 'hispanic', 'amind', 'pacis', 'twora']
-    # makes a copy of the college_racial_rep dataset
-    df = df.copy()
-    mkt_share = pd.DataFrame()
-    df.columns = [
-        'mkt_hispanic' if x == 'mkt_hispa' else x for x in df.columns]
-    for race in races:
-        mkt_share[race] = df.groupby('fips_ipeds')['mkt_' + race].mean()
-    # groups toegther minority populations for minority group metrics
-    mkt_share['minority'] = (mkt_share['asian'] + mkt_share['black'] +
-                             mkt_share['hispanic'] + mkt_share['pacis'] +
-                             mkt_share['amind'] + mkt_share['twora'])
-    usa = gpd.read_file('data/gz_2010_us_040_00_5m.json')
+    if averages is None:
+        averages = state_race_averages(df)
+    # includes the minority populations grouped together for minority group metrics
+    mkt_share = metric_averages(averages, 'mkt_')
+    usa = geometry.load_states()
     merged = usa.merge(mkt_share,
                        left_on='NAME',
                        right_index=True,
                        how='right')
 
-    # for loop plots the market share graphs for each of the racial categories
-    for race in ['minority', 'white', 'black', 'hispanic', 'asian']:
-        fig, ax = plt.subplots(1)
-        fig.tight_layout()
-        ax.set_title('Average Market Share of ' + race.capitalize() +' People Per State')
-        merged.plot(ax=ax, column=race, legend='true')
-        plt.xlim(-200, -35)
-        plt.savefig('graphs/market_race_' + race + '.png')
-        plt.clf()
+    # plots the market share graphs for each of the racial categories
+    rendering.render_maps(merged, [
+        (race, 'Average Market Share of ' + race.capitalize() + ' People Per State',
+         'market_race_' + race + '.png')
+        for race in ['minority', 'white', 'black', 'hispanic', 'asian']])
 
 
-def race_enrollment_diff(df, test=False):
+def race_enrollment_diff(df, test=False, averages=None):
     '''
     The market difference represents the difference in percentage of the university's 
     enrolled population of a race and the state's overall market 
     of the race (col_RACE - mkt_RACE).
-    Takes in the college racial representative dataset for the year 2017. 
+    Takes in the college racial representative dataset for the year 2017
+    and optionally the result of state_race_averages.
     '''
-    races_dif = pd.DataFrame()
-    df_copy = df.copy()
-    races = ['white', 'black', 'asian', 'hispanic', 'amind', 'pacis', 'twora']
-    df_copy.columns = [
-        'dif_hispanic' if x == 'dif_hispa' else x for x in df.columns]
-    for race in races:
-        races_dif[race] = df_copy.groupby('fips_ipeds')['dif_' + race].mean()
+    if averages is None:
+        averages = state_race_averages(df)
+    races_dif = metric_averages(averages, 'dif_')
 
     # merges with the JSON file which contains shape of states
-    usa = gpd.read_file('data/gz_2010_us_040_00_5m.json')
+    usa = geometry.load_states()
     merged = usa.merge(races_dif, left_on='NAME', right_index=True, how='inner')
 
     # only plots if not testing call
     if test == False:
-        plot_market_difference(merged, 'white')
-        plot_market_difference(merged, 'black')
-        plot_market_difference(merged, 'asian')
-        plot_market_difference(merged, 'hispanic')
+        rendering.render_maps(merged, [
+            (race, 'Avg Market Difference of ' + race.capitalize() + ' People Per State',
+             'market_diff_' + race + '.png')
+            for race in ['white', 'black', 'asian', 'hispanic']])
 
     # returns the dataset with groupby for testing
     return merged
 
 
-def plot_market_difference(merged, race):
-    '''
-    Helper method for race_enrollment_diff method. Plots the market difference of 
-    the race passed in and the merged/groupby dataset. 
-    '''
-    fig, ax = plt.subplots(1)
-    fig.tight_layout()
-    ax.set_title('Avg Market Difference of ' + race.capitalize() +' People Per State')
-    merged.plot(ax=ax, column=race, legend='true')
-    plt.xlim(-200, -35)
-    plt.savefig('graphs/market_diff_' + race + '.png')
-    plt.clf()
-
-
-def calculate_racial_diversity_index(df):
+def calculate_racial_diversity_index(df, races=None, method='shannon',
+                                     chunksize=None, columns=None):
     '''
     Calculate the racial diversity scores by using the Shannon-Wiener Diversity Index.
     Excluded amind, pacis, and twora races as they caused the diversity index to be 
     negative. Uses a subset of the data (year == 2017) out of the college racial rep dataset.
     https://archives.huduser.gov/healthycommunities/sites/default/files/public/Racial%20Diversity%20using%20Shannon-Wiener%20Index.pdf
+    Returns the dataset with an added index column. The races and method can be
+    changed, and chunksize limits how many rows are scored at once for
+    multi-year data (see diversity_index).
+    Adding the column copies the whole dataset, so columns can limit the
+    returned dataset to the columns that are needed (plus the index).
     '''
-    df_copy = df.copy()
-    races = ['white', 'black', 'asian', 'hispa', 'amind', 'pacis', 'twora']
+    index = diversity_index(df, races, method, chunksize)
+    if columns is not None:
+        df = df[columns]
+    return df.assign(index=index)
 
-    for race in races:
-        # divided by 100 to get in decimal format
-        df_copy['col_' + race] = df_copy['col_' + race].div(100)
-        # finds population number fo race
-        df_copy[race +'_pop'] = df_copy['total_enrollment'] * df_copy['col_' + race]
-        # Shannon-Wiener Diversity Index method from pdf
-        df_copy[race +'_diverse'] = df_copy['col_' +
-                                      race].apply(log_apply) * df_copy['col_' + race]
 
+def diversity_index(df, races=None, method='shannon', chunksize=None):
+    '''
+    Returns an array with the diversity index of every row of the college racial
+    rep dataset, computed over the col_ columns of the given races
+    (white and hispa by default). The method is one of:
+        shannon: Shannon-Wiener index, -sum(p * log(p)) where 0 * log(0) is 0
+        simpson: Simpson index, sum(p^2)
+        gini_simpson: Gini-Simpson index, 1 - sum(p^2)
+    Missing percentages count as 0. The rows are scored chunksize at a time
+    (all at once by default).
+    '''
+    if races is None:
+        races = DIVERSITY_RACES
+    if method not in DIVERSITY_METHODS:
+        raise ValueError('method must be one of ' + ', '.join(DIVERSITY_METHODS))
+    index_method = {'shannon': _shannon_index, 'simpson': _simpson_index,
+                    'gini_simpson': _gini_simpson_index}[method]
+    # divided by 100 to get in decimal format
+    shares = df[['col_' + race for race in races]].to_numpy(dtype=float) / 100
+    index = np.empty(len(shares))
+    step = chunksize or max(len(shares), 1)
+    for start in range(0, len(shares), step):
+        index[start:start + step] = index_method(shares[start:start + step])
+    return index
+
+
+def _shannon_index(shares):
+    '''
+    Helper method for diversity_index. Shannon-Wiener Diversity Index method from pdf.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.where(shares > 0, np.log(shares), 0)
     # performs the -sum of all the races
-    df_copy['index'] = df_copy.loc[:, ['white_diverse', 'hispa_diverse']].sum(axis=1) * -1
-    return df_copy
+    return -np.nansum(shares * logs, axis=1)
+
+
+def _simpson_index(shares):
+    '''
+    Helper method for diversity_index. Sum of the squared shares of the races.
+    '''
+    return np.nansum(shares * shares, axis=1)
 
 
-def log_apply(series):
+def _gini_simpson_index(shares):
     '''
-    Helper method for calculating racial diversity index
+    Helper method for diversity_index. One minus the Simpson index.
     '''
-    # returns log if it doesn't equal 0
-    if series == 0:
-        return 0
-    else:
-        return np.log(series)
+    return 1 - _simpson_index(shares)
 
 
 def race_top_bottom_5(df):
@@ -186,20 +215,17 @@ def race_top_bottom_5(df):
     find the top 5 and bottom 5 universities in racial diversity and plots a bar
     graph of their racial percentages.
     '''
-    fig, ax = plt.subplots(1)
+    fig, ax = rendering.new_figure()
     top_5 = df.nlargest(5, 'index')
     lowest_5 = df.nsmallest(5, 'index')
     # concatenates the two dataframes
     top_and_worst = pd.concat([top_5, lowest_5])
 
     # plots bar plot and customizes it
-    top_and_worst[[
-        'inst_name', 'col_white', 'col_black', 'col_asian', 'col_hispa',
-        'col_amind', 'col_pacis', 'col_twora'
-    ]].plot.bar(x='inst_name', ax=ax, fontsize=8)
-    plt.xlabel('Institution Name', fontsize=15)
-    plt.ylabel('Racial Percentages', fontsize=15)
-    plt.title('Top/Bottom 5 Universities in Racial Diversity', fontsize=20)
+    top_and_worst[TOP_BOTTOM_COLUMNS].plot.bar(x='inst_name', ax=ax, fontsize=8)
+    ax.set_xlabel('Institution Name', fontsize=15)
+    ax.set_ylabel('Racial Percentages', fontsize=15)
+    ax.set_title('Top/Bottom 5 Universities in Racial Diversity', fontsize=20)
 
     # used ChatGPT for legend change code
     handles, labels = ax.get_legend_handles_labels()
@@ -208,49 +234,58 @@ def race_top_bottom_5(df):
         'Pacific Islander', '2+ Races'
     ]
     ax.legend(handles, new_labels, fontsize=12)
-    plt.savefig('graphs/top_and_worst.png', bbox_inches='tight')
-    plt.clf()
+    rendering.save(fig, 'top_and_worst.png', bbox_inches='tight')
 
 
-def race_percent_time_bar(df, test=False):
+def race_percent_time_bar(df, test=False, averages=None):
     '''
     Takes in the college racial rep dataset and plots a stacked bar
     plot of the change in racial percentages and calls the method for
-    the line plot for enrollment over time.
+    the line plot for enrollment over time. The yearly averages from
+    cube.year_averages can be passed in as averages instead of the dataset.
     '''
-    average_races = pd.DataFrame()
-    average_races['total_enrollment'] = df.groupby(
-        'year')['total_enrollment'].sum()
     races = ['white', 'asian', 'black', 'hispa', 'pacis', 'amind', 'twora']
 
-    # performs average of each race by year with groupby
-    for race in races:
-        average_races[race] = df.groupby('year')['col_' + race].mean()
+    if averages is None:
+        # sums the enrollment and averages each race by year with one groupby
+        aggregations = {'total_enrollment': 'sum'}
+        aggregations.update({'col_' + race: 'mean' for race in races})
+        averages = df.groupby('year').agg(aggregations)
+    average_races = averages[['total_enrollment'] + ['col_' + race for race in races]]
+    average_races = average_races.set_axis(['total_enrollment'] + races, axis=1)
 
     # only plots if it is not a test call
     if test == False:
-        fig, ax = plt.subplots(1)
-        # filters to not include year with NaN value
-        average_races['year'] = [year for year in range(2009, 2018)]
-        average_races = average_races[average_races['year'] >= 2010]
-        average_races1 = average_races.drop(columns='total_enrollment')
-
-        # plots bar plot and customizes graph
-        average_races1.plot.bar(x='year', stacked=True, ax=ax)
-        handles, labels = ax.get_legend_handles_labels()
-        new_labels = [
-            'White', 'Black', 'Asian', 'Hispanic', 'American Indian',
-            'Pacific Islander', '2+ Races'
-        ]
-        ax.legend(handles, new_labels)
-        plt.title('Enrollment Percentages By Race Across the Nation')
-        plt.xlabel('Year')
-        plt.ylabel('Percentage')
-        plt.savefig('graphs/race_percent_over_time.png', bbox_inches='tight')
-        race_enrollment_time_line(average_races)
+        # filters to not include years with NaN values
+        average_races = average_races.dropna().reset_index()
+        rendering.render_all([(race_percent_bar, (average_races,)),
+                              (race_enrollment_time_line, (average_races,))])
     return average_races
 
 
+def race_percent_bar(average_races):
+    '''
+    Helper method for race_percent_time_bar. Takes in the dataset which is
+    already grouped by year and plots the stacked bar plot of the racial
+    percentages over the years.
+    '''
+    fig, ax = rendering.new_figure()
+    average_races1 = average_races.drop(columns='total_enrollment')
+
+    # plots bar plot and customizes graph
+    average_races1.plot.bar(x='year', stacked=True, ax=ax)
+    handles, labels = ax.get_legend_handles_labels()
+    new_labels = [
+        'White', 'Black', 'Asian', 'Hispanic', 'American Indian',
+        'Pacific Islander', '2+ Races'
+    ]
+    ax.legend(handles, new_labels)
+    ax.set_title('Enrollment Percentages By Race Across the Nation')
+    ax.set_xlabel('Year')
+    ax.set_ylabel('Percentage')
+    rendering.save(fig, 'race_percent_over_time.png', bbox_inches='tight')
+
+
 def race_enrollment_time_line(average_races, test=False):
     '''
     Takes in the dataset which is already grouped by year and plots
@@ -260,11 +295,11 @@ def race_enrollment_time_line(average_races, test=False):
     races = ['white', 'asian', 'black', 'hispa', 'pacis', 'amind', 'twora']
 
     # finds the total enrollment from the average percent
+    enrollment = average_races[['year']].copy()
     for race in races:
-        average_races[race] = average_races[race] / 100 * average_races['total_enrollment']
-    fig, ax = plt.subplots(1)
-    average_races = average_races.drop(columns='total_enrollment')
-    average_races.plot(x='year', figsize=(12, 10), ax=ax, fontsize=12)
+        enrollment[race] = average_races[race] / 100 * average_races['total_enrollment']
+    fig, ax = rendering.new_figure(figsize=(12, 10))
+    enrollment.plot(x='year', ax=ax, fontsize=12)
     handles, labels = ax.get_legend_handles_labels()
     
     # new labels adds names for the legend so they are not the columns names from the dataset
@@ -273,8 +308,8 @@ def race_enrollment_time_line(average_races, test=False):
         'Pacific Islander', '2+ Races'
     ]
     ax.legend(handles, new_labels, fontsize=15)
-    plt.title('Enrollment By Race Across the Nation', fontsize=20)
-    plt.xlabel('Year', fontsize=15)
-    plt.ylabel('Enrollment Count', fontsize=15)
-    plt.ticklabel_format(style='plain')
-    plt.savefig('graphs/race_count_over_time.png', bbox_inches='tight')
+    ax.set_title('Enrollment By Race Across the Nation', fontsize=20)
+    ax.set_xlabel('Year', fontsize=15)
+    ax.set_ylabel('Enrollment Count', fontsize=15)
+    ax.ticklabel_format(style='plain')
+    rendering.save(fig, 'race_count_over_time.png', bbox_inches='tight')
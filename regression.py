@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+'''
+Fits straight lines through scatterplots without bootstrapping. The least
+squares fit, Pearson and Spearman correlations and the confidence band of
+every requested x/y pair are computed together with array operations, and
+the band comes from the t distribution instead of resampling the rows.
+Large scatterplots are drawn as hexbins instead of one dot per row.
+'''
+
+# scatterplots with more points than this are drawn as hexbins
+HEXBIN_POINTS = 20000
+CONFIDENCE = 0.95
+
+
+def fit_lines(df, pairs):
+    '''
+    Takes in a dataframe and a list of (x, y) column name pairs and returns
+    a dataframe with one row per pair: the number of rows used (rows missing
+    either value are left out), the slope and intercept of the least squares
+    line, the Pearson and Spearman correlations, the p-value of the slope and
+    the values confidence_band needs.
+    '''
+    x = df[[x_col for x_col, y_col in pairs]].to_numpy(dtype=float)
+    y = df[[y_col for x_col, y_col in pairs]].to_numpy(dtype=float)
+    # each pair only uses the rows where both of its values exist
+    mask = np.isfinite(x) & np.isfinite(y)
+    x = np.where(mask, x, np.nan)
+    y = np.where(mask, y, np.nan)
+    n = mask.sum(axis=0)
+    x_mean = np.nanmean(x, axis=0)
+    y_mean = np.nanmean(y, axis=0)
+    sxx, syy, sxy = _sums_of_squares(x - x_mean, y - y_mean)
+    slope = sxy / sxx
+    residual = np.maximum(syy - slope * sxy, 0)
+    std_error = np.sqrt(residual / (n - 2))
+    t_slope = slope / (std_error / np.sqrt(sxx))
+    # Spearman's correlation is Pearson's correlation of the ranks
+    x_ranks = pd.DataFrame(x).rank().to_numpy()
+    y_ranks = pd.DataFrame(y).rank().to_numpy()
+    rank_xx, rank_yy, rank_xy = _sums_of_squares(x_ranks - np.nanmean(x_ranks, axis=0),
+                                                 y_ranks - np.nanmean(y_ranks, axis=0))
+    return pd.DataFrame({
+        'x': [x_col for x_col, y_col in pairs],
+        'y': [y_col for x_col, y_col in pairs],
+        'n': n,
+        'slope': slope,
+        'intercept': y_mean - slope * x_mean,
+        'pearson': sxy / np.sqrt(sxx * syy),
+        'spearman': rank_xy / np.sqrt(rank_xx * rank_yy),
+        'p_value': 2 * stats.t.sf(np.abs(t_slope), n - 2),
+        'std_error': std_error,
+        'x_mean': x_mean,
+        'sxx': sxx,
+    })
+
+
+def confidence_band(fit, x, confidence=CONFIDENCE):
+    '''
+    Takes in one row of fit_lines and an array of x values and returns the
+    fitted y values with the lower and upper bounds of the confidence band
+    of the line at those x values.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = fit['intercept'] + fit['slope'] * x
+    t = stats.t.ppf((1 + confidence) / 2, fit['n'] - 2)
+    half_width = t * fit['std_error'] * np.sqrt(1 / fit['n'] + (x - fit['x_mean']) ** 2
+                                                / fit['sxx'])
+    return y, y - half_width, y + half_width
+
+
+def regression_plot(ax, df, x, y, color='C0', fit=None, max_points=HEXBIN_POINTS):
+    '''
+    Draws the x and y columns of the dataframe on the axes with the least
+    squares line and its confidence band, like seaborn's regplot. A row of
+    fit_lines can be passed in as fit so it is not computed again. With more
+    than max_points points the scatterplot is drawn as a hexbin.
+    '''
+    if fit is None:
+        fit = fit_lines(df, [(x, y)]).iloc[0]
+    x_values = df[x].to_numpy(dtype=float)
+    y_values = df[y].to_numpy(dtype=float)
+    mask = np.isfinite(x_values) & np.isfinite(y_values)
+    x_values = x_values[mask]
+    y_values = y_values[mask]
+    if len(x_values) > max_points:
+        ax.hexbin(x_values, y_values, gridsize=50, mincnt=1, cmap='Greys')
+    else:
+        ax.scatter(x_values, y_values, color=color, alpha=0.8, s=15)
+    if len(x_values) > 2:
+        line_x = np.linspace(x_values.min(), x_values.max(), 100)
+        line_y, lower, upper = confidence_band(fit, line_x)
+        ax.plot(line_x, line_y, color=color)
+        ax.fill_between(line_x, lower, upper, color=color, alpha=0.15, linewidth=0)
+    ax.set_xlabel(x)
+    ax.set_ylabel(y)
+    return fit
+
+
+def _sums_of_squares(dx, dy):
+    '''
+    Helper method for fit_lines. Returns the sums of squares of the x and y
+    deviations and the sum of their products for every column.
+    '''
+    return (np.nansum(dx ** 2, axis=0), np.nansum(dy ** 2, axis=0),
+            np.nansum(dx * dy, axis=0))
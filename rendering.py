@@ -0,0 +1,240 @@
+import contextlib
+import contextvars
+import multiprocessing
+import os
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
+'''
+Renders the graphs of the project. Every graph is drawn on its own Figure
+with the object-oriented Agg API instead of the global pyplot state, so
+independent graphs can be rendered at the same time by a process pool.
+The pool's processes are started by a fork server instead of forking the
+calling process, since pipeline stages render from several threads and a
+forked copy of a threaded process can hang on a lock another thread held.
+New processes import the script that was run, so scripts that render need
+an if __name__ == '__main__' guard; without one the pool breaks, and the
+graphs are rendered in the calling process instead (with a warning).
+State maps (choropleths) build the state shapes once and only recolor
+them for each map that is saved.
+Code can save its graphs into a folder of its own (graphs_in) without
+changing the folder of other threads. The folder is kept in a context
+variable, so pipeline stages run for the caller save into its folder.
+'''
+
+# number of processes used by render_all (None uses every core, 1 renders
+# every graph in the calling process)
+PROCESSES = None
+GRAPHS_DIR = 'graphs'
+
+_output_dir = GRAPHS_DIR
+# folder of the graphs_in block the code is in, if any
+_context_dir = contextvars.ContextVar('output_dir', default=None)
+_pool = None
+# pipeline stages running in threads can ask for the pool at the same time
+_pool_lock = threading.Lock()
+
+
+def new_figure(nrows=1, ncols=1, **kwargs):
+    '''
+    Returns a new figure and its axes like plt.subplots, but the figure is
+    not registered with pyplot, so it never has to be closed.
+    '''
+    subplot_kw = {key: kwargs.pop(key) for key in ['sharex', 'sharey', 'squeeze']
+                  if key in kwargs}
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig, fig.subplots(nrows, ncols, **subplot_kw)
+
+
+def graph_path(name):
+    '''
+    Returns the path in the graphs folder for the graph with the given file name.
+    '''
+    return os.path.join(get_output_dir(), name)
+
+
+def save(fig, name, **kwargs):
+    '''
+    Saves the figure in the graphs folder under the given file name.
+    '''
+    os.makedirs(get_output_dir(), exist_ok=True)
+    fig.savefig(graph_path(name), **kwargs)
+
+
+def render_maps(states, maps, xlim=(-200, -35), **kwargs):
+    '''
+    Takes in a GeoDataFrame of states and a list of (column, title, file name)
+    maps and saves a state map colored by each column. The state shapes and
+    the colorbar are drawn once; each map only changes the colors, the color
+    range and the title. Other keyword arguments are passed to new_figure.
+    '''
+    fig, ax = new_figure(**kwargs)
+    fig.tight_layout()
+    collection, colorbar = choropleth(ax, state_paths(states))
+    ax.set_xlim(*xlim)
+    for column, title, name in maps:
+        set_map_values(collection, colorbar, states[column])
+        ax.set_title(title)
+        save(fig, name)
+
+
+def state_paths(states):
+    '''
+    Returns the outline of every state in the GeoDataFrame as a matplotlib
+    path (states without a shape get an empty path), so the shapes are only
+    converted once no matter how many maps are drawn from them.
+    '''
+    paths = []
+    for shape in states.geometry:
+        polygons = [] if shape is None else getattr(shape, 'geoms', [shape])
+        rings = [Path(np.asarray(ring.coords)[:, :2], closed=True)
+                 for polygon in polygons
+                 for ring in [polygon.exterior] + list(polygon.interiors)]
+        paths.append(Path.make_compound_path(*rings) if rings
+                     else Path(np.empty((0, 2))))
+    return paths
+
+
+def choropleth(ax, paths, legend=True):
+    '''
+    Adds the state paths to the axes as one collection, with the same aspect
+    ratio GeoDataFrame.plot uses for latitude and longitude, and a colorbar
+    if legend is True. Returns the collection and the colorbar (or None).
+    The colors are set with set_map_values.
+    '''
+    collection = PatchCollection([PathPatch(path) for path in paths])
+    collection.set_array(np.ma.masked_all(len(paths)))
+    ax.add_collection(collection, autolim=True)
+    ax.autoscale_view()
+    y_min, y_max = ax.get_ylim()
+    ax.set_aspect(1 / np.cos(np.radians((y_min + y_max) / 2)))
+    colorbar = ax.figure.colorbar(collection, ax=ax) if legend else None
+    return collection, colorbar
+
+
+def set_map_values(collection, colorbar, values):
+    '''
+    Recolors the states of a choropleth collection by the values (one per
+    path, in the same order) and updates the color range and colorbar.
+    States with missing values are not filled.
+    '''
+    values = np.ma.masked_invalid(np.asarray(values, dtype=float))
+    collection.set_array(values)
+    if values.count() > 0:
+        # sets both ends of the range at once, so the colorbar never sees
+        # a minimum above the old maximum
+        collection.norm.autoscale(values)
+    if colorbar is not None:
+        colorbar.update_normal(collection)
+
+
+def get_output_dir():
+    '''
+    Returns the folder the graphs are saved in.
+    '''
+    return _context_dir.get() or _output_dir
+
+
+def set_output_dir(path):
+    '''
+    Changes the folder the graphs are saved in.
+    '''
+    global _output_dir
+    _output_dir = path
+
+
+@contextlib.contextmanager
+def graphs_in(path):
+    '''
+    Saves the graphs drawn in the with block in the path instead of the
+    graphs folder. Other threads keep saving in their own folder, while
+    code run in a copy of the block's context (like pipeline stages) saves
+    in the path too.
+    '''
+    token = _context_dir.set(path)
+    try:
+        yield path
+    finally:
+        _context_dir.reset(token)
+
+
+def set_processes(processes):
+    '''
+    Changes the number of processes used to render graphs. 1 turns off
+    the process pool.
+    '''
+    global PROCESSES
+    shutdown()
+    PROCESSES = processes
+
+
+def render_all(jobs, processes=None):
+    '''
+    Takes in a list of (function, args) jobs, each of which draws and saves
+    its own figure, and runs them on the process pool. Returns the list of
+    values returned by the jobs, in the same order.
+    '''
+    processes = PROCESSES if processes is None else processes
+    if processes == 1 or len(jobs) <= 1:
+        return [func(*args) for func, args in jobs]
+    pool = _get_pool(processes)
+    try:
+        futures = [pool.submit(_run_job, func, args, get_output_dir())
+                   for func, args in jobs]
+        return [future.result() for future in futures]
+    except BrokenProcessPool:
+        warnings.warn('the render pool stopped (is the script missing an '
+                      "if __name__ == '__main__' guard?), so graphs are "
+                      'rendered in this process from now on')
+        set_processes(1)
+        return [func(*args) for func, args in jobs]
+
+
+def shutdown():
+    '''
+    Stops the processes of the render pool if it was started.
+    '''
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def _get_pool(processes):
+    '''
+    Helper method for render_all. Starts the render pool the first time
+    it is needed and reuses it after that.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=_pool_context())
+    return _pool
+
+
+def _pool_context():
+    '''
+    Helper method for _get_pool. Returns the forkserver start method, or
+    spawn where there is no fork server (Windows).
+    '''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _run_job(func, args, output_dir):
+    '''
+    Helper method for render_all. Runs one job in a worker process, saving
+    into the same folder as the process that submitted it.
+    '''
+    global _output_dir
+    _output_dir = output_dir
+    return func(*args)
@@ -0,0 +1,242 @@
+import argparse
+import functools
+import json
+import os
+import threading
+import pandas as pd
+from flask import Flask, Response, request
+import admissions
+import cube
+import demographics
+import ingest
+# main's service entry point below shadows the module's name
+import main as project
+import model_store
+import race
+'''
+Local HTTP service for the state aggregates, diversity rankings and model
+predictions, so they can be queried without running main. The datasets are
+loaded once and every query result is kept in a least recently used cache.
+The race averages are answered from the aggregate cube of the racial rep
+dataset, and the admission rates from the racial rep dataset merged with
+the most recent cohorts dataset, like main's admissions plot.
+When a dataset file changes, the datasets are loaded again and the cache
+is cleared. Requests can be served on several threads, so loading the
+datasets, answering queries and clearing them on a change hold one lock.
+'''
+
+CACHE_SIZE = 256
+DIVERSITY_LIMIT = 10
+
+
+def create_app(paths=None, models_dir=model_store.MODELS_DIR, cache_size=CACHE_SIZE,
+               cache_dir=None):
+    '''
+    Returns the Flask app. paths can map the dataset names ('ipeds', 'race'
+    and 'recent') to other CSV files than the ingest defaults, and cache_dir
+    is the folder for their Parquet copies (the ingest cache by default).
+    '''
+    app = Flask(__name__)
+    paths = {name: (paths or {}).get(name, dataset['path'])
+             for name, dataset in ingest.DATASETS.items()}
+    state = {'fingerprint': None, 'data': {}, 'models': {}}
+    # reentrant, since a dataset can be built from other datasets
+    lock = threading.RLock()
+
+    def dataset(name):
+        '''
+        Returns the named dataset (or the 'cube' of the racial rep dataset,
+        or the 'institution_index' matching its institutions to the most
+        recent cohorts), loading it the first time it is needed.
+        '''
+        with lock:
+            if name not in state['data']:
+                state['data'][name] = load(name)
+            return state['data'][name]
+
+    def load(name):
+        '''
+        Helper method for dataset that loads the named dataset.
+        '''
+        if name == 'cube':
+            return cube.load_cube(paths['race'], cache_dir=cache_dir)
+        if name == 'institution_index':
+            return project.build_institution_index(dataset('race'), dataset('recent'))
+        return ingest.compact(ingest.read_dataset(name, path=paths[name], cache_dir=cache_dir))
+
+    @functools.lru_cache(maxsize=cache_size)
+    def query(name, params):
+        '''
+        Runs the named query with the (key, value) tuple of parameters and
+        returns its result as a JSON string.
+        '''
+        return QUERIES[name](dataset, **dict(params))
+
+    @app.before_request
+    def check_data():
+        # the results are out of date once a dataset file changes
+        # (not while a query is still using the old datasets)
+        with lock:
+            current = data_fingerprint(paths)
+            if current != state['fingerprint']:
+                state['fingerprint'] = current
+                state['data'] = {}
+                query.cache_clear()
+
+    def respond(name, params):
+        try:
+            with lock:
+                result = query(name, tuple(sorted(params.items())))
+        except (KeyError, ValueError) as error:
+            return Response(json.dumps({'error': str(error)}), status=400,
+                            mimetype='application/json')
+        return Response(result, mimetype='application/json')
+
+    @app.route('/race/averages')
+    def race_averages():
+        return respond('race_averages', {'year': request.args.get('year', type=int),
+                                         'metric': request.args.get('metric')})
+
+    @app.route('/gender')
+    def gender():
+        return respond('gender', {})
+
+    @app.route('/admissions')
+    def admission_rates():
+        return respond('admissions', {'year': request.args.get('year', project.YEAR, type=int)})
+
+    @app.route('/diversity')
+    def diversity():
+        return respond('diversity', {
+            'year': request.args.get('year', type=int),
+            'method': request.args.get('method', 'shannon'),
+            'limit': request.args.get('limit', DIVERSITY_LIMIT, type=int),
+            'lowest': request.args.get('order', 'highest') == 'lowest',
+        })
+
+    @app.route('/models/<name>/predict', methods=['POST'])
+    def predict(name):
+        # predictions depend on the posted rows, so they are not cached
+        path = model_store.model_path(name, models_dir)
+        if not os.path.exists(path):
+            return Response(json.dumps({'error': 'no saved model ' + name}),
+                            status=404, mimetype='application/json')
+        mtime = os.stat(path).st_mtime
+        with lock:
+            if name not in state['models'] or state['models'][name][0] != mtime:
+                state['models'][name] = (mtime, model_store.load_model(name, models_dir))
+            record = state['models'][name][1]
+        body = request.get_json(silent=True)
+        try:
+            rows = pd.DataFrame(body['rows'])
+        except (TypeError, KeyError, ValueError):
+            error = "the body must be JSON with the 'rows' to predict"
+            return Response(json.dumps({'error': error}), status=400,
+                            mimetype='application/json')
+        missing = [col for col in record['features'] if col not in rows.columns]
+        if missing:
+            return Response(json.dumps({'error': 'missing features ' + ', '.join(missing)}),
+                            status=400, mimetype='application/json')
+        predictions = model_store.predict_chunk(record, rows)
+        return Response(json.dumps({'predictions': _json_values(predictions)}),
+                        mimetype='application/json')
+
+    app.query_cache = query
+    return app
+
+
+def data_fingerprint(paths):
+    '''
+    Returns the modification time and size of every dataset file, which
+    changes whenever a dataset file is replaced or edited.
+    '''
+    fingerprint = []
+    for name in sorted(paths):
+        if os.path.exists(paths[name]):
+            stat = os.stat(paths[name])
+            fingerprint.append((name, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+def race_averages_query(dataset, year=None, metric=None):
+    '''
+    Returns the state averages of the race metrics for the year (all years
+    if None), only of one metric ('col_', 'mkt_' or 'dif_') if given.
+    '''
+    averages = cube.state_averages(dataset('cube'), None if year is None else [year])
+    if metric is not None:
+        if metric not in race.METRICS:
+            raise ValueError('unknown metric ' + metric)
+        averages = race.metric_averages(averages, metric)
+    return averages.rename_axis('state').reset_index().to_json(orient='records')
+
+
+def gender_query(dataset):
+    '''
+    Returns the average enrollment percentage of women and men per state.
+    '''
+    merged = demographics.filter_by_gender(dataset('ipeds'), testing=True)
+    return merged[['NAME', 'women', 'men']].to_json(orient='records')
+
+
+def admissions_query(dataset, year=project.YEAR):
+    '''
+    Returns the average admission rate per state of the institutions in the
+    racial rep dataset for the year, merged with the most recent cohorts
+    dataset the same way as for main's admissions plot.
+    '''
+    df_race = dataset('race')
+    df_merged = project.merge_race_recent(df_race[df_race['year'] == year],
+                                          dataset('recent'), dataset('institution_index'))
+    merged = admissions.admission_rate(df_merged, testing=True)
+    return merged[['NAME', 'ST_FIPS', 'ADM_RATE']].to_json(orient='records')
+
+
+def diversity_query(dataset, year=None, method='shannon', limit=DIVERSITY_LIMIT,
+                    lowest=False):
+    '''
+    Returns the institutions with the highest (or lowest) diversity index
+    for the year (all years if None).
+    '''
+    if method not in race.DIVERSITY_METHODS:
+        raise ValueError('unknown method ' + method)
+    df = dataset('race')
+    if year is not None:
+        df = df[df['year'] == year]
+    scored = race.calculate_racial_diversity_index(
+        df, method=method, columns=['year', 'fips_ipeds', 'inst_name']).dropna(subset=['index'])
+    ranked = scored.nsmallest(limit, 'index') if lowest else scored.nlargest(limit, 'index')
+    return ranked[['year', 'fips_ipeds', 'inst_name', 'index']].to_json(orient='records')
+
+
+QUERIES = {
+    'race_averages': race_averages_query,
+    'gender': gender_query,
+    'admissions': admissions_query,
+    'diversity': diversity_query,
+}
+
+
+def _json_values(series):
+    '''
+    Helper method that turns a series into a list for JSON, with missing
+    values as None.
+    '''
+    return [None if pd.isna(value) else getattr(value, 'item', lambda: value)()
+            for value in series]
+
+
+def main():
+    '''
+    Command line entry point that starts the service.
+    '''
+    parser = argparse.ArgumentParser(description='Serve the project aggregates over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--models-dir', default=model_store.MODELS_DIR)
+    args = parser.parse_args()
+    create_app(models_dir=args.models_dir).run(host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
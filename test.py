@@ -2,6 +2,30 @@ import demographics
 import machine_learning
 import race
 import admissions
+import cube
+import geometry
+import ingest
+import institutions
+import regression
+import rendering
+import service
+import model_store
+import peers
+import pipeline
+import benchmark
+import instrument
+import main
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from cse163_utils import assert_equals
 
@@ -16,20 +40,42 @@ def run_testing_methods(merged_df, race_df):
     Instantiates the test csv files
     Calls the tests methods for the different research questions/code groups
     '''
-    test_race_df = pd.read_csv('test_data/racial_test.csv')
-    # also used for tests which assumed that it was only one year
-    test_race_df2 = pd.read_csv('test_data/racial_test_diff_years.csv')
-    test_ipeds_df = pd.read_csv('test_data/ipeds_test.csv')
-    test_recent_df = pd.read_csv('test_data/recent_cohorts_test1.csv')
-    test_df_gender = pd.read_csv('test_data/gender_test.csv')
-    # calls on all of the testing methods
-    call_race_test(test_race_df,test_race_df2, test_ipeds_df)
-    test_race_tuition_correlation(test_ipeds_df)
-    test_filter_by_gender(test_ipeds_df)
-    test_in_out_state(test_ipeds_df)
-    test_plot_gender_barplot(test_df_gender)
-    test_admissions_plot(test_recent_df)
-    test_ml_data_prep(merged_df, race_df)
+    # the test plots are saved in a folder of their own, so they never
+    # replace the real graphs
+    with tempfile.TemporaryDirectory() as directory, rendering.graphs_in(directory):
+        test_race_df = pd.read_csv('test_data/racial_test.csv')
+        # also used for tests which assumed that it was only one year
+        test_race_df2 = pd.read_csv('test_data/racial_test_diff_years.csv')
+        test_ipeds_df = pd.read_csv('test_data/ipeds_test.csv')
+        test_recent_df = pd.read_csv('test_data/recent_cohorts_test1.csv')
+        test_df_gender = pd.read_csv('test_data/gender_test.csv')
+        # calls on all of the testing methods
+        call_race_test(test_race_df,test_race_df2, test_ipeds_df)
+        test_race_tuition_correlation(test_ipeds_df)
+        test_filter_by_gender(test_ipeds_df)
+        test_in_out_state(test_ipeds_df)
+        test_regression(test_ipeds_df)
+        test_plot_gender_barplot(test_df_gender)
+        test_admissions_plot(test_recent_df)
+        test_state_geometry()
+        test_read_dataset()
+        test_read_scorecard(test_recent_df)
+        test_compact(test_race_df, test_ipeds_df, test_recent_df)
+        test_institution_index(test_recent_df)
+        test_render_all(test_df_gender)
+        test_parallel_plot_stages()
+        test_year_stages()
+        test_render_maps()
+        test_service(test_race_df, test_recent_df)
+        test_pipeline()
+        test_benchmark()
+        test_instrument(test_race_df)
+        test_ml_data_prep(merged_df, race_df)
+        test_evaluate_models(race_df)
+        test_approximate_svm(merged_df)
+        test_cross_validation(race_df)
+        test_peers(race_df)
+        test_model_store(race_df)
 
 
 def test_filter_by_gender(df_ipeds_test):
@@ -61,17 +107,55 @@ def test_race_tuition_correlation(df):
     assert_equals(list(white_test), [46.0, 60.0, 76.0, 130.0, 180.0])
     black_test = demographics.plot_race_tuition(df, 'Black', 'red', True)
     assert_equals(list(black_test), [9.0, 7.5, 4.0, 22.5, 30.0])
+    # every race and the admission rate come from one narrow frame
+    columns = list(df.columns)
+    metrics = demographics.race_enrollment_metrics(df)
+    assert_equals(['Black_enrollment_count', 'Asian_enrollment_count',
+                   'Hispanic/Latino_enrollment_count', 'White_enrollment_count',
+                   'admission_rate'], list(metrics.columns))
+    assert_equals(list(white_test), list(metrics['White_enrollment_count']))
+    assert_equals([20.0, 75.0, 10.0, 7.143, 15.0], list(metrics['admission_rate']))
+    assert_equals(columns, list(df.columns))
 
 
 def test_in_out_state(df):
     '''
     Tests the organizations for the residency vs admissions rate correlation regplots.
     '''
+    columns = list(df.columns)
     df_admissions_residency = demographics.in_state_out_state(df, True)
+    # the IPEDS dataframe is not changed
+    assert_equals(columns, list(df.columns))
     assert_equals(list(df_admissions_residency['admission_rate']), [20.0, 75.0, 10.0, 7.143, 15.0])
     assert_equals(list(df_admissions_residency['Number of first-time undergraduates - in-state']), [400, 500, 200, 400, 700])
 
 
+def test_regression(df):
+    '''
+    Tests that the lines fitted together match fitting each pair on its own,
+    that missing values are left out and that the confidence band is centered
+    on the line.
+    '''
+    df = demographics.in_state_out_state(df, True)
+    df.loc[0, 'Number of first-time undergraduates - foreign countries'] = None
+    fits = regression.fit_lines(df, [('admission_rate', col)
+                                     for col in demographics.RESIDENCY])
+    assert_equals([5, 5, 4], list(fits['n']))
+    in_state = df['Number of first-time undergraduates - in-state']
+    slope, intercept = np.polyfit(df['admission_rate'], in_state, 1)
+    assert_equals([float(slope), float(intercept)],
+                  [fits['slope'][0], fits['intercept'][0]])
+    assert_equals(float(df['admission_rate'].corr(in_state)), fits['pearson'][0])
+    assert_equals(float(df['admission_rate'].corr(in_state, method='spearman')),
+                  fits['spearman'][0])
+    foreign = df.dropna()
+    assert_equals(float(foreign['admission_rate'].corr(foreign[demographics.RESIDENCY[2]])),
+                  fits['pearson'][2])
+    y, lower, upper = regression.confidence_band(fits.iloc[0], [fits['x_mean'][0], 50])
+    assert_equals(y.tolist(), ((lower + upper) / 2).tolist())
+    assert_equals(True, upper[0] - lower[0] < upper[1] - lower[1])
+
+
 def test_admissions_plot(df):
     '''
     Tests the admission plot's average groupby part.
@@ -81,15 +165,521 @@ def test_admissions_plot(df):
     assert_equals(list(admission_df['ADM_RATE']), [0.85, 0.605])
 
 
+def test_state_geometry():
+    '''
+    Tests that the state shapes are only loaded once and that every
+    caller gets its own copy of them.
+    '''
+    usa = geometry.load_states()
+    usa['STATE'] = usa['STATE'].astype(int)
+    usa2 = geometry.load_states()
+    assert_equals(False, usa is usa2)
+    assert_equals(list(usa['NAME']), list(usa2['NAME']))
+    assert_equals(str, type(usa2['STATE'].iloc[0]))
+    simplified = geometry.load_states(simplify=0.05)
+    assert_equals(list(usa2['GEO_ID']), list(simplified['GEO_ID']))
+
+
+def test_read_dataset():
+    '''
+    Tests that the cached dataset has the same values as the CSV file,
+    only loads the requested columns that exist, and is not shared with a
+    CSV file of the same name in another folder.
+    '''
+    path = 'test_data/ipeds_test.csv'
+    columns = ['FIPS state code', 'Total  enrollment', 'Not a column']
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = os.path.join(directory, 'cache')
+        df = ingest.read_dataset('ipeds', columns, path, cache_dir)
+        # reads it a second time from the cache
+        df_cached = ingest.read_dataset('ipeds', columns, path, cache_dir)
+        # a different file with the same name and size
+        other_path = os.path.join(directory, 'ipeds_test.csv')
+        df_other = pd.read_csv(path)
+        df_other['Total  enrollment'] = df_other['Total  enrollment'][::-1].to_numpy()
+        df_other.to_csv(other_path, index=False)
+        os.utime(other_path, (os.stat(path).st_atime, os.stat(path).st_mtime))
+        df_other_cached = ingest.read_dataset('ipeds', columns, other_path, cache_dir)
+    assert_equals(['FIPS state code', 'Total  enrollment'], list(df_cached.columns))
+    assert_equals(list(pd.read_csv(path)['Total  enrollment']),
+                  list(df['Total  enrollment']))
+    assert_equals(list(df['FIPS state code']), list(df_cached['FIPS state code']))
+    assert_equals('float64', str(df_cached['Total  enrollment'].dtype))
+    assert_equals(df_other['Total  enrollment'].tolist(),
+                  df_other_cached['Total  enrollment'].tolist())
+
+
+def test_compact(race_df, ipeds_df, recent_df):
+    '''
+    Tests that compacted dataframes use less memory and give the same
+    results in the race, demographics and admissions methods.
+    '''
+    race_compact = ingest.compact(race_df)
+    ipeds_compact = ingest.compact(ipeds_df)
+    recent_compact = ingest.compact(recent_df)
+    assert_equals('category', str(race_compact['fips_ipeds'].dtype))
+    assert_equals('int16', str(race_compact['total_enrollment'].dtype))
+    assert_equals('category', str(ipeds_compact['Sector of institution'].dtype))
+    assert_equals('float32', str(recent_compact['ADM_RATE'].dtype))
+    assert_equals(True, ingest.memory_mb(race_compact) < ingest.memory_mb(race_df))
+    assert_equals(True, ingest.memory_mb(ipeds_compact) < ingest.memory_mb(ipeds_df))
+    averages = race.state_race_averages(race_df)
+    averages_compact = race.state_race_averages(race_compact)
+    assert_equals(list(averages.index), list(averages_compact.index))
+    assert_equals(averages['col_minority'].tolist(), averages_compact['col_minority'].tolist())
+    geo = race.race_percent_geoplot(race_df, True)
+    geo_compact = race.race_percent_geoplot(race_compact, True)
+    assert_equals(list(geo['NAME']), list(geo_compact['NAME']))
+    assert_equals(geo['white'].tolist(), geo_compact['white'].tolist())
+    gender = demographics.filter_by_gender(ipeds_df, True)
+    gender_compact = demographics.filter_by_gender(ipeds_compact, True)
+    assert_equals(list(gender['NAME']), list(gender_compact['NAME']))
+    assert_equals(gender['women'].tolist(), gender_compact['women'].tolist())
+    admission = admissions.admission_rate(recent_df)
+    admission_compact = admissions.admission_rate(recent_compact)
+    assert_equals(list(admission['STATE']), list(admission_compact['STATE']))
+    assert_equals(admission['ADM_RATE'].tolist(), admission_compact['ADM_RATE'].tolist())
+
+
+def test_read_scorecard(df_recent):
+    '''
+    Tests that suppressed Scorecard values are read as missing values
+    and only the requested columns are kept.
+    '''
+    df_recent = df_recent.astype({'FIRST_GEN': object})
+    df_recent.loc[1, 'FIRST_GEN'] = 'PrivacySuppressed'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'scorecard.csv')
+        df_recent.to_csv(path, index=False)
+        df = ingest.read_scorecard(path, ['INSTNM', 'FIRST_GEN', 'SAT_AVG'], chunksize=3)
+    assert_equals(['INSTNM', 'FIRST_GEN', 'SAT_AVG'], list(df.columns))
+    assert_equals('float64', str(df['FIRST_GEN'].dtype))
+    assert_equals([False, True, False, False], list(df['FIRST_GEN'].isna()))
+    assert_equals([1000.0, 1200.0, 1000.0, 1006.0], list(df['SAT_AVG']))
+
+
+def test_institution_index(df_recent):
+    '''
+    Tests that institution names are matched despite differences in case,
+    punctuation and typos, that typos are only matched within a state and
+    that the key merge keeps every racial rep row.
+    '''
+    df_race = pd.DataFrame({'inst_name': ['ALABAMA A&M UNIVERSITY',
+                                          'University of Alabama at Birmingham.',
+                                          'California State Univ - Los Angeles',
+                                          'Califrnia State University-Northridge',
+                                          'Unknown College'],
+                            'fips_ipeds': ['Alabama', 'Alabama', 'California',
+                                           'California', 'Alabama'],
+                            'year': [2017, 2017, 2017, 2017, 2017]})
+    index = institutions.build_index(df_race['inst_name'], df_recent['INSTNM'],
+                                     fuzzy_cutoff=institutions.FUZZY_CUTOFF,
+                                     race_states=df_race['fips_ipeds'],
+                                     scorecard_states=df_recent['ST_FIPS'])
+    assert_equals(list(index['scorecard']), list(index['race'][:4]))
+    assert_equals(True, index['race'].iloc[4] not in list(index['scorecard']))
+    assert_equals([('Califrnia State University-Northridge',
+                    'California State University-Northridge')],
+                  list(zip(index['fuzzy']['name'], index['fuzzy']['scorecard_name'])))
+    merged = institutions.merge_on_keys(df_race, df_recent, index)
+    assert_equals(list(df_race['inst_name']), list(merged['inst_name']))
+    assert_equals([1000.0, 1200.0, 1000.0, 1006.0], list(merged['SAT_AVG'][:4]))
+    assert_equals(True, pd.isna(merged['SAT_AVG'][4]))
+    # without the fuzzy match the misspelled name is not matched
+    index = institutions.build_index(df_race['inst_name'], df_recent['INSTNM'])
+    assert_equals(False, index['race'].iloc[3] == index['scorecard'].iloc[3])
+    # similar names of different schools, or in another state, are not matched
+    df_other = pd.DataFrame({'inst_name': ['Saint Johns University',
+                                           'Califrnia State University-Northridge'],
+                             'fips_ipeds': ['New York', 'Washington']})
+    df_scorecard = pd.DataFrame({'INSTNM': ['Saint Josephs University',
+                                            'California State University-Northridge'],
+                                 'ST_FIPS': [36.0, 6.0]})
+    index = institutions.build_index(df_other['inst_name'], df_scorecard['INSTNM'],
+                                     fuzzy_cutoff=institutions.FUZZY_CUTOFF,
+                                     race_states=df_other['fips_ipeds'],
+                                     scorecard_states=df_scorecard['ST_FIPS'])
+    assert_equals(0, len(index['fuzzy']))
+    assert_equals(False, any(index['race'].isin(index['scorecard'])))
+
+
+def test_render_all(df_gender):
+    '''
+    Tests that the render pool returns the results of the jobs in order.
+    '''
+    results = rendering.render_all([(len, ([1, 2],)),
+                                    (demographics.plot_gender_barplot, (df_gender,))],
+                                   processes=2)
+    assert_equals(2, results[0])
+    assert_equals([0.2, 0.4, 1.0, 0.8, -1.0, -0.8, -1.0, -0.4, -0.4],
+                  list(results[1]['difference']))
+    # a script without a __main__ guard still renders its graphs, in its own process
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, 'no_guard.py')
+        with open(script, 'w') as f:
+            f.write('import sys\n'
+                    'sys.path.insert(0, ' + repr(os.path.dirname(os.path.abspath(__file__))) +
+                    ')\n'
+                    'import rendering\n'
+                    'rendering.set_output_dir(' + repr(directory) + ')\n'
+                    'print(rendering.render_all([(len, ([1],)), (len, ([1, 2],))], '
+                    'processes=2))\n')
+        result = subprocess.run([sys.executable, script], capture_output=True, text=True,
+                                cwd=directory, timeout=120)
+    assert_equals('[1, 2]', result.stdout.strip())
+
+
+def _test_ipeds():
+    '''
+    Stage for test_parallel_plot_stages.
+    '''
+    return pd.read_csv('test_data/ipeds_test.csv')
+
+
+def _test_race():
+    '''
+    Stage for test_parallel_plot_stages.
+    '''
+    return pd.read_csv('test_data/racial_test_diff_years.csv')
+
+
+def test_parallel_plot_stages():
+    '''
+    Tests that plot stages running on several threads can start the render
+    pool and save their graphs without hanging.
+    '''
+    # the pool has to be started by the stage threads themselves
+    rendering.shutdown()
+    stages = [pipeline.stage('ipeds', _test_ipeds),
+              pipeline.stage('race', _test_race),
+              pipeline.stage('gender', demographics.filter_by_gender, ['ipeds']),
+              pipeline.stage('tuition', demographics.race_tuition_enrollment_correlation,
+                             ['ipeds']),
+              pipeline.stage('time_series', race.race_percent_time_bar, ['race'])]
+    with tempfile.TemporaryDirectory() as directory:
+        # the stages save in the graphs folder of the thread that runs the pipeline
+        with rendering.graphs_in(os.path.join(directory, 'graphs')):
+            report = pipeline.run_pipeline(stages, cache_dir=os.path.join(directory, 'stages'),
+                                           force=True, workers=4)
+        assert_equals(['ran'] * 5, [status for name, status, seconds in report])
+        graphs = os.listdir(os.path.join(directory, 'graphs'))
+    assert_equals(True, 'race_percent_over_time.png' in graphs)
+    assert_equals(True, 'race_count_over_time.png' in graphs)
+
+
+def _test_race_years():
+    '''
+    Stage for test_year_stages: racial rep rows from 2016 and 2017.
+    '''
+    return benchmark.synthetic_race(20, years=[2016, 2017])
+
+
+def _test_race_year(df, year):
+    '''
+    Stage for test_year_stages that keeps the rows of one year.
+    '''
+    return df[df['year'] == year].reset_index(drop=True)
+
+
+def test_year_stages():
+    '''
+    Tests that the single year race plots run for several years at the same
+    time, each saving its graphs in its own folder.
+    '''
+    names = [s['name'] for s in main.build_stages(2017, years=[2016, 2017])]
+    assert_equals(True, 'load_race_year_2016' in names)
+    assert_equals(False, 'load_race_year_2017' in names)
+    assert_equals(True, 'race_maps_2017' in names)
+    # the dataset loads are replaced by the test rows
+    stages = [pipeline.stage('race_rows', _test_race_years),
+              pipeline.stage('load_race_cube', 'cube:partials', ['race_rows']),
+              pipeline.stage('load_race_year', _test_race_year, ['race_rows'],
+                             params={'year': 2017}),
+              pipeline.stage('load_race_year_2016', _test_race_year, ['race_rows'],
+                             params={'year': 2016})]
+    stages += [s for s in main.year_stages([2016, 2017], 2017)
+               if not s['name'].startswith('load_')]
+    with tempfile.TemporaryDirectory() as directory:
+        # the stages save in the graphs folder of the thread that runs the pipeline
+        with rendering.graphs_in(os.path.join(directory, 'graphs')):
+            report = pipeline.run_pipeline(stages, cache_dir=os.path.join(directory, 'stages'),
+                                           force=True, workers=4)
+        assert_equals(['ran'] * len(stages), [status for name, status, seconds in report])
+        assert_equals(['2016', '2017'], sorted(os.listdir(os.path.join(directory, 'graphs'))))
+        for year in ['2016', '2017']:
+            graphs = os.listdir(os.path.join(directory, 'graphs', year))
+            assert_equals(True, 'top_and_worst.png' in graphs)
+            assert_equals(True, 'state_race_white.png' in graphs)
+
+
+def test_render_maps():
+    '''
+    Tests that recoloring a choropleth changes the colors and color range
+    without adding shapes, and that every map is saved.
+    '''
+    states = geometry.load_states()
+    states['value'] = range(len(states))
+    states['missing'] = [None] + list(range(1, len(states)))
+    fig, ax = rendering.new_figure()
+    collection, colorbar = rendering.choropleth(ax, rendering.state_paths(states))
+    rendering.set_map_values(collection, colorbar, states['value'])
+    assert_equals((0, len(states) - 1), collection.get_clim())
+    rendering.set_map_values(collection, colorbar, states['missing'])
+    assert_equals((1, len(states) - 1), collection.get_clim())
+    # the colorbar follows a range entirely above the old one
+    rendering.set_map_values(collection, colorbar, states['value'] + 100)
+    assert_equals((100, 100 + len(states) - 1), (colorbar.vmin, colorbar.vmax))
+    rendering.set_map_values(collection, colorbar, states['missing'])
+    assert_equals([True] + [False] * (len(states) - 1),
+                  list(np.ma.getmaskarray(collection.get_array())))
+    assert_equals(1, len(ax.collections))
+    with tempfile.TemporaryDirectory() as directory:
+        with rendering.graphs_in(directory):
+            rendering.render_maps(states, [('value', 'Value', 'value.png'),
+                                           ('missing', 'Missing', 'missing.png')])
+        assert_equals(['missing.png', 'value.png'], sorted(os.listdir(directory)))
+
+
+def test_service(race_df, recent_df):
+    '''
+    Tests that the service answers from the cache until a dataset file
+    changes, that its results match the methods it calls, and that bad
+    prediction requests are answered with errors.
+    '''
+    # the first four institutions are in the most recent cohorts dataset
+    race_df = race_df.drop(columns='selective')
+    race_df['inst_name'] = list(recent_df['INSTNM'][:4]) + list(race_df['inst_name'][4:])
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {'race': os.path.join(directory, 'service_race.csv'),
+                 'ipeds': 'test_data/ipeds_test.csv',
+                 'recent': 'test_data/recent_cohorts_test1.csv'}
+        race_df.to_csv(paths['race'], index=False)
+        app = service.create_app(paths, models_dir=directory,
+                                 cache_dir=os.path.join(directory, 'cache'))
+        client = app.test_client()
+        averages = client.get('/race/averages?year=2017&metric=col_').get_json()
+        assert_equals([140/3, 130/3], [row['white'] for row in averages])
+        client.get('/race/averages?year=2017&metric=col_')
+        assert_equals(1, app.query_cache.cache_info().hits)
+        assert_equals(400, client.get('/race/averages?metric=abc').status_code)
+        ranking = client.get('/diversity?limit=2&order=lowest').get_json()
+        scored = race.calculate_racial_diversity_index(race_df)
+        assert_equals(list(scored.nsmallest(2, 'index')['inst_name']),
+                      [row['inst_name'] for row in ranking])
+        # only the racial rep institutions of the year are averaged, like main's plot
+        assert_equals([0.85, 0.605],
+                      [row['ADM_RATE'] for row in client.get('/admissions').get_json()])
+        assert_equals([], client.get('/admissions?year=2016').get_json())
+        assert_equals([52.5, 90, 32.5],
+                      [row['women'] for row in client.get('/gender').get_json()])
+        # changing the file clears the cache and loads the dataset again
+        race_df.head(2).to_csv(paths['race'], index=False)
+        averages = client.get('/race/averages?year=2017&metric=col_').get_json()
+        assert_equals(0, app.query_cache.cache_info().hits)
+        assert_equals(1, len(averages))
+        assert_equals(404, client.post('/models/none/predict', json={'rows': []}).status_code)
+        X = recent_df[['FAMINC', 'FIRST_GEN']]
+        model = machine_learning.race_selectivity_models()['Decision Tree']
+        model.fit(X, recent_df['ST_FIPS'])
+        model_store.save_model('Service Tree', model, X, directory=directory)
+        rows = [{'FAMINC': 32362, 'FIRST_GEN': 0.4}, {'FAMINC': None, 'FIRST_GEN': 0.3}]
+        response = client.post('/models/service_tree/predict', json={'rows': rows})
+        assert_equals([1.0, None], response.get_json()['predictions'])
+        assert_equals(400, client.post('/models/service_tree/predict', json={}).status_code)
+        assert_equals(400, client.post('/models/service_tree/predict', data='rows').status_code)
+        # cold requests on several threads share one load of the datasets
+        app = service.create_app(paths, models_dir=directory,
+                                 cache_dir=os.path.join(directory, 'cache'))
+        urls = ['/race/averages?year=2017', '/diversity', '/admissions', '/gender'] * 2
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            statuses = list(pool.map(lambda url: app.test_client().get(url).status_code, urls))
+        assert_equals([200] * len(urls), statuses)
+        assert_equals(4, app.query_cache.cache_info().hits)
+
+
+def _numbers():
+    '''
+    Stage for test_pipeline.
+    '''
+    return [1, 2, 3]
+
+
+def _double(values, factor=2):
+    '''
+    Stage for test_pipeline.
+    '''
+    return [value * factor for value in values]
+
+
+def _count(values):
+    '''
+    Stage for test_pipeline.
+    '''
+    return len(values)
+
+
+def _fail(values):
+    '''
+    Stage for test_pipeline that always fails.
+    '''
+    raise ValueError('stage failed')
+
+
+def _write_file(path):
+    '''
+    Stage for test_pipeline that writes a file, like a plot stage.
+    '''
+    with open(path, 'w') as f:
+        f.write('graph')
+
+
+def test_pipeline():
+    '''
+    Tests that stages only run again when their inputs or parameters change
+    or their output files are missing, that failures only block the stages that depend on them and that
+    prefetched outputs are used.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        stages = [pipeline.stage('numbers', _numbers, cache=False),
+                  pipeline.stage('double', _double, ['numbers']),
+                  pipeline.stage('count', _count, ['double'])]
+        first = pipeline.run_pipeline(stages, cache_dir=directory)
+        assert_equals(['ran', 'ran', 'ran'], [status for name, status, seconds in first])
+        assert_equals([], pipeline.pending_stages(stages, cache_dir=directory))
+        second = pipeline.run_pipeline(stages, cache_dir=directory)
+        assert_equals(['skipped'] * 3, [status for name, status, seconds in second])
+        stages[1] = pipeline.stage('double', _double, ['numbers'], {'factor': 3})
+        # the uncached numbers stage runs again because double needs it
+        assert_equals(['numbers', 'double', 'count'],
+                      pipeline.pending_stages(stages, cache_dir=directory))
+        third = pipeline.run_pipeline(stages, ['double'], cache_dir=directory)
+        assert_equals([('numbers', 'skipped'), ('double', 'ran')],
+                      [(name, status) for name, status, seconds in third])
+        assert_equals([3, 6, 9], pipeline.load_result('double', directory))
+        # stages and code modules can also be given by name
+        stages[2] = pipeline.stage('count', 'test:_count', ['double'], code=['pipeline'])
+        fourth = pipeline.run_pipeline(stages, ['count'], cache_dir=directory)
+        assert_equals('ran', fourth[-1][1])
+        assert_equals(3, pipeline.load_result('count', directory))
+        fifth = pipeline.run_pipeline(stages, ['count'], cache_dir=directory)
+        assert_equals('skipped', fifth[-1][1])
+        # a failed stage blocks the stages that need it but not the others
+        stages += [pipeline.stage('fail', _fail, ['numbers']),
+                   pipeline.stage('after_fail', _count, ['fail'])]
+        with contextlib.redirect_stderr(io.StringIO()) as errors:
+            sixth = pipeline.run_pipeline(stages, cache_dir=directory, force=True, workers=2)
+        assert_equals(True, 'stage failed' in errors.getvalue())
+        assert_equals([('numbers', 'ran'), ('double', 'ran'), ('count', 'ran'),
+                       ('fail', 'failed'), ('after_fail', 'blocked')],
+                      [(name, status) for name, status, seconds in sixth])
+        path, seconds = pipeline.critical_path(stages, sixth)
+        assert_equals('numbers', path[0])
+        assert_equals(float(sum(secs for name, status, secs in sixth if name in path)), seconds)
+        # prefetched stages use the output of their future
+        loads = ingest.load_in_background({'numbers': lambda: [4, 5]})
+        pipeline.run_pipeline(stages, ['double'], cache_dir=directory, force=True,
+                              prefetched=loads)
+        assert_equals([12, 15], pipeline.load_result('double', directory))
+        # a stage whose output file was deleted runs again
+        graph = os.path.join(directory, 'graph.png')
+        writes = [pipeline.stage('write', _write_file, params={'path': graph},
+                                 outputs=[graph])]
+        pipeline.run_pipeline(writes, cache_dir=directory)
+        assert_equals([], pipeline.pending_stages(writes, cache_dir=directory))
+        os.remove(graph)
+        assert_equals(['write'], pipeline.pending_stages(writes, cache_dir=directory))
+        assert_equals('ran', pipeline.run_pipeline(writes, cache_dir=directory)[0][1])
+        assert_equals(True, os.path.exists(graph))
+
+
+def test_benchmark():
+    '''
+    Tests that the synthetic datasets have the columns of the dataset schemas
+    and that slower benchmark results are found when comparing results.
+    '''
+    df_race = benchmark.synthetic_race(20, years=[2016, 2017])
+    assert_equals(40, len(df_race))
+    assert_equals(sorted(ingest.RACE_SCHEMA), sorted(df_race.columns))
+    assert_equals(sorted(ingest.IPEDS_SCHEMA),
+                  sorted(benchmark.synthetic_ipeds(20).columns))
+    assert_equals(sorted(ingest.RECENT_SCHEMA),
+                  sorted(benchmark.synthetic_scorecard(20).columns))
+    old = {'results': [{'function': 'race.a', 'rows': 10, 'seconds': 1.0},
+                       {'function': 'race.b', 'rows': 10, 'seconds': 1.0}]}
+    new = {'results': [{'function': 'race.a', 'rows': 10, 'seconds': 1.1},
+                       {'function': 'race.b', 'rows': 10, 'seconds': 2.0}]}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for name, results in [('old.json', old), ('new.json', new)]:
+            paths.append(os.path.join(directory, name))
+            with open(paths[-1], 'w') as f:
+                json.dump(results, f)
+        regressions = benchmark.compare_results(paths[0], paths[1], 1.2)
+    assert_equals([('race.b', 10, 1.0, 2.0)], regressions)
+
+
+def test_instrument(race_df):
+    '''
+    Tests that stages and wrapped functions are recorded in the run report
+    only while recording is enabled, and that profiled calls can be nested
+    or run at the same time.
+    '''
+    averages = instrument.wrap_function(race.state_race_averages)
+    averages(race_df)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'report.json')
+        instrument.enable(path, profile=['race.state_race_averages', 'averages',
+                                         'numbers', 'other_numbers'])
+        try:
+            with instrument.measure('averages') as record:
+                record['rows_out'] = len(averages(race_df))
+            stages = [pipeline.stage('numbers', _numbers),
+                      pipeline.stage('other_numbers', _numbers)]
+            report = pipeline.run_pipeline(stages, cache_dir=os.path.join(directory, 'stages'),
+                                           workers=2)
+            instrument.write_report()
+        finally:
+            instrument.disable()
+        with open(path) as f:
+            records = json.load(f)['records']
+        # the nested call is part of the outer call's profile
+        assert_equals(False, 'profile_path' in records[0])
+        assert_equals(True, os.path.exists(records[1]['profile_path']))
+    assert_equals(['ran', 'ran'], [status for name, status, seconds in report])
+    assert_equals(False, tracemalloc.is_tracing())
+    assert_equals(['race.state_race_averages', 'averages'],
+                  [record['name'] for record in records[:2]])
+    assert_equals([6, None], [record['rows_in'] for record in records[:2]])
+    assert_equals([2, 2], [record['rows_out'] for record in records[:2]])
+    assert_equals(True, records[1]['wall_seconds'] >= records[0]['wall_seconds'])
+    assert_equals(True, all('traced_peak_mb' in record and 'rss_delta_mb' in record
+                            for record in records))
+    # the peak counts memory that was freed before the call ended
+    instrument.enable(path)
+    try:
+        with instrument.measure('allocate') as record:
+            values = np.ones(2 ** 24)
+            time.sleep(0.1)
+            del values
+    finally:
+        instrument.disable()
+    # 128 MB were allocated and freed again
+    assert_equals(True, record['peak_rss_mb'] > instrument._rss_mb() + 64)
+    assert_equals(True, record['rss_delta_mb'] < 64)
+
+
 def call_race_test(test_race_df,test_race_df2, test_ipeds_df):
     '''
     Calls all the methods for testing the different race research
     question methods.
     '''
     test_race_percent_geoplots(test_race_df, test_race_df2)
+    test_state_race_averages(test_race_df)
     test_race_market_diff_geoplots(test_race_df)
     test_racial_index(test_race_df,test_race_df2)
+    test_race_year_partitions(test_race_df)
     test_year_averages(test_race_df,test_race_df2)
+    test_cube(test_race_df, test_race_df2)
 
 
 def test_race_percent_geoplots(race_df, race_df2):
@@ -110,6 +700,21 @@ def test_race_percent_geoplots(race_df, race_df2):
     assert_equals(list(avg_race_df['GEO_ID']), ['0400000US06', '0400000US53'])
 
 
+def test_state_race_averages(race_df):
+    '''
+    Tests that the single groupby finds the same averages as the
+    geoplot methods and adds the minority columns.
+    '''
+    averages = race.state_race_averages(race_df)
+    # no mkt_ columns in the test data
+    assert_equals(False, any(col.startswith('mkt_') for col in averages.columns))
+    assert_equals(list(averages['col_hispanic']), [20, 80/3])
+    assert_equals(list(averages['col_minority']), [161/3, 170/3])
+    assert_equals(list(averages['dif_white']), [1, 2])
+    avg_race_df = race.race_percent_geoplot(race_df, True, averages)
+    assert_equals(list(avg_race_df['black']), [70/3, 20])
+
+
 def test_race_market_diff_geoplots(race_df):
     '''
     Tests the plots for the market different per state.
@@ -133,6 +738,19 @@ def test_racial_index(race_df1, race_df2):
     race_div_df2 = race.calculate_racial_diversity_index(race_df2)
     assert_equals(list(race_div_df1['index']), [0.668461, 0.668461, 0.727708, 0.576832, 0.668461, 0.727708])
     assert_equals(list(race_div_df2['index']), [0.6437752, 0.576832, 0.6684612, 0.6684612, 0.727708, 0.727708])
+    # percentages are left as they were
+    assert_equals(list(race_df1['col_white']), list(race_div_df1['col_white']))
+    # only the given columns are kept
+    scored = race.calculate_racial_diversity_index(race_df1, columns=['inst_name'])
+    assert_equals(['inst_name', 'index'], list(scored.columns))
+    assert_equals(list(race_div_df1['index']), list(scored['index']))
+    # scoring in chunks gives the same result
+    chunked = race.diversity_index(race_df2, chunksize=4)
+    assert_equals(list(race_div_df2['index']), list(chunked))
+    simpson = race.diversity_index(race_df1, method='simpson')
+    assert_equals([0.29, 0.29], list(simpson[:2]))
+    gini = race.diversity_index(race_df1, ['white', 'black'], 'gini_simpson')
+    assert_equals([0.71, 0.71], list(gini[:2]))
 
 
 def test_ml_data_prep(merged_df, race_df):
@@ -148,8 +766,188 @@ def test_ml_data_prep(merged_df, race_df):
     # checks length
     assert_equals(list(X1_test.columns), list(X1_test))
     assert_equals(list(X2_test.columns), list(X2_test))
+    # suppressed values are dropped, so every input column is numeric
+    assert_equals(True, all(pd.api.types.is_numeric_dtype(dtype)
+                            for dtype in X2_train.dtypes))
     
    
+def test_evaluate_models(race_df):
+    '''
+    Makes sure that fitting every model once in the evaluation table gives
+    the same scores as fitting the models one at a time.
+    '''
+    X_train, X_test, y_train, y_test = machine_learning.race_selectivity_data_prep(race_df)
+    results = machine_learning.run_race_selectivity_ml_models(X_train, X_test,
+                                                              y_train, y_test)
+    assert_equals(['Decision Tree', 'Random Forest', 'K-Nearest Neighbors'],
+                  list(results.index))
+    forest = machine_learning.race_selectivity_random_forest(X_train, X_test,
+                                                             y_train, y_test)
+    assert_equals(forest, list(results.loc['Random Forest', ['test_score', 'train_score']]))
+
+
+def test_approximate_svm(merged_df):
+    '''
+    Makes sure the exact and approximate SVMs can be picked on their own or
+    together, and that the approximate SVM scores the same in the table as
+    when it is fit on its own.
+    '''
+    assert_equals(['Decision Tree', 'Random Forest', 'SVM'],
+                  list(machine_learning.socio_SAT_models('exact')))
+    assert_equals(['Decision Tree', 'Random Forest', 'Approximate SVM'],
+                  list(machine_learning.socio_SAT_models('approximate')))
+    X_train, X_test, y_train, y_test = machine_learning.socio_and_SAT_data_prep(merged_df)
+    results = machine_learning.run_socio_and_SAT_data_ml_models(X_train, X_test,
+                                                                y_train, y_test)
+    assert_equals(['Decision Tree', 'Random Forest', 'SVM', 'Approximate SVM'],
+                  list(results.index))
+    approximate = machine_learning.socio_SAT_approximate_svm(X_train, X_test,
+                                                             y_train, y_test)
+    assert_equals(approximate,
+                  list(results.loc['Approximate SVM', ['test_score', 'train_score']]))
+
+
+def test_cross_validation(race_df):
+    '''
+    Makes sure every model is scored on every fold and that the summary is
+    the mean of the fold scores, whether the folds run in parallel or not.
+    '''
+    summary, folds = machine_learning.run_race_selectivity_cv(race_df, folds=3)
+    assert_equals(['Decision Tree', 'Random Forest', 'K-Nearest Neighbors'],
+                  list(summary.index))
+    assert_equals([0, 1, 2] * 3, list(folds['fold']))
+    forest = folds[folds['model'] == 'Random Forest']
+    assert_equals(float(forest['test_score'].mean()),
+                  summary.loc['Random Forest', 'test_mean'])
+    summary_serial, folds_serial = machine_learning.run_race_selectivity_cv(
+        race_df, folds=3, n_jobs=1)
+    # the decision tree has no random_state, so only the other models are compared
+    seeded = folds['model'] != 'Decision Tree'
+    assert_equals(list(folds.loc[seeded, 'test_score']),
+                  list(folds_serial.loc[seeded, 'test_score']))
+
+
+def test_peers(race_df):
+    '''
+    Makes sure the peer index finds the same nearest institutions as
+    comparing every pair, with and without a state filter.
+    '''
+    df = race_df.dropna(subset=peers.COMPOSITION).reset_index(drop=True)
+    index = peers.build_index(df)
+    values = df[peers.COMPOSITION].to_numpy(dtype=float)
+    points = (values - values.mean(axis=0)) / values.std(axis=0)
+    distances = ((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2) ** 0.5
+    found = peers.find_peers(index, df.head(3), k=4)
+    assert_equals([1, 2, 3, 4] * 3, list(found['rank']))
+    for row in range(3):
+        expected = np.sort(distances[row])[:4]
+        assert_equals(expected.tolist(), found.loc[found['query'] == row, 'distance'].tolist())
+    # an institution is never its own peer
+    name = df['inst_name'].iloc[0]
+    own = peers.peers_of(index, [name], k=3)
+    assert_equals(3, len(own))
+    assert_equals(False, bool((own['distance'] == 0).all()))
+    # a query missing a percentage has no peers, and the other queries still do
+    queries = df.head(3).copy()
+    queries.loc[1, 'col_black'] = np.nan
+    partial = peers.find_peers(index, queries, k=4)
+    assert_equals([0] * 4 + [2] * 4, list(partial['query']))
+    assert_equals(found.loc[found['query'] == 2, 'distance'].tolist(),
+                  partial.loc[partial['query'] == 2, 'distance'].tolist())
+    state = df['fips_ipeds'].iloc[0]
+    in_state = peers.find_peers(index, df.head(1), k=2, state=state)
+    assert_equals([state, state], list(in_state['fips_ipeds']))
+    with tempfile.TemporaryDirectory() as directory:
+        saved = peers.load_index(df, directory=directory)
+        loaded = peers.load_index(df, directory=directory)
+        assert_equals(1, len(os.listdir(directory)))
+        assert_equals(saved['points'].tolist(), loaded['points'].tolist())
+
+
+def test_model_store(race_df):
+    '''
+    Tests that a saved model scores a file in chunks the same way as
+    the fitted model it was saved from.
+    '''
+    X_train, X_test, y_train, y_test = machine_learning.race_selectivity_data_prep(race_df)
+    model = machine_learning.fit_and_score(
+        machine_learning.race_selectivity_models()['Random Forest'],
+        X_train, X_test, y_train, y_test, machine_learning.accuracy_score)['model']
+    with tempfile.TemporaryDirectory() as directory:
+        model_store.save_model('Test Forest', model, X_train, y_train,
+                               {'accuracy': 1.0}, directory)
+        record = model_store.load_model('Test Forest', directory)
+        assert_equals(list(X_train.columns), record['features'])
+        assert_equals(model_store.fingerprint(X_train, y_train), record['fingerprint'])
+        input_path = os.path.join(directory, 'input.csv')
+        output_path = os.path.join(directory, 'output.csv')
+        # columns in a different order than the model was trained with
+        X_test[X_test.columns[::-1]].to_csv(input_path, index=False)
+        rows = model_store.predict_file('Test Forest', input_path, output_path,
+                                        chunksize=7, directory=directory)
+        assert_equals(len(X_test), rows)
+        predictions = pd.read_csv(output_path)['prediction']
+        assert_equals(list(model.predict(X_test)), list(predictions))
+
+
+def test_race_year_partitions(race_df):
+    '''
+    Tests that one year of the racial rep dataset can be read on its own.
+    '''
+    race_df = race_df.assign(selective=pd.to_numeric(race_df['selective'], errors='coerce'),
+                             year=[2016, 2017, 2017, 2016, 2017, 2017])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'racial_years.csv')
+        race_df.to_csv(path, index=False)
+        cache_dir = os.path.join(directory, 'cache')
+        years = ingest.race_years(path, cache_dir)
+        df_2016 = ingest.read_race_year(2016, ['year', 'col_white'], path, cache_dir)
+        df_2015 = ingest.read_race_year(2015, ['year', 'col_white'], path, cache_dir)
+        old = ingest.race_partitions(path, cache_dir)
+        # a changed file is split into a new folder that replaces the old one
+        race_df.assign(year=2018).to_csv(path, index=False)
+        new = ingest.race_partitions(path, cache_dir)
+        folders = [name for name in os.listdir(cache_dir) if '_by_year' in name]
+        assert_equals([os.path.basename(new)], folders)
+        assert_equals(False, old == new)
+        assert_equals([2018], ingest.race_years(path, cache_dir))
+    assert_equals([2016, 2017], years)
+    assert_equals([2016, 2016], list(df_2016['year']))
+    assert_equals([50, 50], list(df_2016['col_white']))
+    assert_equals(0, len(df_2015))
+
+
+def test_cube(race_df, race_df2):
+    '''
+    Tests that the state and year averages from the cube match the averages
+    from the institution rows and that a saved cube only computes new years.
+    '''
+    race_df = race_df.assign(selective=pd.to_numeric(race_df['selective'], errors='coerce'))
+    averages = race.state_race_averages(race_df)
+    from_cube = cube.state_averages(cube.partials(race_df))
+    assert_equals(list(averages.columns), list(from_cube.columns))
+    assert_equals(averages['col_minority'].tolist(), from_cube['col_minority'].tolist())
+    assert_equals(averages['dif_black'].tolist(), from_cube['dif_black'].tolist())
+    yearly = race.race_percent_time_bar(None, True, cube.year_averages(cube.partials(race_df2)))
+    assert_equals(race.race_percent_time_bar(race_df2, True).to_dict('list'),
+                  yearly.to_dict('list'))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'racial_cube.csv')
+        race_df.assign(year=2016).to_csv(path, index=False)
+        cache_dir = os.path.join(directory, 'cache')
+        saved = cube.load_cube(path, cache_dir=cache_dir)
+        assert_equals([2016], sorted(saved['year'].unique().tolist()))
+        # changes the saved 2016 sums, which stay changed if 2016 is not computed again
+        cube_path = os.path.join(cache_dir, 'cube', ingest.cache_key(path), 'cube.parquet')
+        saved.assign(sum=saved['sum'] * 2).to_parquet(cube_path, index=False)
+        pd.concat([race_df.assign(year=2016), race_df]).to_csv(path, index=False)
+        updated = cube.load_cube(path, cache_dir=cache_dir)
+        assert_equals(averages['col_white'].tolist(),
+                      cube.state_averages(updated, [2017])['col_white'].tolist())
+        assert_equals((averages['col_white'] * 2).tolist(),
+                      cube.state_averages(updated, [2016])['col_white'].tolist())
+
+
 def test_year_averages(race_df1, race_df2):
     '''
     Tests the averaging per year organization